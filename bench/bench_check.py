@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+# check() のベンチマーク: 従来の都道府県×エリアの二重ループと比較する
+#
+# 使い方: python3 bench/bench_check.py [エントリ数]
+#   全国 47 都道府県・約 1,900 区域の area.csv 相当の設定と、
+#   各地の気象警報・注意報を含む合成フィード（既定 60 エントリ）で計測し、結果の一致も確認する。
+import os
+import sys
+import timeit
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jma
+
+REPEAT = 20
+PREFS = ['北海道', '青森県', '岩手県', '宮城県', '秋田県', '山形県', '福島県', '茨城県', '栃木県', '群馬県',
+         '埼玉県', '千葉県', '東京都', '神奈川県', '新潟県', '富山県', '石川県', '福井県', '山梨県', '長野県',
+         '岐阜県', '静岡県', '愛知県', '三重県', '滋賀県', '京都府', '大阪府', '兵庫県', '奈良県', '和歌山県',
+         '鳥取県', '島根県', '岡山県', '広島県', '山口県', '徳島県', '香川県', '愛媛県', '高知県', '福岡県',
+         '佐賀県', '長崎県', '熊本県', '大分県', '宮崎県', '鹿児島県', '沖縄県']
+AREAS_PER_PREF = 40
+
+
+def check_legacy(feed):
+    links = {}
+    for item in feed.entries:
+        if jma.USE_LEGACY_FEED:
+            if item.title != jma.ITEM_TITLE:
+                continue
+        else:
+            if not item.title.startswith(jma.ITEM_TITLE_R06):
+                continue
+        for p_name, area_codes in jma.pref.items():
+            for a_code in area_codes:
+                if p_name in item.description:
+                    links[item.link] = jma.pref[p_name]
+                    break
+    return links
+
+
+def make_config():
+    jma.pref.clear()
+    for i, p_name in enumerate(PREFS):
+        jma.pref[p_name] = {f'{(i + 1) * 100000 + j * 100:07d}': 1 for j in range(AREAS_PER_PREF)}
+    jma.build_pref_matcher()
+
+
+def make_feed(n_entry):
+    entries = []
+    for i in range(n_entry):
+        p_name = PREFS[i * 7 % len(PREFS)]
+        title = f'{jma.ITEM_TITLE_R06}（大雨）' if i % 4 else '気象情報'
+        entries.append(SimpleNamespace(
+            title=title,
+            description=f'【{p_name}気象警報・注意報】{p_name}では、土砂災害に警戒してください。',
+            link=f'https://www.data.jma.go.jp/developer/xml/data/{i:04d}_VPWW55_{i:06d}.xml'))
+    return SimpleNamespace(entries=entries)
+
+
+def main():
+    n_entry = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    make_config()
+    feed = make_feed(n_entry)
+
+    assert jma.check(feed) == check_legacy(feed), 'result mismatch'
+    t_old = min(timeit.repeat(lambda: check_legacy(feed), number=1, repeat=REPEAT))
+    t_new = min(timeit.repeat(lambda: jma.check(feed), number=1, repeat=REPEAT))
+    print(f'{len(jma.pref)} prefectures, {sum(map(len, jma.pref.values()))} areas, {n_entry} entries: '
+          f'legacy {t_old * 1000:8.3f} ms  new {t_new * 1000:8.3f} ms  x{t_old / t_new:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+#!/usr/bin/python3
+# compare_and_post() のベンチマーク: 従来の全コード走査・if/elif 方式と代表的な入力で処理時間を比較する
+#
+# 使い方: python3 bench/bench_compare.py
+#   従来の実装と全組合せでの一致の確認は tests/test_compare.py にある（この比較でも同じ従来の実装を使う）。
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+import jma
+from test_compare import AREA_CODE, compare_and_post_legacy, state
+
+REPEAT = 2000
+
+
+def main():
+    jma.area[AREA_CODE] = [f'acct{i}' for i in range(8)]
+    jma.write_last = lambda *args: None
+
+    # 典型例: 大雨注意報・雷注意報が継続し、大雨警報が危険警報へ、強風注意報が暴風警報へ変化
+    ref_last = state(['10', '14', '03', '15'])
+    ref_last['time'] = 100
+    current = state(['10', '14', '43', '05'], '')
+    t_old = min(timeit.repeat(lambda: compare_and_post_legacy(AREA_CODE, 200, current, None, ref_last), number=REPEAT, repeat=5))
+    t_new = min(timeit.repeat(lambda: jma.compare_and_post(AREA_CODE, 200, current, None, ref_last), number=REPEAT, repeat=5))
+    print(f'typical call: legacy {t_old / REPEAT * 1e6:7.1f} us  new {t_new / REPEAT * 1e6:7.1f} us  x{t_old / t_new:.1f}')
+
+
+if __name__ == '__main__':
+    main()
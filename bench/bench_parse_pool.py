@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+# 解析プロセス（PARSE_PROCESSES）のベンチマーク: 電文をプロセス数毎に並列に解析した時の速度を比較する
+#
+# 使い方: python3 bench/bench_parse_pool.py [電文数] [区域数]
+#   bench_xml.py の合成電文（既定 128 通、1通 100 区域）を、同一プロセスで順に parse_telegram() した場合と、
+#   ProcessPoolExecutor(spawn) で 1, 2, 4, … os.cpu_count() プロセスに分けた場合とで計測し、結果の一致も確認する。
+#   プロセスの起動時間（jma.py の読込みを含む）は「起動」として別に表示する。
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jma
+from bench_xml import make_telegram
+
+TELEGRAMS = 128
+AREAS = 100
+WARMUP = 0.1	# 起動を確認するため各プロセスに待たせる時間(秒)。起動時間からは除く
+
+
+def worker_counts():
+    cpus = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= cpus:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cpus:
+        counts.append(cpus)
+    return counts
+
+
+def main():
+    telegrams = int(sys.argv[1]) if len(sys.argv) > 1 else TELEGRAMS
+    areas = int(sys.argv[2]) if len(sys.argv) > 2 else AREAS
+    content, codes = make_telegram(areas)
+    ref_area = frozenset(codes)
+    print(f'{telegrams} telegrams x {len(content) // 1024} KiB ({areas} areas), os.cpu_count()={os.cpu_count()}')
+
+    start = time.perf_counter()
+    expected = [jma.parse_telegram(content, ref_area) for _ in range(telegrams)]
+    base = time.perf_counter() - start
+    print(f'in-process      : {base * 1000:8.1f} ms')
+
+    for workers in worker_counts():
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            for future in [executor.submit(time.sleep, WARMUP) for _ in range(workers)]:
+                future.result()	# 全プロセスを起動させる
+            ready = time.perf_counter()
+            results = [r for r, _ in executor.map(jma.parse_worker, [content] * telegrams, [ref_area] * telegrams,
+                                                   chunksize=max(1, telegrams // (workers * 8)))]
+            done = time.perf_counter()
+        assert results == expected, 'result mismatch'
+        print(f'{workers:2d} processes    : {(done - ready) * 1000:8.1f} ms  x{base / (done - ready):4.2f}'
+              f'   (start-up {(ready - start - WARMUP) * 1000:6.1f} ms)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# 取得 → 解析 → 集約のパイプライン（run_pipeline()）のベンチマーク: 従来の「全電文の解析を待つ」方式と比較する
+#
+# 使い方: python3 bench/bench_pipeline.py [取得遅延(秒)]
+#   PREFS 都道府県 × VPWW55/57/58 の合成電文（1電文 AREAS_PER_PREF 区域、同一 report_time）を、
+#   取得遅延（既定 0.2 秒 ± JITTER、最後の電文だけ SLOW_FACTOR 倍）付きの偽の fetch_xml() で流し、
+#   最初の投稿が outbox に登録されるまでの時間と全体の時間を計測する。outbox の内容の一致も確認する。
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jma
+
+PREFS = 12
+AREAS_PER_PREF = 20
+VPWW_TYPES = {'VPWW55': [(10, '発表'), (3, '発表')], 'VPWW57': [(19, '発表')], 'VPWW58': [(15, '発表'), (5, '継続')]}
+JITTER = 0.5	# 取得遅延のばらつき（遅延に対する割合）
+SLOW_FACTOR = 5	# 最後の電文の取得遅延の倍率（応答の遅い電文が1つある場合）
+SEED = 1
+
+
+# ── 従来の実装（比較用）: 全電文を取得・解析してからエリア毎に処理する ─────────────
+def run_barrier(ref_links):
+    links = list(ref_links)
+    jma.load_state_cache()
+    with ThreadPoolExecutor(max_workers=min(jma.FETCH_WORKERS, len(links))) as executor:
+        contents = list(executor.map(jma.fetch_xml, links))
+    parts = {}
+    for index, (link, content) in enumerate(zip(links, contents)):
+        if content is None:
+            continue
+        for area_code_text, (report_time, current) in jma.parse_xml(content, ref_links[link]).items():
+            parts.setdefault(area_code_text, []).append((index, report_time, current, jma.extract_vpww_type(link)))
+    return sum(jma.process_area(code, jma.merge_events(p))[0] for code, p in parts.items())
+
+
+def run_streaming(ref_links):
+    return jma.run_pipeline(ref_links)[1]
+
+
+# ── 合成データ ───────────────────────────────────────────────────────
+def make_telegram(codes, kinds):
+    items = ''.join(f'''
+      <Item>{''.join(f"""
+        <Kind>
+          <Name>x</Name><Code>{code:02d}</Code><Status>{status}</Status>
+        </Kind>""" for code, status in kinds)}
+        <Area><Name>区域{c}</Name><Code>{c}</Code></Area>
+      </Item>''' for c in codes)
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
+<Report xmlns="http://xml.kishou.go.jp/jmaxml1/">
+  <Head xmlns="http://xml.kishou.go.jp/jmaxml1/informationBasis1/">
+    <ReportDateTime>2026-10-18T10:00:00+09:00</ReportDateTime>
+  </Head>
+  <Body xmlns="http://xml.kishou.go.jp/jmaxml1/body/meteorology1/">
+    <Warning type="{jma.WARNING_TYPE_R06}">{items}
+    </Warning>
+  </Body>
+</Report>
+'''.encode('utf-8')
+
+
+def setup(work_dir):
+    """area.csv を作って読み込み、{リンク => ref_area} と {リンク => 本文} を返す。"""
+    area_csv = os.path.join(work_dir, 'area.csv')
+    pref_codes = {}
+    with open(area_csv, 'w', encoding='utf-8') as f:
+        for p in range(PREFS):
+            codes = [f'{1000000 * (p + 10) + 100 * (i + 1)}' for i in range(AREAS_PER_PREF)]
+            pref_codes[f'県{p:02d}'] = codes
+            for code in codes:
+                accts = [f'{code}{g}' for g in ('wa', 'ww', 'wuw', 'wew', 'ewa', 'eww', 'ewuw', 'ewew')]
+                f.write(f'{code},区域{code},Area{code},x,県{p:02d},{",".join(accts)},tag{code},tage{code}\n')
+    jma.AREA_CSV = area_csv
+    jma.read_area()
+
+    ref_links = {}
+    contents = {}
+    for p_name, codes in pref_codes.items():
+        for vpww_type, kinds in VPWW_TYPES.items():
+            link = f'https://example.invalid/data/20261018010000_0_{vpww_type}_{codes[0][:2]}0000.xml'
+            ref_links[link] = jma.pref[p_name]
+            contents[link] = make_telegram(codes, kinds)
+    return ref_links, contents
+
+
+def run(name, func, ref_links, contents, latency):
+    work_dir = tempfile.mkdtemp(prefix='jma_pipeline_')
+    jma.close_state()
+    jma.LAST_DIR = work_dir + '/'
+    jma.STATE_DB = jma.LAST_DIR + 'state.db'
+    random.seed(SEED)
+    delays = {link: latency * (1 + random.uniform(-JITTER, JITTER)) for link in ref_links}
+    delays[list(ref_links)[-1]] = latency * SLOW_FACTOR
+
+    def fetch_xml(url):
+        time.sleep(delays[url])
+        return contents[url]
+
+    first = []
+    enqueue_post = jma.enqueue_post
+
+    def timed_enqueue(*args):
+        if not first:
+            first.append(time.perf_counter())
+        return enqueue_post(*args)
+
+    jma.fetch_xml = fetch_xml
+    jma.enqueue_post = timed_enqueue
+    start = time.perf_counter()
+    try:
+        queued = func(ref_links)
+    finally:
+        jma.enqueue_post = enqueue_post
+    total = time.perf_counter() - start
+    rows = jma.state_db.execute('SELECT area_code, acct, report_time, text FROM outbox ORDER BY area_code, acct').fetchall()
+    print(f'{name:9}: first post queued {(first[0] - start) * 1000:8.1f} ms   all done {total * 1000:8.1f} ms   '
+          f'posts {queued}')
+    return rows
+
+
+def main():
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.2
+    ref_links, contents = setup(tempfile.mkdtemp(prefix='jma_pipeline_'))
+    print(f'{len(ref_links)} telegrams ({PREFS} prefectures x {len(VPWW_TYPES)} types, {AREAS_PER_PREF} areas each), '
+          f'fetch latency {latency:.2f}s +/-{JITTER:.0%} (last one x{SLOW_FACTOR}), FETCH_WORKERS={jma.FETCH_WORKERS}')
+    old = run('barrier', run_barrier, ref_links, contents, latency)
+    new = run('pipeline', run_streaming, ref_links, contents, latency)
+    assert old == new, 'outbox mismatch'
+    jma.close_state()
+
+
+if __name__ == '__main__':
+    main()
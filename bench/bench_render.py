@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+# render_post() のベンチマーク: 従来の投稿ごとに正規表現で分解し、TextBuilder で組み立てて build_text() で数え直す実装と比較する
+#
+# 使い方: python3 bench/bench_render.py [area.csv post.csv]
+#   area.csv の全エリアの全アカウント（日本語・英語）について、代表的なステータスの組合せ(NORMAL)を描画し、
+#   本文・facet（outbox に保存する形）が従来の実装と一致することを確認してから1投稿あたりの時間を比較する。
+#   従来の時間は outbox に保存する形への変換（models.get_model_as_dict()）を含む（初回の描画は定型部分の
+#   準備を含むため別に表示する）。次に上限を超える組合せ(LONG)を描画し、書記素クラスタ数・バイト数が上限内に
+#   収まり、残したリンクの facet が本文の等級名などを正しく指すことを確認する。
+#   引数が無い時は全国 47 都道府県 × AREAS_PER_PREF 区域の合成設定を使う。
+import os
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from atproto import client_utils, models	# 従来の実装と、その結果を outbox に保存する形にするのに使う
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jma
+
+PREFS = 47
+AREAS_PER_PREF = 40
+REPORT_TIME = 1792285200	# 2026-10-18 10:00 JST
+# 代表的な組合せ: (コード, ステータス)。昇格・降格のステータスは他の等級のアカウントへのリンクになる
+NORMAL = [('03', '注意報から警報'), ('10', '発表'), ('14', '継続'), ('15', '警報から注意報'), ('18', '解除'),
+          ('04', '特別警報から警報')]
+# 上限を超える組合せ: 全コードにステータスを順に割り当てる
+LONG_STATUSES = ['発表', '継続', '警報から注意報', '注意報から警報', '特別警報から危険警報', '危険警報から警報',
+                 '解除', '警報へ変化', '特別警報へ変化', '危険警報から注意報']
+
+
+# ── 従来の実装（比較用） ─────────────────────────────────────────────
+def linkify_status_legacy(status_text, acct):
+    acct_area = jma.acct_area
+    ja        = acct_area[acct]['lang'] == 'ja'
+    grade_idx = jma.GRADE_INDEX_JA if ja else jma.GRADE_INDEX_EN
+    grade_re  = jma.GRADE_RE_JA   if ja else jma.GRADE_RE_EN
+    cur_grade = acct_area[acct]['grade']
+    accts     = jma.area.get(acct_area[acct]['code'], [])
+    base      = 0 if ja else 4
+
+    segs = []
+    pos = 0
+    for m in grade_re.finditer(status_text):
+        token = m.group(0)
+        if token == cur_grade:
+            continue
+        idx = base + grade_idx[token]
+        target = accts[idx] if idx < len(accts) else ''
+        if not target or target not in jma.post_acct:
+            continue
+        if m.start() > pos:
+            segs.append((status_text[pos:m.start()], None))
+        handle = jma.post_acct[target]['bs_username']
+        url = f"https://bsky.app/profile/{jma.bs_handles.cached_did(handle) or handle}"
+        segs.append((token, url))
+        pos = m.end()
+    if pos < len(status_text):
+        segs.append((status_text[pos:], None))
+    if not segs:
+        segs = [(status_text, None)]
+    return segs
+
+
+def render_post_legacy(report_datetime, acct, ref_code_status):
+    acct_area = jma.acct_area
+    ja = acct_area[acct]['lang'] == 'ja'
+
+    kind_str = {}
+    status = {}
+    cnt = 50
+    delimiter = '、' if ja else ', '
+
+    for code, value in ref_code_status.items():
+        match = re.fullmatch(r'(.*),([^,]+)', value)
+        if match:
+            name, st = match.groups()
+            key = jma.STATUS_KEY.get(st, cnt)
+            cnt += 1 if key == cnt else 0
+            kind_str[key] = kind_str.get(key, '') + delimiter + name
+            status[key] = st
+
+    grade_level = f'{acct_area[acct]["grade"]}({jma.GRADE_LEVEL.get(acct_area[acct]["grade"], "")})'
+    segments = [(f'【{acct_area[acct]["name"]}：{grade_level}】\n' if ja
+                 else f'% {acct_area[acct]["name"]} : {grade_level} %\n', None)]
+
+    for k in sorted(status.keys()):
+        if k < 0:
+            continue
+        kind_str[k] = re.sub(r'^[、,]', '', kind_str[k])
+        if ja:
+            ob, cb = ('《', '》') if k < 10 else ('‥', '‥') if k < 50 else ('｛', '｝')
+        else:
+            ob, cb = ('[', ']') if k < 10 else ('-', '-') if k < 50 else ('{', '}')
+        grade = re.match(r'(.+)へ変化', status[k]) or re.search(r'Change to (.+)$', status[k])
+        grade = grade.group(1) if grade else acct_area[acct]['grade']
+        segments.append((ob, None))
+        segments.extend(linkify_status_legacy(status[k], acct))
+        if ja:
+            segments.append((f'{cb} {kind_str[k]} {grade}\n', None))
+        else:
+            segments.append((f'{cb} {kind_str[k]}\n', None))
+
+    local_tz = datetime.now().astimezone().tzinfo
+    dt = datetime.fromtimestamp(report_datetime, local_tz)
+    formatted_time = dt.strftime('%Y-%m-%d %H:%M')
+    segments.append((f" ({formatted_time})", None))
+
+    body = ''.join(t for t, _ in segments)
+
+    tb = client_utils.TextBuilder()
+    if len(body) > 299:
+        tb = tb.text(body[:299] + '…')
+    else:
+        for t, u in segments:
+            tb = tb.link(t, u) if u else tb.text(t)
+
+    if len(tb.build_text()) + len(acct_area[acct]['tag']) + 3 < 299:
+        tb = tb.text(f"\n ")
+        for tag in acct_area[acct]["tag"].split(' '):
+            tb = tb.tag('#' + tag + ' ', tag)
+
+    mssg = f'\n[気象庁サイトへ]' if ja else f'\n[To JMA site]'
+    if len(tb.build_text()) + len(mssg) < 299:
+        tb = tb.link(mssg, jma.FORM_URL_JMA_WARNING.format(acct_area[acct]['code'], acct_area[acct]['lang']))
+    return tb
+
+
+# ── 合成データ ───────────────────────────────────────────────────────
+def make_config(work_dir):
+    area_csv = os.path.join(work_dir, 'area.csv')
+    post_csv = os.path.join(work_dir, 'post.csv')
+    with open(area_csv, 'w', encoding='utf-8') as area_f, open(post_csv, 'w', encoding='utf-8') as post_f:
+        for p in range(PREFS):
+            for i in range(AREAS_PER_PREF):
+                code = f'{(p + 1) * 100000 + (i + 1) * 100:07d}'
+                accts = [f'jma{code}{g}' for g in ('wa', 'ww', 'wuw', 'wew', 'ewa', 'eww', 'ewuw', 'ewew')]
+                area_f.write(f'{code},テスト市{code},Test City {code},x,県{p:02d},{",".join(accts)},'
+                             f'テスト市 気象警報,TestCity JMA_Warning\n')
+                for acct in accts:
+                    post_f.write(f'{acct},{acct}.bsky.social,pw\n')
+    return area_csv, post_csv
+
+
+def code_status(scenario, lang):
+    if lang == 'ja':
+        return {code: f'{jma.code_kind[code]},{st}' for code, st in scenario}
+    return {code: f'{jma.code_kind_e[code]},{jma.status_ja_en[st]}' for code, st in scenario}
+
+
+def as_post(post):
+    """従来の TextBuilder を render_post() と同じ (本文, facets) の形にする。"""
+    if isinstance(post, tuple):
+        return post
+    return post.build_text(), [models.get_model_as_dict(f) for f in post.build_facets()]
+
+
+def run(render, accts, statuses):
+    start = time.perf_counter()
+    posts = [as_post(render(REPORT_TIME, acct, statuses[jma.acct_area[acct]['lang']])) for acct in accts]
+    return time.perf_counter() - start, posts
+
+
+def check_facets(text, facets):
+    """facet が本文の中に収まり、リンク・タグの文字列を指していることを確かめる。"""
+    data = text.encode('utf-8')
+    for facet in facets:
+        token = data[facet['index']['byteStart']:facet['index']['byteEnd']].decode('utf-8')
+        feature = facet['features'][0]
+        if 'tag' in feature:
+            assert token == f"#{feature['tag']} ", token
+        elif 'bsky.app/profile/' in feature['uri']:
+            assert token in jma.GRADE_INDEX_JA or token in jma.GRADE_INDEX_EN, token
+        else:
+            assert token in ('\n[気象庁サイトへ]', '\n[To JMA site]'), token
+
+
+def main():
+    work_dir = tempfile.mkdtemp(prefix='jma_render_')
+    if len(sys.argv) > 2:
+        jma.AREA_CSV, jma.POST_CSV = sys.argv[1:3]
+    else:
+        jma.AREA_CSV, jma.POST_CSV = make_config(work_dir)
+    jma.HANDLE_CACHE = os.path.join(work_dir, 'handles.db')
+    jma.syslog.syslog = lambda *args: None	# 切り詰めの警告を出力しない
+    jma.read_config()
+    accts = [acct for acct in jma.acct_area if acct]
+    print(f'{len(jma.area)} areas, {len(accts)} accounts (ja + en)')
+
+    normal = {lang: code_status(NORMAL, lang) for lang in ('ja', 'en')}
+    t_old, old = run(render_post_legacy, accts, normal)
+    t_first, new = run(jma.render_post, accts, normal)
+    t_new, new = run(jma.render_post, accts, normal)
+    assert old == new, 'post mismatch'
+    print(f'normal  : legacy {t_old / len(accts) * 1e6:7.1f} us/post   new {t_new / len(accts) * 1e6:7.1f} us/post '
+          f'x{t_old / t_new:.1f}   (first render with template {t_first / len(accts) * 1e6:7.1f} us/post)')
+
+    codes = sorted(jma.code_kind)
+    long = {lang: code_status([(code, LONG_STATUSES[i % len(LONG_STATUSES)]) for i, code in enumerate(codes)], lang)
+            for lang in ('ja', 'en')}
+    t_old, old = run(render_post_legacy, accts, long)
+    t_new, new = run(jma.render_post, accts, long)
+    facets_new = 0
+    for text, facets in new:
+        assert jma.grapheme_len(text) <= jma.POST_MAX_GRAPHEMES and len(text.encode('utf-8')) <= jma.POST_MAX_BYTES
+        check_facets(text, facets)
+        facets_new += len(facets)
+    facets_old = sum(len(facets) for _, facets in old)
+    print(f'long    : legacy {t_old / len(accts) * 1e6:7.1f} us/post   new {t_new / len(accts) * 1e6:7.1f} us/post '
+          f'x{t_old / t_new:.1f}   facets kept: legacy {facets_old / len(accts):.1f}  new {facets_new / len(accts):.1f} '
+          f'per post')
+
+
+if __name__ == '__main__':
+    main()
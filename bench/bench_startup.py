@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+# 起動コストのベンチマーク: 更新なし(304)で終わる1回分の実行の読込み時間・実行時間・最大RSS を計測する
+#
+# 使い方: python3 bench/bench_startup.py [回数]
+#   ローカルに常に 304 を返すフィードサーバを立て、jma.py を読み込んで run_once() を1回実行する子プロセスを
+#   既定 5 回ずつ起動する（状態は一時ディレクトリに作り、outbox は空）。
+#     lazy  … 現在の jma.py（atproto・feedparser は使う時まで読み込まない）
+#     eager … 従来どおり atproto・feedparser・multiprocessing・http.server を先に読み込んでから jma.py を読み込む
+#   子プロセスは -X importtime 付きで起動し、読込みに時間のかかったモジュールの上位も表示する。
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+RUNS = 5
+EAGER_MODULES = ['atproto', 'feedparser', 'multiprocessing', 'http.server']	# 従来 jma.py が先頭で読み込んでいたもの
+TOP_IMPORTS = 5
+
+
+def child(mode, url, work_dir):
+    """子プロセス側: 読み込み → run_once() を1回実行し、結果を JSON で標準出力に書く。"""
+    start = time.perf_counter()
+    if mode == 'eager':
+        for name in EAGER_MODULES:
+            __import__(name)
+    sys.path.insert(0, ROOT)
+    import jma
+    imported = time.perf_counter()
+
+    jma.LAST_DIR = work_dir + '/'
+    jma.STATE_DB = jma.LAST_DIR + 'state.db'
+    jma.LEDGER_FILE = jma.LAST_DIR + 'ledger'
+    jma.FEED_STATE = jma.LAST_DIR + 'feed_state'
+    jma.LAST_MODIFIED = jma.LAST_DIR + 'last_modified'
+    jma.SESSION_DIR = jma.LAST_DIR + 'session/'
+    jma.HANDLE_CACHE = jma.LAST_DIR + 'handles.db'
+    jma.URL_JMA_PULL = url
+    jma.write_feed_state(int(time.time()), '')
+    jma.run_once()
+    jma.close_state()
+    done = time.perf_counter()
+
+    print(json.dumps({'import': imported - start, 'run': done - imported,
+                      'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      'atproto': 'atproto' in sys.modules, 'feedparser': 'feedparser' in sys.modules}))
+
+
+# def parse_importtime(stderr)
+# return: -X importtime の出力から、トップレベルの import を累積時間(マイクロ秒)の大きい順に [(us, name)]
+def parse_importtime(stderr):
+    result = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            result.append((int(cumulative), name.strip()))
+    return sorted(result, reverse=True)
+
+
+def run_child(mode, url):
+    with tempfile.TemporaryDirectory(prefix='jma_startup_') as work_dir:
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', os.path.abspath(__file__), '--child',
+                               mode, url, work_dir], capture_output=True, text=True, check=True)
+        wall = time.perf_counter() - start
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result['wall'] = wall
+    result['imports'] = parse_importtime(proc.stderr)
+    return result
+
+
+def main():
+    # 子プロセスの計測に含まれないよう、サーバ側のモジュールはここで読み込む
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class NotModifiedHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(304)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+    server = ThreadingHTTPServer(('127.0.0.1', 0), NotModifiedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/extra.xml'
+
+    results = {'eager': [], 'lazy': []}
+    for _ in range(runs):
+        for mode in results:
+            results[mode].append(run_child(mode, url))
+    server.shutdown()
+
+    print(f'no-update run (304, empty outbox), median of {runs} processes')
+    print(f'{"":6} {"wall":>9} {"import":>9} {"run_once":>9} {"max RSS":>10}  atproto  feedparser')
+    for mode, rs in results.items():
+        print(f'{mode:6} {statistics.median(r["wall"] for r in rs) * 1000:7.1f}ms'
+              f' {statistics.median(r["import"] for r in rs) * 1000:7.1f}ms'
+              f' {statistics.median(r["run"] for r in rs) * 1000:7.1f}ms'
+              f' {statistics.median(r["rss"] for r in rs) / 1024:8.1f}MB'
+              f'  {"loaded" if rs[0]["atproto"] else "-":7}  {"loaded" if rs[0]["feedparser"] else "-"}')
+    for mode, rs in results.items():
+        print(f'slowest top-level imports ({mode}, -X importtime):')
+        for us, name in rs[-1]['imports'][:TOP_IMPORTS]:
+            print(f'  {us / 1000:8.1f}ms  {name}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '--child':
+        child(*sys.argv[2:])
+    else:
+        main()
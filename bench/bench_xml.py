@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+# parse_xml() のベンチマーク: 従来の find_element_by_tag 方式と比較する
+#
+# 使い方: python3 bench/bench_xml.py [電文XML ...]
+#   電文を指定しない場合は府県全域（市町村等 200 区域）の合成 VPWW 電文を使う。
+#   全区域を ref_area とした場合と、1区域のみの場合の両方で計測し、結果の一致も確認する。
+import os
+import re
+import sys
+import tempfile
+import timeit
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jma
+
+REPEAT = 20
+
+
+# ── 従来の実装（比較用） ─────────────────────────────────────────────
+def find_element_by_tag(data, tag_list):
+    dat = data
+    for tag in tag_list:
+        for element in dat.iter():
+            if re.search(rf"[^A-Za-z\d]{tag}$", element.tag):
+                dat = element
+                break
+        if dat == None:
+            return None
+    return dat
+
+def find_element_list_by_tag(data, tag):
+    element_list = []
+    for element in data.iter():
+        if re.search(rf"[^A-Za-z\d]{tag}$", element.tag):
+            element_list.append(element)
+    return element_list
+
+def parse_xml_legacy(content, ref_area):
+    root = ET.fromstring(content)
+    report_datetime = find_element_by_tag(root, ['Report', 'Head', 'ReportDateTime'])
+    body            = find_element_by_tag(root, ['Report', 'Body'])
+    warning         = find_element_list_by_tag(body, 'Warning')
+
+    report_time = 0
+    match = re.match(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})\+09:00$', report_datetime.text)
+    if match:
+        year, month, day, hour, minute, second = map(int, match.groups())
+        report_time = int(datetime(year, month, day, hour, minute, second).timestamp())
+
+    result = {}
+    accepted_types = {jma.WARNING_TYPE} if jma.USE_LEGACY_FEED else {jma.WARNING_TYPE, jma.WARNING_TYPE_R06}
+
+    for warn_elem in warning:
+        if warn_elem.get('type') not in accepted_types:
+            continue
+        for item_elem in find_element_list_by_tag(warn_elem, 'Item'):
+            area_code_text = find_element_by_tag(item_elem, ['Area', 'Code']).text
+            if area_code_text not in ref_area:
+                continue
+
+            ref_last_t = jma.read_last(int(area_code_text))
+            if 'time' in ref_last_t:
+                if report_time < ref_last_t['time']:
+                    continue
+                if report_time == ref_last_t['time'] and jma.USE_LEGACY_FEED:
+                    continue
+
+            current = {'wa': {}, 'ww': {}, 'wuw': {}, 'wew': {}}
+            for kind_elem in find_element_list_by_tag(item_elem, 'Kind'):
+                try:
+                    kind_elem_code   = int(find_element_by_tag(kind_elem, ['Code']).text)
+                    kind_elem_status = find_element_by_tag(kind_elem, ['Status']).text
+                    condition        = find_element_by_tag(kind_elem, ['Condition']).text.strip()
+                except:
+                    continue
+                if kind_elem_status == '解除':
+                    continue
+                code_str = f"{kind_elem_code:02d}"
+                if   10 <= kind_elem_code < 30: current['wa' ][code_str] = condition
+                elif  2 <= kind_elem_code < 10: current['ww' ][code_str] = condition
+                elif 40 <= kind_elem_code < 50: current['wuw'][code_str] = condition
+                elif 30 <= kind_elem_code < 40: current['wew'][code_str] = condition
+
+            result[area_code_text] = (report_time, current)
+
+    return result
+
+
+# ── 合成電文 ─────────────────────────────────────────────────────────
+def make_telegram(n_area=200):
+    kinds = [(10, '発表', ''), (3, '継続', '土砂災害'), (15, '発表', ''), (14, '解除', ''), (43, '発表', ''), (20, '継続', '')]
+
+    def kind(code, status, cond):
+        prop = ''.join(
+            f'''
+          <Property>
+            <Type>{t}</Type>
+            <DetailForecast><PeakTime><Date>2026-10-18T12:00:00+09:00</Date></PeakTime></DetailForecast>
+            <Addition><Note>ピーク時の{t}に注意</Note></Addition>
+          </Property>''' for t in ('雨', '風', '波'))
+        c = f'\n          <Condition>{cond}</Condition>' if cond else ''
+        return f'''
+        <Kind>
+          <Name>x</Name>
+          <Code>{code:02d}</Code>
+          <Status>{status}</Status>{c}{prop}
+        </Kind>'''
+
+    def warning(type_, codes):
+        items = ''.join(f'''
+      <Item>{''.join(kind(*k) for k in kinds)}
+        <Area><Name>区域{c}</Name><Code>{c}</Code></Area>
+        <ChangeStatus>警報・注意報種別に変化有</ChangeStatus>
+      </Item>''' for c in codes)
+        return f'<Warning type="{type_}">{items}\n    </Warning>'
+
+    codes = [f'{1310100 + i * 100}' for i in range(n_area)]
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
+<Report xmlns="http://xml.kishou.go.jp/jmaxml1/">
+  <Control><Title>気象警報・注意報（Ｒ０６）（大雨）</Title></Control>
+  <Head xmlns="http://xml.kishou.go.jp/jmaxml1/informationBasis1/">
+    <Title>気象警報・注意報</Title>
+    <ReportDateTime>2026-10-18T10:00:00+09:00</ReportDateTime>
+  </Head>
+  <Body xmlns="http://xml.kishou.go.jp/jmaxml1/body/meteorology1/">
+    {warning('気象警報・注意報（府県予報区等）', ['130000'])}
+    {warning('気象警報・注意報（一次細分区域等）', codes[:20])}
+    {warning(jma.WARNING_TYPE_R06, codes)}
+  </Body>
+</Report>
+'''.encode('utf-8'), codes
+
+
+def main():
+    jma.LAST_DIR = tempfile.mkdtemp() + '/'    # 前回状態なし
+    jma.STATE_DB = jma.LAST_DIR + 'state.db'
+
+    if len(sys.argv) > 1:
+        telegrams = []
+        for path in sys.argv[1:]:
+            with open(path, 'rb') as f:
+                content = f.read()
+            codes = set(re.findall(rb'<Code>(\d{7})</Code>', content))
+            telegrams.append((os.path.basename(path), content, [c.decode() for c in codes]))
+    else:
+        content, codes = make_telegram()
+        telegrams = [('synthetic', content, codes)]
+
+    for name, content, codes in telegrams:
+        for label, ref_area in (('all areas', {c: 1 for c in codes}), ('1 area', {c: 1 for c in codes[:1]})):
+            new = jma.parse_xml(content, ref_area)
+            old = parse_xml_legacy(content, ref_area)
+            assert new == old, f'{name}: result mismatch ({label})'
+            t_old = min(timeit.repeat(lambda: parse_xml_legacy(content, ref_area), number=1, repeat=REPEAT))
+            t_new = min(timeit.repeat(lambda: jma.parse_xml(content, ref_area), number=1, repeat=REPEAT))
+            print(f'{name} ({len(content) // 1024} KiB, {label:9}): '
+                  f'legacy {t_old * 1000:8.2f} ms  new {t_new * 1000:8.2f} ms  x{t_old / t_new:.1f}')
+
+
+if __name__ == '__main__':
+    main()
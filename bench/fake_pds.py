@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+# 負荷・遅延試験用のローカル Bluesky PDS もどき
+#
+# 使い方: python3 bench/fake_pds.py [--port 2583] [--latency 0.2] [--jitter 0.1]
+#                                   [--error-rate 0.05] [--rate-limit 30 --rate-window 300] [--token-ttl 7200]
+#   jma.py / post_message.py / update_profile.py の接続先を BS_BASE_URL=http://127.0.0.1:2583 で切り替えて使う。
+#   終了時（Ctrl-C / SIGTERM）にエンドポイント別・応答コード別の件数を表示する。
+#
+# 実装している XRPC:
+#   com.atproto.server.createSession / refreshSession, com.atproto.repo.createRecord / getRecord / putRecord,
+#   com.atproto.identity.resolveHandle, app.bsky.actor.getProfile（atproto の login() が呼ぶ）
+# 認証はパスワードを問わず常に成功する。レコードはメモリ上にのみ保持する。
+import argparse
+import base64
+import hashlib
+import json
+import random
+import signal
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+config = None
+lock = threading.Lock()
+stats = Counter()       # (nsid, status) => 件数
+records = {}            # (did, collection, rkey) => record
+tokens = {}             # jwt => (did, scope, exp)
+accounts = {}           # handle => did
+rate_used = {}          # did => [window_start, count]
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def make_jwt(did, scope, ttl):
+    now = int(time.time())
+    header = b64url(json.dumps({'typ': 'JWT', 'alg': 'HS256'}).encode())
+    payload = b64url(json.dumps({'scope': scope, 'sub': did, 'iat': now, 'exp': now + ttl,
+                                 'jti': b64url(random.randbytes(12))}).encode())
+    jwt = f"{header}.{payload}.{b64url(random.randbytes(32))}"
+    tokens[jwt] = (did, scope, now + ttl)
+    return jwt
+
+
+def make_cid(data):
+    return 'bafyrei' + base64.b32encode(hashlib.sha256(data).digest()).decode().lower().rstrip('=')[:52]
+
+
+def did_for(handle):
+    if handle not in accounts:
+        accounts[handle] = 'did:plc:' + base64.b32encode(hashlib.sha256(handle.encode()).digest()).decode().lower()[:24]
+    return accounts[handle]
+
+
+def handle_for(did):
+    return next((h for h, d in accounts.items() if d == did), 'unknown.test')
+
+
+class XrpcError(Exception):
+    def __init__(self, status, error, message='', headers=None):
+        super().__init__(message)
+        self.status = status
+        self.error = error
+        self.message = message
+        self.headers = headers or {}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if config.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        nsid = url.path.rsplit('/', 1)[-1]
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if config.latency or config.jitter:
+            time.sleep(max(0.0, config.latency + random.uniform(-config.jitter, config.jitter)))
+
+        headers = {}
+        try:
+            if random.random() < config.error_rate:
+                raise XrpcError(502 if random.random() < 0.5 else 500, 'InternalServerError', 'injected error')
+            handler = ROUTES.get((method, nsid))
+            if handler is None:
+                raise XrpcError(404, 'MethodNotImplemented', f'{method} {nsid}')
+            status, result = handler(self, json.loads(body) if body else {}, params, headers)
+        except XrpcError as e:
+            status, result = e.status, {'error': e.error, 'message': e.message}
+            headers.update(e.headers)
+
+        with lock:
+            stats[(nsid, status)] += 1
+        data = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, str(v))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # ── 認証・レート制限 ──
+    def auth(self, scope='com.atproto.access'):
+        value = self.headers.get('Authorization', '')
+        jwt = value[len('Bearer '):] if value.startswith('Bearer ') else ''
+        with lock:
+            entry = tokens.get(jwt)
+        if entry is None or entry[1] != scope:
+            raise XrpcError(400, 'InvalidToken', 'Token could not be verified')
+        did, _, exp = entry
+        if exp < time.time():
+            raise XrpcError(400, 'ExpiredToken', 'Token has expired')
+        return did
+
+    def rate_limit(self, did, headers):
+        if not config.rate_limit:
+            return
+        now = time.time()
+        with lock:
+            window = rate_used.setdefault(did, [now, 0])
+            if now - window[0] >= config.rate_window:
+                window[0], window[1] = now, 0
+            window[1] += 1
+            remaining = config.rate_limit - window[1]
+            reset = int(window[0] + config.rate_window)
+        headers.update({'ratelimit-limit': config.rate_limit, 'ratelimit-remaining': max(remaining, 0),
+                        'ratelimit-reset': reset, 'ratelimit-policy': f'{config.rate_limit};w={config.rate_window}'})
+        if remaining < 0:
+            raise XrpcError(429, 'RateLimitExceeded', 'Rate Limit Exceeded', dict(headers))
+
+
+def create_session(h, body, params, headers):
+    identifier = body.get('identifier', '')
+    with lock:
+        did = did_for(identifier)
+    h.rate_limit(did, headers)
+    with lock:
+        return 200, {'did': did, 'handle': identifier,
+                     'accessJwt': make_jwt(did, 'com.atproto.access', config.token_ttl),
+                     'refreshJwt': make_jwt(did, 'com.atproto.refresh', config.token_ttl * 12)}
+
+
+def refresh_session(h, body, params, headers):
+    did = h.auth('com.atproto.refresh')
+    with lock:
+        return 200, {'did': did, 'handle': handle_for(did),
+                     'accessJwt': make_jwt(did, 'com.atproto.access', config.token_ttl),
+                     'refreshJwt': make_jwt(did, 'com.atproto.refresh', config.token_ttl * 12)}
+
+
+def create_record(h, body, params, headers):
+    did = h.auth()
+    h.rate_limit(did, headers)
+    rkey = body.get('rkey') or b64url(random.randbytes(9)).lower()
+    with lock:
+        records[(did, body['collection'], rkey)] = body['record']
+    uri = f"at://{did}/{body['collection']}/{rkey}"
+    return 200, {'uri': uri, 'cid': make_cid(json.dumps(body['record']).encode())}
+
+
+def put_record(h, body, params, headers):
+    did = h.auth()
+    h.rate_limit(did, headers)
+    with lock:
+        records[(did, body['collection'], body['rkey'])] = body['record']
+    uri = f"at://{did}/{body['collection']}/{body['rkey']}"
+    return 200, {'uri': uri, 'cid': make_cid(json.dumps(body['record']).encode())}
+
+
+def get_record(h, body, params, headers):
+    key = (params.get('repo'), params.get('collection'), params.get('rkey'))
+    with lock:
+        record = records.get(key)
+    if record is None:
+        raise XrpcError(400, 'RecordNotFound', f'Could not locate record: at://{"/".join(map(str, key))}')
+    return 200, {'uri': f'at://{"/".join(key)}', 'cid': make_cid(json.dumps(record).encode()), 'value': record}
+
+
+def resolve_handle(h, body, params, headers):
+    handle = params.get('handle', '')
+    if handle.endswith('.invalid'):
+        raise XrpcError(400, 'InvalidRequest', 'Unable to resolve handle')
+    with lock:
+        return 200, {'did': did_for(handle)}
+
+
+def get_profile(h, body, params, headers):
+    actor = params.get('actor', '')
+    with lock:
+        did = actor if actor.startswith('did:') else did_for(actor)
+        handle = handle_for(did) if actor.startswith('did:') else actor
+    return 200, {'did': did, 'handle': handle}
+
+
+ROUTES = {
+    ('POST', 'com.atproto.server.createSession'): create_session,
+    ('POST', 'com.atproto.server.refreshSession'): refresh_session,
+    ('POST', 'com.atproto.repo.createRecord'): create_record,
+    ('POST', 'com.atproto.repo.putRecord'): put_record,
+    ('GET', 'com.atproto.repo.getRecord'): get_record,
+    ('GET', 'com.atproto.identity.resolveHandle'): resolve_handle,
+    ('GET', 'app.bsky.actor.getProfile'): get_profile,
+}
+
+
+def main():
+    global config
+    parser = argparse.ArgumentParser(description='Local stand-in Bluesky PDS for load and latency testing.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2583)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random +/- seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 500/502 response')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='requests per account per window before answering 429 (0: unlimited)')
+    parser.add_argument('--rate-window', type=int, default=300, help='rate limit window in seconds')
+    parser.add_argument('--token-ttl', type=int, default=7200, help='access token lifetime in seconds')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    config = parser.parse_args()
+
+    server = ThreadingHTTPServer((config.host, config.port), Handler)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f'listening on http://{config.host}:{config.port}  (BS_BASE_URL=http://{config.host}:{config.port})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    for (nsid, status), n in sorted(stats.items()):
+        print(f'{n:8d}  {status}  {nsid}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+# 記録したフィード・電文（jma.py --record ZIP）を jma.py の処理にオフラインで流し、処理時間を計測する
+#
+# 使い方: python3 bench/replay.py ZIP [--area area.csv] [--post post.csv]
+#   フィードは記録順（Last-Modified 順）に1件ずつ run_once() へ渡す。
+#   電文は ZIP から読み、投稿は Bluesky へ送らずに件数だけ数える。
+#   状態（state.db など）は一時ディレクトリに作るため、本番の last/ には影響しない。
+#   外部への接続は行わない（接続しようとした時はその接続を失敗させ、終了時に一覧を出して終了コード 1 とする）
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+import atproto	# jma.py は atproto を投稿の送信時まで読み込まないため、読込み時間を post の計測から除く
+import feedparser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jma
+
+# 計測対象の段階: 表示名 => jma の関数名
+STAGES = {
+    'feed parse': 'fetch_feed',
+    'check': 'check',
+    'xml fetch': 'fetch_xml',
+    'xml parse': 'parse_xml',
+    'compare': 'compare_and_post',
+    'render': 'render_post',
+    'post': 'post_acct_items',
+}
+
+stage_time = {name: 0.0 for name in STAGES}
+stage_count = {name: 0 for name in STAGES}
+lock = threading.Lock()
+posts = []
+connections = []	# 接続しようとした宛先（名前解決を含む）
+
+
+def no_network(address):
+    with lock:
+        connections.append(address)
+    raise OSError(f'replay must not connect to {address}')
+
+
+def timed(name, func):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with lock:
+                stage_time[name] += elapsed
+                stage_count[name] += 1
+    return wrapper
+
+
+def post_sink(text, facets, lang, acct, deadline=None):
+    with lock:
+        posts.append((acct, lang, text))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a corpus recorded by jma.py --record.')
+    parser.add_argument('corpus', help='ZIP file written by jma.py --record')
+    parser.add_argument('--area', default=jma.AREA_CSV, help='area.csv to use (default: %(default)s)')
+    parser.add_argument('--post', default=jma.POST_CSV, help='post.csv to use (default: %(default)s)')
+    args = parser.parse_args()
+
+    with zipfile.ZipFile(args.corpus) as zf:
+        feeds = sorted((n for n in zf.namelist() if n.startswith('feed/')),
+                       key=lambda n: int(os.path.splitext(os.path.basename(n))[0]))
+        corpus = {n: zf.read(n) for n in zf.namelist()}
+
+    work_dir = tempfile.mkdtemp(prefix='jma_replay_')
+    jma.LAST_DIR = work_dir + '/'
+    jma.STATE_DB = jma.LAST_DIR + 'state.db'
+    jma.LEDGER_FILE = jma.LAST_DIR + 'ledger'
+    jma.FEED_STATE = jma.LAST_DIR + 'feed_state'
+    jma.LAST_MODIFIED = jma.LAST_DIR + 'last_modified'
+    jma.SESSION_DIR = jma.LAST_DIR + 'session/'
+    jma.HANDLE_CACHE = jma.LAST_DIR + 'handles.db'
+    jma.AREA_CSV = args.area
+    jma.POST_CSV = args.post
+    jma.OUTBOX_EXPIRE = 1 << 40	# 記録した電文は古いため、outbox の期限切れ破棄を行わない
+
+    pending = list(feeds)
+
+    def fetch_feed():
+        return feedparser.parse(corpus[pending.pop(0)])
+
+    def fetch_xml(url):
+        return corpus.get(f"data/{os.path.basename(url)}")
+
+    jma.fetch_feed = fetch_feed
+    jma.fetch_xml = fetch_xml
+    jma.catchup_gap = lambda now: 0	# 記録したフィードを全て流すため、長期フィードによる追いつきは行わない
+    jma.post_bs = post_sink
+    socket.getaddrinfo = lambda host, port, *args, **kwargs: no_network((host, port))
+    socket.socket.connect = lambda sock, address: no_network(address)
+    for name, func_name in STAGES.items():
+        setattr(jma, func_name, timed(name, getattr(jma, func_name)))
+
+    start = time.perf_counter()
+    while pending:
+        jma.run_once()
+    wall = time.perf_counter() - start
+    jma.close_state()
+
+    print(f'feeds      : {len(feeds)}')
+    print(f'telegrams  : {sum(1 for n in corpus if n.startswith("data/"))}')
+    print(f'posts      : {len(posts)}')
+    print(f'wall time  : {wall:.3f} s')
+    print(f'posts/sec  : {len(posts) / wall if wall > 0 else 0.0:.1f}')
+    for name in STAGES:
+        print(f'  {name:12}: {stage_time[name]:8.3f} s  ({stage_count[name]} calls)')
+    print('(post runs on POST_WORKERS threads, so its total can exceed the wall time)')
+    if connections:
+        print(f'ERROR: tried to connect to {sorted(set(map(str, connections)))}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# Bluesky ハンドル → DID の解決結果のキャッシュ。jma.py / post_message.py で共用する。
+#
+#   - CACHE_FILE(SQLite) に保存し、実行をまたいで再利用する（有効期限 TTL、件数上限 MAX_ENTRIES）
+#   - 解決できなかったハンドルも NEGATIVE_TTL の間は記録し、問い合わせを繰り返さない
+#   - resolve_all(): キャッシュに無いハンドルだけを RESOLVE_WORKERS 本まで並列に問い合わせる
+#   - jma.py はログイン時に分かったハンドルと DID を store() で登録し、リンク先の組み立てに使う
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bs_ratelimit
+
+CACHE_FILE = 'last/handles.db'	# post.csv のあるディレクトリ(jma.py の BASE_DIR)からの相対パス。jma.py は LAST_DIR 配下に設定する
+TTL = 24 * 3600	# 解決できたハンドルの有効期限(秒)
+NEGATIVE_TTL = 600	# 解決できなかったハンドルの有効期限(秒)
+MAX_ENTRIES = 10000	# 保存する件数の上限。超えたら最後に使った時刻の古いものから削除する
+RESOLVE_WORKERS = 8	# 同時に問い合わせるハンドル数の上限
+RESOLVE_RETRY = 3
+
+lock = threading.Lock()
+db = None	# CACHE_FILE の接続（open_cache() で生成）
+memory = {}	# handle => (did または None, 有効期限)（db の内容のうち、この実行で参照したもの）
+
+
+def open_cache():
+    global db
+    if db is None:
+        os.makedirs(os.path.dirname(CACHE_FILE) or '.', exist_ok=True)
+        db = sqlite3.connect(CACHE_FILE, timeout=10, check_same_thread=False)
+        db.execute('CREATE TABLE IF NOT EXISTS handles (handle TEXT PRIMARY KEY, did TEXT, '
+                   'expires INTEGER NOT NULL, used INTEGER NOT NULL)')
+        db.commit()
+    return db
+
+
+def close_cache():
+    global db
+    with lock:
+        if db is not None:
+            db.close()
+            db = None
+        memory.clear()
+
+
+# def lookup(handle)
+# return: (キャッシュにあるか, did)  did が None なら「解決できない」と記録されている
+def lookup(handle):
+    handle = handle.lower()
+    now = int(time.time())
+    with lock:
+        entry = memory.get(handle)
+        if entry is None:
+            try:
+                row = open_cache().execute('SELECT did, expires FROM handles WHERE handle = ?', (handle,)).fetchone()
+                if row is not None:
+                    open_cache().execute('UPDATE handles SET used = ? WHERE handle = ?', (now, handle))
+                    db.commit()
+            except sqlite3.Error:
+                row = None
+            entry = memory[handle] = row if row is not None else (None, 0)
+    did, expires = entry
+    return (True, did) if expires > now else (False, None)
+
+
+# def cached_did(handle)
+# return: キャッシュにある DID（無い・期限切れ・解決できないハンドルは None）。問い合わせは行わない
+def cached_did(handle):
+    return lookup(handle)[1]
+
+
+# def store(handle, did)
+# did=None は解決できなかったことを記録する（NEGATIVE_TTL の間）
+def store(handle, did):
+    handle = handle.lower()
+    now = int(time.time())
+    expires = now + (TTL if did else NEGATIVE_TTL)
+    with lock:
+        memory[handle] = (did, expires)
+        try:
+            cache = open_cache()
+            cache.execute('INSERT OR REPLACE INTO handles VALUES (?, ?, ?, ?)', (handle, did, expires, now))
+            over = cache.execute('SELECT COUNT(*) FROM handles').fetchone()[0] - MAX_ENTRIES
+            if over > 0:
+                cache.execute('DELETE FROM handles WHERE handle IN '
+                              '(SELECT handle FROM handles ORDER BY used LIMIT ?)', (over,))
+            cache.commit()
+        except sqlite3.Error:
+            pass	# キャッシュに書けなくても解決結果はこの実行の間は memory で使える
+
+
+# def resolve_all(client, handles, on_error=None)
+# handles を DID に解決して { handle => did または None } を返す。
+# キャッシュに無いものだけを並列に問い合わせる。400(解決できない)は負のキャッシュに記録し、
+# 5xx・通信エラーは記録しない（次回また問い合わせる）
+# on_error(handle, e): 問い合わせに失敗したハンドル毎に呼ぶ（警告の出力用）
+def resolve_all(client, handles, on_error=None):
+    result = {}
+    missing = []
+    for handle in dict.fromkeys(handles):
+        found, did = lookup(handle)
+        if found:
+            result[handle] = did
+        else:
+            missing.append(handle)
+    if not missing:
+        return result
+    from atproto.exceptions import BadRequestError
+
+    def resolve(handle):
+        try:
+            return bs_ratelimit.call(
+                lambda: client.com.atproto.identity.resolve_handle({'handle': handle}).did, RESOLVE_RETRY), None
+        except BadRequestError as e:
+            store(handle, None)
+            return None, e
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=min(RESOLVE_WORKERS, len(missing))) as executor:
+        for handle, (did, error) in zip(missing, executor.map(resolve, missing)):
+            if did:
+                store(handle, did)
+            elif on_error is not None:
+                on_error(handle, error)
+            result[handle] = did
+    return result
@@ -0,0 +1,171 @@
+# Bluesky (PDS) への要求の流量制御。jma.py / post_message.py / update_profile.py で共用する。
+#
+#   - 要求を送る前に、アカウント毎・PDS ホスト毎のトークンバケットから1つずつ取り出す（空なら補充を待つ）
+#   - 応答の ratelimit-remaining / ratelimit-reset を読み、残りが尽きたらリセット時刻までそのアカウントを止める
+#   - call(): 429 はリセット時刻まで待って、5xx・通信エラーはジッタ付き指数バックオフで再試行する。
+#             認証エラー・その他の 4xx は再試行せずに即座に失敗とする
+#             deadline を渡すと、その時刻を過ぎる待ち（補充・リセット待ち、再試行前の待ち）はせずに DeadlineExceeded とする
+#
+# 使い方:
+#   client = Client(BS_BASE_URL, request=bs_ratelimit.new_request(acct))
+#   bs_ratelimit.call(lambda: client.send_post(text), retries=3)
+import random
+import threading
+import time
+
+# atproto は読込みに時間がかかるため new_request() / retry_delay() の中で import する
+# （jma.py が更新なしで終了する実行では読み込まない）
+
+ACCOUNT_RATE = 0.4	# アカウント毎の補充速度(要求/秒)。書き込み 5000pt/時(投稿 3pt)を下回るようにする
+ACCOUNT_BURST = 20	# アカウント毎のバケット容量（連続して送れる要求数）
+HOST_RATE = 10.0	# PDS ホスト毎の補充速度(要求/秒)。IP 毎 3000件/5分 に合わせる
+HOST_BURST = 50	# PDS ホスト毎のバケット容量
+BACKOFF_BASE = 1.0	# 5xx・通信エラー時の初回待ち時間の上限(秒)。試行毎に倍にする
+BACKOFF_MAX = 60.0	# 同 上限(秒)
+MAX_WAIT = 900	# これより長いリセット待ちは待たずに失敗とする(秒)（1日あたりの上限超過など）
+
+lock = threading.Lock()
+buckets = {}	# ('acct', acct) / ('host', host) => [残りトークン, 最終補充時刻, 停止解除時刻]（時刻は time.monotonic()）
+on_wait = None	# 待ちが発生した時に呼ぶ関数 on_wait(key, seconds)（jma.py のメトリクス用）
+local = threading.local()	# local.deadline: 実行中の call() の期限（time.monotonic()）。スレッド毎
+
+
+class RateLimitWait(Exception):
+    """リセットまでの待ち時間が MAX_WAIT を超えるため送信を諦めた。"""
+
+
+class DeadlineExceeded(RateLimitWait):
+    """待つと call() の期限を過ぎるため送信を諦めた（期限を延ばせば送れる）。"""
+
+
+def bucket_params(key):
+    return (ACCOUNT_RATE, ACCOUNT_BURST) if key[0] == 'acct' else (HOST_RATE, HOST_BURST)
+
+
+# def refill(key, now)
+# key のバケットを now までの経過時間分だけ補充して返す（lock を取得して呼ぶこと）
+def refill(key, now):
+    rate, burst = bucket_params(key)
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = [float(burst), now, 0.0]
+    bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    return bucket
+
+
+# def acquire(*keys, deadline=None)
+# 全ての keys のバケットからトークンを1つずつ取り出す。足りなければ補充・停止解除まで待つ
+# deadline: 待つとこの時刻を過ぎる時は DeadlineExceeded。None なら実行中の call() の期限に従う
+def acquire(*keys, deadline=None):
+    if deadline is None:
+        deadline = getattr(local, 'deadline', None)
+    while True:
+        with lock:
+            now = time.monotonic()
+            wait, wait_key = 0.0, None
+            for key in keys:
+                tokens, _, blocked_until = refill(key, now)
+                key_wait = max(blocked_until - now, (1 - tokens) / bucket_params(key)[0])
+                if key_wait > wait:
+                    wait, wait_key = key_wait, key
+            if wait <= 0:
+                for key in keys:
+                    buckets[key][0] -= 1
+                return
+        if wait > MAX_WAIT:
+            raise RateLimitWait(f"rate limited on {wait_key[0]} {wait_key[1]} for {wait:.0f}s")
+        if deadline is not None and now + wait > deadline:
+            raise DeadlineExceeded(f"rate limited on {wait_key[0]} {wait_key[1]} for {wait:.0f}s past the deadline")
+        if on_wait is not None:
+            on_wait(wait_key, wait)
+        time.sleep(wait)
+
+
+# def note_response(key, status, headers)
+# 応答の ratelimit-* ヘッダをバケットに反映する
+def note_response(key, status, headers):
+    remaining = headers.get('ratelimit-remaining')
+    reset = headers.get('ratelimit-reset')
+    retry_after = headers.get('retry-after')
+    if remaining is None and status != 429:
+        return
+    try:
+        remaining = int(remaining) if remaining is not None else 0
+        if reset is not None:
+            delay = int(reset) - time.time() + 1	# 秒単位に丸められているため1秒の余裕をみる
+        elif retry_after is not None:
+            delay = float(retry_after)
+        else:
+            delay = 0.0
+    except ValueError:
+        return
+
+    # 残数は要求の種類（ログイン・書き込み等）毎の枠を表すため、尽きた時だけリセットまで止める
+    if remaining > 0 and status != 429:
+        return
+    with lock:
+        now = time.monotonic()
+        bucket = refill(key, now)
+        bucket[2] = max(bucket[2], now + max(delay, 0.0))
+
+
+# def new_request(acct)
+# acct 用の atproto Request を返す。送信前に acquire()、受信時に note_response() を呼ぶ
+# （ログイン・トークン更新・ハンドル解決を含む全ての XRPC 要求が対象）
+def new_request(acct):
+    from atproto import Request
+
+    def on_request(request):
+        acquire(('acct', acct), ('host', request.url.host))
+
+    def on_response(response):
+        note_response(('acct', acct), response.status_code, response.headers)
+
+    return Request(event_hooks={'request': [on_request], 'response': [on_response]})
+
+
+# def retry_delay(e, attempt)
+# return: 例外 e の後に再試行するまでの秒数。再試行しない例外は None
+def retry_delay(e, attempt):
+    from atproto.exceptions import (BadRequestError, LoginRequiredError, NetworkError, RateLimitExceededError,
+                                    RequestException, UnauthorizedError)
+    if isinstance(e, RateLimitExceededError):
+        # リセット時刻が分かれば note_response() で設定済みで、次の acquire() がそこまで待つ。
+        # ヘッダの無い 429 でもすぐには再試行しないよう、指数バックオフの時間は必ず待つ
+        return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    if isinstance(e, (UnauthorizedError, LoginRequiredError, BadRequestError, RateLimitWait)):
+        return None
+    if isinstance(e, NetworkError) or (isinstance(e, RequestException) and
+                                       (e.response is None or e.response.status_code >= 500)):
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))	# full jitter
+    return None
+
+
+# def call(func, retries=3, on_retry=None, deadline=None)
+# func() を最大 retries 回試行して結果を返す。再試行できない例外・最後の試行の例外はそのまま送出する
+# on_retry(e, delay): 再試行の前に呼ぶ（ログ出力用）
+# deadline: time.monotonic() の期限。func() の中の acquire() も含め、これを過ぎる待ちは DeadlineExceeded とする。
+#           None なら外側の call() の期限を引き継ぐ
+def call(func, retries=3, on_retry=None, deadline=None):
+    outer = getattr(local, 'deadline', None)
+    if deadline is None:
+        deadline = outer
+    elif outer is not None:
+        deadline = min(deadline, outer)
+    local.deadline = deadline
+    try:
+        for attempt in range(retries):
+            try:
+                return func()
+            except Exception as e:
+                delay = retry_delay(e, attempt)
+                if delay is None or attempt == retries - 1:
+                    raise
+                if deadline is not None and time.monotonic() + delay > deadline:
+                    raise DeadlineExceeded(f"retry in {delay:.1f}s would pass the deadline: {e}") from e
+                if on_retry is not None:
+                    on_retry(e, delay)
+                time.sleep(delay)
+    finally:
+        local.deadline = outer
@@ -0,0 +1,94 @@
+# Bluesky セッション文字列の保存・復元。jma.py / update_profile.py で共用する。
+#
+#   - SESSION_DIR/<account> に所有者のみ読み書き可(0600)で保存し、rename で差し替える
+#   - 接続先 PDS (BS_BASE_URL) と別の PDS で作ったセッションは読み込まない
+#   - new_client(): 新規ログイン・トークン更新の度にセッションを保存し直す Client を返す
+#
+# 使い方:
+#   client = bs_session.new_client(acct)
+#   session_str = bs_session.read_session(acct)
+#   client.login(session_string=session_str) if session_str else client.login(username, password)
+import os
+import sys
+
+import bs_ratelimit
+
+# atproto は読込みに時間がかかるため new_client() / session_matches_pds() の中で import する
+
+SESSION_DIR = 'last/session/'	# post.csv のあるディレクトリ(jma.py の BASE_DIR)からの相対パス。jma.py は LAST_DIR 配下に設定する
+BS_BASE_URL = os.environ.get('BS_BASE_URL')	# 接続先 PDS（None: bsky.social）
+on_error = None	# ファイルの読み書きに失敗した時に呼ぶ関数 on_error(message)（None なら標準エラー出力に警告を出す）
+
+
+def warn(message):
+    if on_error is not None:
+        on_error(message)
+    else:
+        print(f"Warning: {message}", file=sys.stderr)
+
+
+# def read_session(acct)
+# return: 保存済みのセッション文字列（無い・別の PDS のものなら None）
+def read_session(acct):
+    try:
+        with open(f"{SESSION_DIR}{acct}", 'r') as f:
+            session_str = f.read().strip()
+    except FileNotFoundError:
+        return None
+    except IOError as e:
+        warn(f"Can't read session file {SESSION_DIR}{acct}: {e}")
+        return None
+    if not session_str or not session_matches_pds(session_str):
+        return None
+    return session_str
+
+
+# def write_session(acct, session_str)
+# パスワード同等の秘密情報のため所有者のみ読み書き可(0600)で書き込み、rename で差し替える
+def write_session(acct, session_str):
+    path = f"{SESSION_DIR}{acct}"
+    tmp = f"{path}.{os.getpid()}"
+    try:
+        os.makedirs(SESSION_DIR, mode=0o700, exist_ok=True)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(session_str + '\n')
+        os.replace(tmp, path)
+    except OSError as e:
+        warn(f"Can't write session file {path}: {e}")
+
+
+def remove_session(acct):
+    try:
+        os.unlink(f"{SESSION_DIR}{acct}")
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        warn(f"Can't remove session file {SESSION_DIR}{acct}: {e}")
+
+
+def session_matches_pds(session_str):
+    """接続先 PDS を切り替えた場合、別の PDS で作ったセッションは使わない。"""
+    if not BS_BASE_URL:
+        return True
+    from atproto import Session
+    try:
+        return Session.decode(session_str).pds_endpoint.startswith(BS_BASE_URL.rstrip('/'))
+    except Exception:
+        return False
+
+
+# def new_client(acct)
+# acct 用の Client を返す（ログインはしない）。要求は全て bs_ratelimit のアカウント毎・PDS ホスト毎のバケットを通し、
+# 新規ログイン(CREATE)・アクセストークンの自動更新(REFRESH)の時にセッションを保存する
+def new_client(acct):
+    from atproto import Client, SessionEvent
+
+    client = Client(BS_BASE_URL, request=bs_ratelimit.new_request(acct))
+
+    def on_session_change(event, session):
+        if event in (SessionEvent.CREATE, SessionEvent.REFRESH):
+            write_session(acct, session.export())
+
+    client.on_session_change(on_session_change)
+    return client
@@ -3,21 +3,62 @@ import requests
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 import email.utils
+import io
+import json
 import os
-import feedparser
 import syslog
 import time
+import unicodedata
 import csv
 import xml.etree.ElementTree as ET
+import queue
 import re
-import multiprocessing
-from atproto import Client, client_utils, models
+import sqlite3
+import zipfile
+import argparse
+import calendar
+import contextlib
+import fcntl
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+# atproto・feedparser・http.server は読込みに時間がかかるため、使う関数の中で import する
+# （更新なし・outbox が空の実行では読み込まない）
+import bs_handles
+import bs_ratelimit
+import bs_session
 
 DEBUG = 0
-DELAY_START = 20	# 処理開始を20秒待つ
+DELAY_START = 20	# 処理開始を20秒待つ（フィードの更新時刻を学習するまでの既定値）
 LOCK_TIMEOUT = 540	# ロックのタイムアウト
+CRON_INTERVAL = 60	# cron の起動間隔(秒)。次の確認がこれより先なら今回はフィードを確認しない
+POLL_MIN = 5	# フィード確認間隔の下限(秒)。直近 POLL_ACTIVE_WINDOW 秒以内に更新があり、更新時刻が未学習ならこの間隔で確認する
+POLL_MAX = 120	# 同 上限(秒)。更新が無い間は最後の更新からの経過時間の POLL_BACKOFF 倍まで間隔を延ばす
+POLL_WARNING_MAX = 30	# 警報以上が発表中のエリアがある間の確認間隔の上限(秒)
+POLL_ACTIVE_WINDOW = 600	# 最後の更新からこの時間(秒)以内は更新が続いているとみなす
+POLL_BACKOFF = 0.1
+POLL_PERIOD = 60	# フィードの更新周期(秒)。更新は毎分ほぼ同じ秒に行われる
+POLL_LAG = 3	# 更新が予想される時刻から確認するまでの余裕(秒)
+POLL_PHASE_SPREAD = 2	# 更新時刻（毎分の何秒か）の推定で同じとみなす幅(±秒)
+POLL_SAMPLES = 10	# 更新時刻の推定に必要な Last-Modified の記録数
+POLL_HISTORY = 24 * 3600	# Last-Modified の記録を残す期間(秒)
 URL_JMA_PULL = 'https://www.data.jma.go.jp/developer/xml/feed/extra.xml'
+URL_JMA_LONG = 'https://www.data.jma.go.jp/developer/xml/feed/extra_l.xml'	# 長期フィード（過去数日分）。追いつき処理で使う
+FEED_WINDOW = 600	# extra.xml に電文が掲載される期間の目安(秒)。これより長くフィードを確認できなかったら長期フィードで追いつく
+CATCHUP_BATCH = 100	# 追いつき処理で1度に取得・解析する電文数（同じ時刻の電文は分けない）
+CATCHUP_POST_AGE = 3600	# 追いつき処理で report_time がこれより古い変化は状態だけを更新し、投稿しない(秒)。0 で全く投稿しない
 XML_BASE = '{http://xml.kishou.go.jp/jmaxml1/}'
+XML_HEAD = '{http://xml.kishou.go.jp/jmaxml1/informationBasis1/}'    # Head 部の名前空間
+XML_BODY = '{http://xml.kishou.go.jp/jmaxml1/body/meteorology1/}'   # Body 部（気象）の名前空間
+TAG_REPORT_DATETIME = XML_HEAD + 'ReportDateTime'
+TAG_WARNING         = XML_BODY + 'Warning'
+TAG_ITEM            = XML_BODY + 'Item'
+TAG_AREA_CODE       = f'{XML_BODY}Area/{XML_BODY}Code'
+TAG_KIND            = XML_BODY + 'Kind'
+TAG_KIND_CODE       = XML_BODY + 'Code'
+TAG_KIND_STATUS     = XML_BODY + 'Status'
+TAG_KIND_CONDITION  = XML_BODY + 'Condition'
+REPORT_DATETIME_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})\+09:00$')
 ITEM_TITLE = '気象特別警報・警報・注意報'            # VPWW53 旧形式（移行期間中〜2028年頃）
 ITEM_TITLE_R06 = '気象警報・注意報（Ｒ０６）'          # VPWW55-61 新形式プレフィックス（確認済）
                                                         # 実タイトル例: '気象警報・注意報（Ｒ０６）（大雨）'
@@ -46,51 +87,392 @@ VPWW_RESPONSIBLE = {
     'VPWW61': {'wa': {'14', '17', '18', '20', '21', '22', '23', '24', '25', '26', '27'},
                'ww': set(), 'wuw': set(), 'wew': set()},
 }
+STATE_KINDS = ['wa', 'ww', 'wuw', 'wew']
+CLEARED_RE = re.compile(r'(解除|に切り替え|なし|へ変化)')	# 状態に残さないステータス
 NO_CHANGESTATUS = '変化無'
 FORM_URL_JMA_WARNING = 'https://www.jma.go.jp/bosai/warning/#area_type=class20s&area_code={}&lang={}'
 BASE_DIR = '/usr/local/emerry/jma/'
 LAST_DIR = BASE_DIR + 'last/'
 LOCK_FILE = LAST_DIR + "lock"
+DAEMON_LOCK_FILE = LAST_DIR + "daemon.lock"
 AREA_CSV = BASE_DIR + 'area.csv'
 POST_CSV = BASE_DIR + 'post.csv'
-LAST_MODIFIED = LAST_DIR + "last_modified"
-POST_RETRY = 3
-POST_INTERVAL = 10
+FEED_STATE = LAST_DIR + "feed_state"	# フィードの Last-Modified / ETag（条件付き GET 用）
+LAST_MODIFIED = LAST_DIR + "last_modified"	# 旧形式（FEED_STATE への移行元）
+STATE_DB = LAST_DIR + "state.db"	# エリア毎の発表状態（旧: エリアコード名の個別ファイル）
+CORPUS_FILE = None	# --record 指定時の記録先（フィード・電文を zip に追記）
+LEDGER_FILE = LAST_DIR + "ledger"	# 処理済み電文（エントリID・リンク）の記録
+LEDGER_WINDOW = 3 * 3600	# 処理済み記録の保持期間(秒)。extra.xml の掲載期間より長くする
+BS_BASE_URL = os.environ.get('BS_BASE_URL')	# 投稿先 PDS（None: bsky.social）。試験時は bench/fake_pds.py を指定
+SESSION_DIR = LAST_DIR + 'session/'	# Bluesky セッション文字列の保存先（bs_session、update_profile.py と共用）
+HANDLE_CACHE = LAST_DIR + 'handles.db'	# ハンドル → DID のキャッシュ（bs_handles、post_message.py と共用）
+POST_MAX_GRAPHEMES = 300	# 投稿本文の上限（書記素クラスタ数。Bluesky の制限）
+POST_MAX_BYTES = 3000	# 同 UTF-8 のバイト数
+FACET_TYPE = 'app.bsky.richtext.facet'	# facet の $type（リンク・タグ・位置は '#link' などを付ける）
+POST_TRIM_MARK = '…\n'	# 上限を超えてステータスの行を削った時に残した行の後に置く
+POST_RETRY = 3	# 投稿の試行回数（再試行の間隔は bs_ratelimit が 429・5xx に応じて決める）
+OUTBOX_EXPIRE = 6 * 3600	# report_time からこれ以上経った未送信の投稿は送らずに破棄する(秒)
+OUTBOX_KEEP = 24 * 3600	# 送信済み・破棄した投稿の記録を残す期間(秒)。同じ投稿の重複登録を防ぐ
+OUTBOX_RETRY_BASE = 60	# 送信に失敗した投稿を次に試すまでの時間(秒)。失敗毎に倍にする
+OUTBOX_RETRY_MAX = 1800	# 同 上限(秒)
+OUTBOX_DRAIN_TIME = 30	# 1回の送信処理(drain)の期限(秒)。流量制限・再試行の待ちもこれを超えない。残りは次回に回す
+BREAKER_THRESHOLD = 5	# 連続してこの件数の送信に失敗したら送信を止める（サーキットブレーカー）
+BREAKER_COOLDOWN = 300	# 送信を止める時間(秒)。経過後に1件だけ試し、成功すれば再開する
+FETCH_WORKERS = 8	# XML 取得の同時接続数上限
+PIPELINE_QUEUE = 16	# 取得→解析、解析→集約の各キューに溜める電文数の上限（超えると前段が待つ）
+PARSE_PROCESSES = os.cpu_count() or 1	# 電文の多い時に XML を解析するプロセス数（1 で解析プロセスを使わない）
+PARSE_PROCESS_THRESHOLD = 64	# 1回の電文数がこれ以上の時だけ解析プロセスを使う（起動の時間に見合う件数）
+HTTP_TIMEOUT = 10	# JMA への HTTP リクエスト毎のタイムアウト(秒)
+POST_WORKERS = 8	# 投稿ワーカー数（アカウント間を並列化、1 で従来どおり逐次投稿）
+SHARD_COUNT = 1	# シャード数（--shard I/N の N）。1 は従来どおり1プロセスで全都道府県を処理する
+SHARD_INDEX = 0	# この実行が受け持つシャード（--shard I/N の I）
+SHARD_DIR = LAST_DIR	# シャード間で共有するディレクトリ（フィードの共有ファイルとシャード毎の状態）。複数ホストでは NFS 等の共有領域
+METRICS_FILE = None	# --metrics-file 指定時の出力先（node_exporter textfile collector 用。拡張子 .prom）
+METRICS_PORT = 0	# 常駐モードで --metrics-port 指定時に /metrics を公開するポート（0: 公開しない）
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)	# 段階別所要時間のヒストグラム境界(秒)
 # global variables
 pref = {}  # pref_name => hash (key=area_code)
 area = {}  # area_code => [acct_wa, acct_ww, acct_wuw, acct_wew]
 acct_area = {}  # acct => {'lang': 'ja'/'en', 'code': area_code, 'name': pref_name, 'grade': '注意報(Level 2)'/..., 'tag': hash_tag}
+pref_matcher = None	# pref の都道府県名を照合する正規表現（build_pref_matcher() で生成）
+pref_order = {}	# pref_name => area.csv での出現順
 post_acct = {}	# acct => { 'bs_username': bs_username, 'bs_passwd': bs_passwd }
+http_session = None	# JMA 向け keep-alive セッション（get_http_session() で生成）
+state_db = None	# STATE_DB の sqlite3 接続（open_state() で生成）
+state_cache = {}	# area_code(int) => ref_last（STATE_DB の内容をメモリに保持）
+state_loaded = False	# state_cache に全エリアの状態を読み込んだか（load_state_cache() で読み込む）
+config_loaded = False	# area.csv / post.csv 読込み済みか
+acct_template = {}	# acct => 投稿の定型部分（compile_template() で作成。read_config() で作り直す）
+bs_client = {}	# acct => ログイン済み atproto Client（1実行につきアカウント毎に1回だけ生成）
+shard_prefs = None	# この実行が受け持つ都道府県名の集合（None: 全て。assign_shard() で決める）
+lock_fd = None	# シャード実行時に LOCK_FILE を fcntl.lockf でロックしているファイル
+catchup_requested = False	# --catch-up 指定時、次の実行で間隔に関係なく追いつき処理を行う
+breaker_lock = threading.Lock()
+breaker = {'failures': 0, 'until': 0, 'probing': False}	# 連続失敗数, 送信停止の期限(UNIX時刻), 再開を試行中か
+metrics_lock = threading.Lock()	# 以下のメトリクスは XML 取得・投稿ワーカーからも更新する
+metric_counter = {}	# (name, labels) => 値   labels は (('key', 'value'), ...)
+metric_gauge = {}	# name => 値
+metric_hist = {}	# stage => [METRICS_BUCKETS 毎の累積件数..., 合計秒, 件数]
+
+# 段階別所要時間（timed() の stage 名）と各メトリクスの説明
+METRIC_HELP = {
+    'jma_stage_duration_seconds': 'Time spent in each processing stage.',
+    'jma_runs_total': 'Number of poll cycles.',
+    'jma_run_errors_total': 'Poll cycles aborted by an unexpected error (daemon mode).',
+    'jma_feed_requests_total': 'Feed requests by result.',
+    'jma_feed_shared_total': 'Feed checks answered from the copy another shard fetched.',
+    'jma_bytes_total': 'Bytes downloaded from JMA by source.',
+    'jma_xml_fetch_total': 'Telegram downloads by result.',
+    'jma_telegrams_skipped_total': 'Telegrams skipped because they were already processed.',
+    'jma_state_writes_total': 'Area state rows written.',
+    'jma_logins_total': 'Bluesky logins by method and result.',
+    'jma_posts_total': 'Bluesky posts by result (after retries; deferred = left pending at the drain deadline).',
+    'jma_outbox_expired_total': 'Queued posts dropped because they were older than OUTBOX_EXPIRE.',
+    'jma_outbox_pending': 'Posts waiting in the outbox after the last drain.',
+    'jma_breaker_open': '1 while posting is suspended by the circuit breaker.',
+    'jma_post_retries_total': 'Bluesky post attempts beyond the first, by reason.',
+    'jma_last_run_timestamp_seconds': 'Start time of the last poll cycle.',
+    'jma_last_run_duration_seconds': 'Duration of the last poll cycle.',
+    'jma_first_queue_seconds': 'Seconds from the start of telegram fetching to the first queued post in the last update.',
+    'jma_catchup_runs_total': 'Catch-up runs over the long feed.',
+    'jma_posts_trimmed_total': 'Posts whose status lines were trimmed to fit the length limit.',
+    'jma_posts_suppressed_total': 'State changes not posted because they were too old when caught up.',
+    'jma_next_poll_timestamp_seconds': 'Time of the next feed check chosen by the poll scheduler.',
+}
+
+# def count(name, value=1, **labels)
+# カウンタ name{labels} に value を加える
+def count(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metric_counter[key] = metric_counter.get(key, 0) + value
+
+def set_gauge(name, value):
+    with metrics_lock:
+        metric_gauge[name] = value
+
+# def observe(stage, seconds)
+# 段階 stage の所要時間をヒストグラムに加える
+def observe(stage, seconds):
+    with metrics_lock:
+        hist = metric_hist.get(stage)
+        if hist is None:
+            hist = metric_hist[stage] = [0] * (len(METRICS_BUCKETS) + 2)
+        for i, le in enumerate(METRICS_BUCKETS):
+            if seconds <= le:
+                hist[i] += 1
+        hist[-2] += seconds
+        hist[-1] += 1
+
+# with timed(stage): ...
+# ブロックの所要時間を段階 stage として記録する（例外で抜けた場合も記録）
+@contextlib.contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def format_labels(labels):
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if labels else ''
+
+# def render_metrics()
+# return: Prometheus テキスト形式のメトリクス
+def render_metrics():
+    lines = []
+    with metrics_lock:
+        name = 'jma_stage_duration_seconds'
+        if metric_hist:
+            lines += [f"# HELP {name} {METRIC_HELP[name]}", f"# TYPE {name} histogram"]
+        for stage in sorted(metric_hist):
+            hist = metric_hist[stage]
+            for le, n in zip(METRICS_BUCKETS, hist):
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {n}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {hist[-1]}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {hist[-2]:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {hist[-1]}')
+
+        by_name = {}
+        for (name, labels), value in metric_counter.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for name in sorted(by_name):
+            lines += [f"# HELP {name} {METRIC_HELP.get(name, name)}", f"# TYPE {name} counter"]
+            lines += [f"{name}{format_labels(labels)} {value}" for labels, value in sorted(by_name[name])]
+
+        for name in sorted(metric_gauge):
+            lines += [f"# HELP {name} {METRIC_HELP.get(name, name)}", f"# TYPE {name} gauge",
+                      f"{name} {metric_gauge[name]:.3f}"]
+    return '\n'.join(lines) + '\n'
+
+# bs_ratelimit の流量制御による待ち時間も段階 rate_limit_wait として記録する
+bs_ratelimit.on_wait = lambda key, seconds: observe('rate_limit_wait', seconds)
+bs_session.on_error = lambda message: syslog.syslog(syslog.LOG_WARNING, message)
+
+# def write_metrics()
+# METRICS_FILE へ書き出す。node_exporter が書きかけを読まないよう一時ファイルから rename で差し替える
+def write_metrics():
+    if not METRICS_FILE:
+        return
+    tmp = f"{METRICS_FILE}.{os.getpid()}"
+    try:
+        with open(tmp, 'w') as f:
+            f.write(render_metrics())
+        os.replace(tmp, METRICS_FILE)
+    except OSError as e:
+        syslog.syslog(syslog.LOG_ERR, f"Can't write metrics file {METRICS_FILE}: {e}")
+
+# def start_metrics_server(port)
+# 常駐モード用: GET /metrics に render_metrics() を返す HTTP サーバを別スレッドで起動する
+def start_metrics_server(port):
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            data = render_metrics().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
 
-def check_last_modified():
+    try:
+        server = http.server.ThreadingHTTPServer(('', port), MetricsHandler)
+    except OSError as e:
+        syslog.syslog(syslog.LOG_ERR, f"Can't listen for metrics on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    syslog.syslog(syslog.LOG_INFO, f"Serving metrics on port {port}")
+    return server
+
+# def get_http_session()
+# JMA 向けの共有 requests.Session を返す（TLS 接続を使い回し、FETCH_WORKERS 本まで同時接続）
+def get_http_session():
+    global http_session
+    if http_session is None:
+        http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(FETCH_WORKERS, 1))
+        http_session.mount('https://', adapter)
+        http_session.mount('http://', adapter)
+    return http_session
+
+# def read_feed_state()
+# return: (last_modified, etag)
+#   last_modified … 前回取得したフィードの Last-Modified（UNIX時刻、不明時は 0）
+#   etag          … 前回取得したフィードの ETag（不明時は ''）
+# 旧形式の last_modified ファイル（UNIX時刻のみ）からも読み込む
+def read_feed_state():
     last_modified = 0
+    etag = ''
 
     try:
-        with open(LAST_MODIFIED, "r") as file:
-            last_modified = int(file.read())
-            syslog.syslog(syslog.LOG_INFO, f"last last_modified={last_modified}")
+        with open(FEED_STATE, "r") as file:
+            lines = file.read().split('\n')
+        last_modified = int(lines[0]) if lines[0].strip() else 0
+        etag = lines[1].strip() if len(lines) > 1 else ''
+    except FileNotFoundError:
+        try:
+            with open(LAST_MODIFIED, "r") as file:
+                last_modified = int(file.read())
+        except (FileNotFoundError, IOError, ValueError) as e:
+            syslog.syslog(syslog.LOG_WARNING, f"File '{FEED_STATE}': {e}")
+    except (IOError, ValueError) as e:
+        syslog.syslog(syslog.LOG_WARNING, f"File '{FEED_STATE}': {e}")
+
+    syslog.syslog(syslog.LOG_INFO, f"last last_modified={last_modified}, etag={etag}")
+    return last_modified, etag
+
+# def write_feed_state(last_modified, etag)
+# 2行形式: last_modified(UNIX時刻), etag
+def write_feed_state(last_modified, etag):
+    try:
+        with open(FEED_STATE, "w") as file:
+            file.write(f"{last_modified:d}\n{etag}\n")
     except (FileNotFoundError, IOError) as e:
-        syslog.syslog(syslog.LOG_WARNING, f"File '{LAST_MODIFIED}': {e}")
+        syslog.syslog(syslog.LOG_ERR, f": File '{FEED_STATE}': {e}")
+        return
+    # 旧形式の last_modified ファイルは不要になる
+    if os.path.exists(LAST_MODIFIED):
+        os.unlink(LAST_MODIFIED)
+
+# def request_feed(last_modified, etag)
+# If-Modified-Since / If-None-Match 付きの GET 1回でフィードを取得する。
+# return: (status_code, headers, content)。通信エラー時は None
+def request_feed(last_modified, etag):
+    headers = {}
+    if last_modified:
+        headers['If-Modified-Since'] = email.utils.formatdate(last_modified, usegmt=True)
+    if etag:
+        headers['If-None-Match'] = etag
 
-    response = requests.head(URL_JMA_PULL)
-    if 'Last-Modified' in response.headers:
-        cur_last_modified_str = response.headers['Last-Modified']
+    try:
+        with timed('feed_check'):
+            response = get_http_session().get(URL_JMA_PULL, headers=headers, timeout=HTTP_TIMEOUT)
+    except requests.RequestException as e:
+        syslog.syslog(syslog.LOG_ERR, f"Failed to fetch feed from {URL_JMA_PULL}: {e}")
+        count('jma_feed_requests_total', result='error')
+        return None
+    if response.status_code == 200:
+        count('jma_bytes_total', len(response.content), source='feed')
+    return response.status_code, response.headers, response.content
+
+# def read_shared_feed()
+# return: (取得時刻, last_modified, etag, content)。共有ファイルが無い・壊れている時は None
+# SHARD_DIR/feed.state は3行形式: 取得時刻(UNIX時刻), last_modified(UNIX時刻), etag。本文は SHARD_DIR/feed.xml
+def read_shared_feed():
+    try:
+        with open(SHARD_DIR + 'feed.state', 'r') as file:
+            lines = file.read().split('\n')
+        with open(SHARD_DIR + 'feed.xml', 'rb') as file:
+            content = file.read()
+        return float(lines[0]), int(lines[1]), lines[2].strip(), content
+    except (IOError, ValueError, IndexError):
+        return None
+
+# def write_shared_feed(fetched, last_modified, etag, content)
+# 本文 → 状態の順に一時ファイル経由で差し替える（content=None は本文をそのまま残す: 304 の時）
+def write_shared_feed(fetched, last_modified, etag, content):
+    try:
+        for name, data in (('feed.xml', content), ('feed.state', f"{fetched:.1f}\n{last_modified:d}\n{etag}\n".encode())):
+            if data is None:
+                continue
+            tmp = f"{SHARD_DIR}{name}.{os.getpid()}"
+            with open(tmp, 'wb') as file:
+                file.write(data)
+            os.replace(tmp, SHARD_DIR + name)
+    except IOError as e:
+        syslog.syslog(syslog.LOG_ERR, f": File '{SHARD_DIR}feed.xml': {e}")
+
+# def fetch_shared_feed(last_modified, etag)
+# シャード実行時のフィード取得。全シャードで1サイクル1回だけ JMA から取得し、SHARD_DIR の共有ファイルを使い回す。
+# SHARD_DIR/feed.lock を fcntl.lockf で排他し（共有ディレクトリ上なら他のホストとも排他）、共有ファイルが
+# feed_share_age() 秒より古ければ代表して条件付き GET で更新する。他のシャードはその間ロックを待ち、結果を読む。
+# last_modified, etag: このシャードが前回処理したフィードのもの（同じなら 304 として返す）
+# return: request_feed() と同じ (status_code, headers, content)。通信エラー時は None
+def fetch_shared_feed(last_modified, etag):
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    with open(SHARD_DIR + 'feed.lock', 'a') as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        shared = read_shared_feed()
+        now = time.time()
+        if shared is not None and now - shared[0] < feed_share_age(now):
+            count('jma_feed_shared_total')
+        else:
+            result = request_feed(*(shared[1:3] if shared is not None else (0, '')))
+            if result is None:
+                return None
+            status_code, headers, content = result
+            if status_code == 200:
+                shared_modified = 0
+                if 'Last-Modified' in headers:
+                    shared_modified = int(email.utils.parsedate_to_datetime(headers['Last-Modified']).timestamp())
+                shared = (time.time(), shared_modified, headers.get('ETag', ''), content)
+                write_shared_feed(*shared)
+            elif status_code == 304 and shared is not None:
+                shared = (time.time(), *shared[1:])
+                write_shared_feed(*shared[:3], None)
+            else:
+                return result
+    _, shared_modified, shared_etag, content = shared
+    if (shared_modified and shared_modified <= last_modified) or (shared_etag and shared_etag == etag):
+        return 304, {}, b''
+    headers = {'ETag': shared_etag}
+    if shared_modified:
+        headers['Last-Modified'] = email.utils.formatdate(shared_modified, usegmt=True)
+    return 200, headers, content
+
+# def fetch_feed()
+# フィードを取得する（シャード実行時は fetch_shared_feed() で他のシャードと1回の取得を共有する）
+# return: 更新があれば解析済みフィード、更新なし(304)・取得失敗時は None
+def fetch_feed():
+    last_modified, etag = read_feed_state()
+
+    result = fetch_shared_feed(last_modified, etag) if SHARD_COUNT > 1 else request_feed(last_modified, etag)
+    if result is None:
+        return None
+    status_code, headers, content = result
+
+    if status_code in (200, 304):
+        record_feed_check()
+    if status_code == 304:
+        syslog.syslog(syslog.LOG_INFO, "NO-UPDATE by Last-Modified.")
+        count('jma_feed_requests_total', result='not_modified')
+        return None
+    if status_code != 200:
+        syslog.syslog(syslog.LOG_ERR, f"Failed to fetch feed from {URL_JMA_PULL}. Status code: {status_code}")
+        count('jma_feed_requests_total', result='error')
+        return None
+
+    cur_last_modified = 0
+    if 'Last-Modified' in headers:
+        cur_last_modified_str = headers['Last-Modified']
         cur_last_modified = int(email.utils.parsedate_to_datetime(cur_last_modified_str).timestamp())
         syslog.syslog(syslog.LOG_INFO, f"current last_modified={cur_last_modified}")
     else:
         syslog.syslog(syslog.LOG_ERR, f"No Last-Modified field in header.")
 
-    if cur_last_modified <= last_modified:
+    # 条件付き GET に応じないサーバに備え、従来どおり Last-Modified でも判定する
+    if cur_last_modified and cur_last_modified <= last_modified:
         syslog.syslog(syslog.LOG_INFO, "NO-UPDATE by Last-Modified.")
-        return False
+        count('jma_feed_requests_total', result='not_modified')
+        return None
+    count('jma_feed_requests_total', result='updated')
 
-    try:
-        with open(LAST_MODIFIED, "w") as file:
-            file.write(str(cur_last_modified) + "\n")
-    except (FileNotFoundError, IOError) as e:
-        syslog.syslog(syslog.LOG_ERR, f": File '{LAST_MODIFIED}': {e}")
+    write_feed_state(cur_last_modified, headers.get('ETag', ''))
+    if cur_last_modified:
+        record_feed_update(cur_last_modified)
+    record_corpus({f"feed/{cur_last_modified or int(time.time())}.xml": content})
 
-    return True
+    # 取得済みの本文をそのまま解析する（再ダウンロードしない）
+    import feedparser
+    with timed('feed_parse'):
+        return feedparser.parse(content)
 
 def read_area():
     # read area.csv
@@ -135,6 +517,8 @@ def read_area():
         for a_code in area_codes:
             hash_t[a_code] = 1
         pref[p_name] = hash_t
+    build_pref_matcher()
+    assign_shard()
 
 
 def read_bs():
@@ -148,12 +532,39 @@ def read_bs():
     except (FileNotFoundError, IOError) as e:
         syslog.syslog(syslog.LOG_ERR, f": File {POST_CSV}: {e}")
 
+# def build_pref_matcher()
+# pref の都道府県名を1本の正規表現にまとめ、check() で説明文を1回走査するだけで済むようにする。
+# 名前同士が重なる場合（例: 東京都 / 京都）も拾えるよう先読みで全位置を照合する。
+def build_pref_matcher():
+    global pref_matcher
+    names = sorted(pref.keys(), key=len, reverse=True)
+    if not names:
+        pref_matcher = None
+        return
+    pref_matcher = re.compile('(?=(' + '|'.join(re.escape(n) for n in names) + '))')
+    pref_order.clear()
+    pref_order.update({p_name: i for i, p_name in enumerate(pref)})
+
+# def assign_shard()
+# --shard I/N: area.csv の都道府県を出現順に N 組へ順番に振り分け、I 組目をこの実行の受け持ちとする。
+# 照合(check())は全都道府県で行い、電文の振り分け先を決めてから受け持ち以外を除く。説明文に複数の都道府県名がある電文
+# （例: 東京都 は 京都 にも一致する）は、シャードに分けない時に選ぶ都道府県を受け持つ1つのシャードだけが取得する
+def assign_shard():
+    global shard_prefs
+    if SHARD_COUNT == 1:
+        shard_prefs = None
+        return
+    shard_prefs = {p_name for p_name, i in pref_order.items() if i % SHARD_COUNT == SHARD_INDEX}
+
 # def check(feed)
 #
 # return: ref to array of matched links
+#   link => pref[p_name]（説明文に複数の都道府県名がある場合は area.csv で後に出現した方）
 #
 def check(feed):
     links = {}
+    if pref_matcher is None:
+        return links
 
     for item in feed.entries:
         # USE_LEGACY_FEED=True : VPWW53/54 旧形式のみ処理
@@ -164,64 +575,187 @@ def check(feed):
         else:
             if not item.title.startswith(ITEM_TITLE_R06):
                 continue
-        for p_name, area_codes in pref.items():
-            for a_code in area_codes:
-                if p_name in item.description:
-#                if True:				# DEBUG
-                    links[item.link] = pref[p_name]
-                    break
+        matched = {m.group(1) for m in pref_matcher.finditer(item.description)}
+        if matched:
+            p_name = max(matched, key=pref_order.get)
+            if shard_prefs is None or p_name in shard_prefs:	# 他のシャードが受け持つ電文は取得しない
+                links[item.link] = pref[p_name]
     return links
 
-# def read_last(area_code)
-# return ref_last { wa => { code => 1,...}, ww => {...}, wuw => {...}, wew => {...}}
+# def read_ledger()
+# return: { entry_id_or_link => 処理時刻(UNIX時刻) }
+# 1行1件: "処理時刻 ID/リンク"
+def read_ledger():
+    ledger = {}
+    try:
+        with open(LEDGER_FILE, 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[0].isdigit():
+                    ledger[parts[1]] = int(parts[0])
+    except FileNotFoundError:
+        pass
+    except IOError as e:
+        syslog.syslog(syslog.LOG_WARNING, f"File '{LEDGER_FILE}': {e}")
+    return ledger
+
+# def write_ledger(ledger)
+# LEDGER_WINDOW より古い記録は破棄し、一時ファイル経由で差し替える
+def write_ledger(ledger):
+    limit = int(time.time()) - LEDGER_WINDOW
+    tmp = f"{LEDGER_FILE}.{os.getpid()}"
+    try:
+        with open(tmp, 'w') as f:
+            for key, t in ledger.items():
+                if t >= limit:
+                    f.write(f"{t:d} {key}\n")
+        os.replace(tmp, LEDGER_FILE)
+    except (FileNotFoundError, IOError) as e:
+        syslog.syslog(syslog.LOG_ERR, f": File '{LEDGER_FILE}': {e}")
+
+# def read_last_file(path)
+# 旧方式のエリア別状態ファイルを読む（state.db への移行用）
+# return ref_last { wa => { code => '',...}, ww => {...}, wuw => {...}, wew => {...}, time => report_time }
 # 新形式(5行): wa, ww, wuw, wew, time
 # 旧形式(4行): wa, ww, wew, time  ← 後方互換
-def read_last(area_code):
+def read_last_file(path):
     ref_last = {'wa': {}, 'ww': {}, 'wuw': {}, 'wew': {}}
 
-    try:
-        with open(f"{LAST_DIR}{area_code}", 'r') as f:
-            lines = f.readlines()
+    with open(path, 'r') as f:
+        lines = f.readlines()
 
-        if len(lines) >= 5:
-            # 新形式: wa, ww, wuw, wew, time
-            keys_order = ['wa', 'ww', 'wuw', 'wew']
-            time_idx = 4
-        else:
-            # 旧形式: wa, ww, wew, time（wuw は空のまま）
-            keys_order = ['wa', 'ww', 'wew']
-            time_idx = 3
+    if len(lines) >= 5:
+        # 新形式: wa, ww, wuw, wew, time
+        keys_order = ['wa', 'ww', 'wuw', 'wew']
+        time_idx = 4
+    else:
+        # 旧形式: wa, ww, wew, time（wuw は空のまま）
+        keys_order = ['wa', 'ww', 'wew']
+        time_idx = 3
 
-        for i, k in enumerate(keys_order):
-            line = lines[i].strip() if i < len(lines) else ''
-            if line:
-                ref_last[k] = {code: '' for code in line.split(',')}
+    for i, k in enumerate(keys_order):
+        line = lines[i].strip() if i < len(lines) else ''
+        if line:
+            ref_last[k] = {code: '' for code in line.split(',')}
 
+    try:
+        ref_last['time'] = int(lines[time_idx].strip()) if time_idx < len(lines) else 0
+    except (ValueError, IndexError):
+        ref_last['time'] = 0
+
+    return ref_last
+
+# def migrate_last_files(db, last_dir=None, codes=None)
+# last_dir(省略時は LAST_DIR) 直下のエリア別状態ファイル（ファイル名=エリアコード）を state.db へ取り込む（初回のみ）。
+# codes: 取り込むエリアコードの集合（シャードの受け持ち。None は全て）。旧ファイルは削除せずに残す。
+def migrate_last_files(db, last_dir=None, codes=None):
+    last_dir = last_dir or LAST_DIR
+    migrated = {}
+    for name in os.listdir(last_dir):
+        if not name.isdigit() or (codes is not None and int(name) not in codes):
+            continue
         try:
-            ref_last['time'] = int(lines[time_idx].strip()) if time_idx < len(lines) else 0
-        except (ValueError, IndexError):
-            ref_last['time'] = 0
-    except FileNotFoundError:
-        pass
+            ref_last = read_last_file(f"{last_dir}{name}")
+        except IOError as e:
+            syslog.syslog(syslog.LOG_WARNING, f"Can't migrate file {last_dir}{name}: {e}")
+            continue
+        # 読込み(int)と書込み(文字列)でファイル名が異なっていた '0' 始まりのコードは新しい方を採用
+        code = int(name)
+        if code in migrated and migrated[code]['time'] >= ref_last['time']:
+            continue
+        migrated[code] = ref_last
+    db.executemany('INSERT OR REPLACE INTO last VALUES (?, ?, ?, ?, ?, ?)',
+                   [(code, *(','.join(ref_last[k]) for k in STATE_KINDS), ref_last['time'])
+                    for code, ref_last in migrated.items()])
+    db.execute("INSERT OR REPLACE INTO meta VALUES ('migrated', ?)", (str(int(time.time())),))
+    syslog.syslog(syslog.LOG_INFO, f"Migrated {len(migrated)} state files from {last_dir} to {STATE_DB}")
+
+# def open_state()
+# state.db を開く（1実行につき1回。常駐モードでは開いたまま）。エリアの状態は load_state_cache() で読み込む
+def open_state():
+    global state_db
+    if state_db is not None:
+        return
+    state_db = load_state()
+
+# def load_state_cache()
+# 全エリアの状態を state_cache に読み込む。エリアの状態を比較する時だけ読み、確認を見送る実行・
+# フィードが更新されていない(304)実行では読まない
+def load_state_cache():
+    global state_loaded
+    open_state()
+    if state_loaded:
+        return
+    with timed('state_read'):
+        state_cache.clear()
+        for area_code, *codes, report_time in state_db.execute('SELECT area_code, wa, ww, wuw, wew, time FROM last'):
+            ref_last = {k: ({code: '' for code in line.split(',')} if line else {})
+                        for k, line in zip(STATE_KINDS, codes)}
+            ref_last['time'] = report_time
+            state_cache[area_code] = ref_last
+    state_loaded = True
+
+# def load_state()
+# return: state.db の接続（旧形式からの移行を済ませたもの）
+def load_state():
+    os.makedirs(LAST_DIR, mode=0o755, exist_ok=True)
+    db = sqlite3.connect(STATE_DB)
+    db.execute('CREATE TABLE IF NOT EXISTS last (area_code INTEGER PRIMARY KEY, '
+               'wa TEXT NOT NULL, ww TEXT NOT NULL, wuw TEXT NOT NULL, wew TEXT NOT NULL, time INTEGER NOT NULL)')
+    db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    db.execute('CREATE TABLE IF NOT EXISTS outbox (area_code INTEGER NOT NULL, acct TEXT NOT NULL, '
+               'report_time INTEGER NOT NULL, lang TEXT NOT NULL, text TEXT NOT NULL, facets TEXT NOT NULL, '
+               "state TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+               'next_try INTEGER NOT NULL DEFAULT 0, created INTEGER NOT NULL, '
+               'PRIMARY KEY (area_code, acct, report_time))')
+    db.execute('CREATE TABLE IF NOT EXISTS feed_updates (modified INTEGER PRIMARY KEY)')
+    if db.execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone() is None:
+        migrate_last_files(db)
+    db.commit()
+    return db
+
+def close_state():
+    global state_db, state_loaded
+    state_cache.clear()
+    state_loaded = False
+    if state_db is None:
+        return
+    state_db.commit()
+    state_db.close()
+    state_db = None
 
+# def read_last(area_code)
+# return ref_last { wa => { code => '',...}, ww => {...}, wuw => {...}, wew => {...}, time => report_time }
+# 状態が無いエリアは time を含まない
+def read_last(area_code):
+    load_state_cache()
+    cached = state_cache.get(int(area_code))
+    if cached is None:
+        return {'wa': {}, 'ww': {}, 'wuw': {}, 'wew': {}}
+    ref_last = {k: dict(cached[k]) for k in STATE_KINDS}
+    ref_last['time'] = cached['time']
     return ref_last
 
 # def write_last(area_code, ref_wa, ref_ww, ref_wuw, ref_wew, report_time)
-# 新形式(5行): wa, ww, wuw, wew, time
+# 発表中のコードのみ記録する。commit_last() までは確定しない
 def write_last(area_code, ref_wa, ref_ww, ref_wuw, ref_wew, report_time):
-    if not os.path.isdir(LAST_DIR):
-        os.mkdir(LAST_DIR, mode=0o755)
-
-    try:
-        with open(f"{LAST_DIR}{area_code}", 'w') as f:
-            for ref in [ref_wa, ref_ww, ref_wuw, ref_wew]:
-                codes = [code for code in ref if not re.search(r'(解除|に切り替え|なし|へ変化)', ref[code])]
-                f.write(','.join(codes) + '\n')
-            f.write(f"{report_time:d}" + '\n')
-    except IOError:
-        syslog.syslog(syslog.LOG_ERR, f"Can't open file {LAST_DIR}{area_code}")
-
-    return
+    load_state_cache()
+    ref_last = {}
+    for k, ref in zip(STATE_KINDS, [ref_wa, ref_ww, ref_wuw, ref_wew]):
+        ref_last[k] = {code: '' for code in ref if not CLEARED_RE.search(ref[code])}
+    ref_last['time'] = report_time
+
+    state_db.execute('INSERT OR REPLACE INTO last VALUES (?, ?, ?, ?, ?, ?)',
+                     (int(area_code), *(','.join(ref_last[k]) for k in STATE_KINDS), report_time))
+    state_cache[int(area_code)] = ref_last
+    count('jma_state_writes_total')
+
+# def commit_last()
+# エリア1件分の write_last() と enqueue_post() をまとめて1トランザクションで確定する
+def commit_last():
+    if state_db is not None:
+        with timed('state_write'):
+            state_db.commit()
 
 code_kind = {
     # 警報 (コード02-09)
@@ -469,23 +1003,37 @@ status_ja_en = {
     '特別警報へ変化': 'Change to Emergency Warning',
 }
 
-def find_element_by_tag(data, tag_list):
-    dat = data
-    for tag in tag_list:
-        for element in dat.iter():
-            if re.search(rf"[^A-Za-z\d]{tag}$", element.tag):
-                dat = element
-                break
-        if dat == None:
-            return None
-    return dat
+# ── 遷移規則の展開 ────────────────────────────────────────────────
+# 種別ごとの「隣接・2段階・3段階の昇格/降格」表を、コード単位の規則へ import 時に1回だけ展開する。
+# TRANSITIONS[kind][code] = (lost_rules, new_rules)
+#   lost_rules … 前回発表のコードが今回無い場合の遷移先 [(種別, コード, status), ...]（昇格→降格の順）
+#   new_rules  … 今回新たに発表されたコードの遷移元   [(種別, コード, rstatus), ...]（同上）
+KIND_CODE_RANGE = {'wa': (10, 29), 'ww': (2, 9), 'wuw': (40, 49), 'wew': (30, 39)}
+KIND_TRANSITIONS = {
+    #        [(遷移先種別, 対応表), ...] 昇格(1,2,3段階) → 降格(1,2,3段階)
+    'wa':  [('ww', wa_ww), ('wuw', wa_wuw), ('wew', wa_wew)],
+    'ww':  [('wuw', ww_wuw), ('wew', ww_wew), ('wa', ww_wa)],
+    'wuw': [('wew', wuw_wew), ('ww', wuw_ww), ('wa', wuw_wa)],
+    'wew': [('wuw', wew_wuw), ('ww', wew_ww), ('wa', wew_wa)],
+}
 
-def find_element_list_by_tag(data, tag):
-    element_list = []
-    for element in data.iter():
-        if re.search(rf"[^A-Za-z\d]{tag}$", element.tag):
-            element_list.append(element)
-    return element_list
+def compile_transitions():
+    transitions = {}
+    for kind_str, (code_min, code_max) in KIND_CODE_RANGE.items():
+        rules = {}
+        for c in range(code_min, code_max + 1):
+            code = f"{c:02d}"
+            lost_rules = []
+            new_rules = []
+            for to_kind, table in KIND_TRANSITIONS[kind_str]:
+                if code in table:
+                    lost_rules.append((to_kind, table[code], table['status']))
+                    new_rules.append((to_kind, table[code], table['rstatus']))
+            rules[code] = (tuple(lost_rules), tuple(new_rules))
+        transitions[kind_str] = rules
+    return transitions
+
+TRANSITIONS = compile_transitions()
 
 # 戻り
 #	公式な発表時刻,
@@ -503,195 +1051,301 @@ def extract_vpww_type(url):
     return m.group(1) if m else None
 
 
-def collect_xml(url, ref_area):
-    """XMLを解析し、{area_code_text: (report_time, current_state)} を返す。
-    report_time が前回処理済みのエリアは除外する（軽量スキップ）。
-    """
-    response = requests.get(url)
+# def record_corpus(files)
+# --record 指定時、取得したフィード・電文を CORPUS_FILE(zip) に追記する（bench/replay.py で再生する）
+# files: { zip 内の名前 => 本文(bytes) }  同名のものは記録済みとして追記しない
+def record_corpus(files):
+    if not CORPUS_FILE or not files:
+        return
+    try:
+        with zipfile.ZipFile(CORPUS_FILE, 'a', compression=zipfile.ZIP_DEFLATED) as zf:
+            names = set(zf.namelist())
+            for name, content in files.items():
+                if name not in names:
+                    zf.writestr(name, content)
+    except (OSError, zipfile.BadZipFile) as e:
+        syslog.syslog(syslog.LOG_ERR, f"Can't record to {CORPUS_FILE}: {e}")
+
+
+def fetch_xml(url):
+    """XMLを取得して本文(bytes)を返す。失敗時は None を返す。"""
+    try:
+        with timed('xml_fetch'):
+            response = get_http_session().get(url, timeout=HTTP_TIMEOUT)
+    except requests.RequestException as e:
+        syslog.syslog(syslog.LOG_ERR, f"Failed to fetch XML from {url}: {e}")
+        count('jma_xml_fetch_total', result='error')
+        return None
     if response.status_code != 200:
         syslog.syslog(syslog.LOG_ERR, f"Failed to fetch XML from {url}. Status code: {response.status_code}")
+        count('jma_xml_fetch_total', result='error')
+        return None
+    count('jma_xml_fetch_total', result='ok')
+    count('jma_bytes_total', len(response.content), source='xml')
+    return response.content
+
+
+def collect_xml(url, ref_area):
+    """XMLを取得・解析し、{area_code_text: (report_time, current_state)} を返す。"""
+    content = fetch_xml(url)
+    if content is None:
         return {}
+    return parse_xml(content, ref_area)
 
-    root = ET.fromstring(response.content)
-    report_datetime = find_element_by_tag(root, ['Report', 'Head', 'ReportDateTime'])
-    body            = find_element_by_tag(root, ['Report', 'Body'])
-    warning         = find_element_list_by_tag(body, 'Warning')
 
-    report_time = 0
-    match = re.match(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})\+09:00$', report_datetime.text)
-    if match:
-        year, month, day, hour, minute, second = map(int, match.groups())
-        report_time = int(datetime(year, month, day, hour, minute, second).timestamp())
+def parse_report_time(text):
+    """ReportDateTime（例 '2026-05-29T10:00:00+09:00'）を UNIX時刻に変換する。形式不正時は 0。"""
+    match = REPORT_DATETIME_RE.match(text or '')
+    if not match:
+        return 0
+    year, month, day, hour, minute, second = map(int, match.groups())
+    return int(datetime(year, month, day, hour, minute, second).timestamp())
+
 
+def kind_text(kind_elem, tag):
+    """Kind 直下の要素 tag のテキスト。要素が無い場合は Kind 自身のテキスト（従来の探索と同じ）。"""
+    elem = kind_elem.find(tag)
+    return (kind_elem if elem is None else elem).text
+
+
+def parse_xml(content, ref_area):
+    """XMLを解析し、{area_code_text: (report_time, current_state)} を返す。
+    report_time が前回処理済みのエリアは除外する（軽量スキップ）。"""
+    return drop_processed(parse_telegram(content, ref_area))
+
+
+def parse_telegram(content, ref_area):
+    """XMLを解析し、ref_area に含まれる全エリアの {area_code_text: (report_time, current_state)} を返す。
+    状態(state.db)を参照しないため、解析プロセス(PARSE_PROCESSES)からも呼ぶ。
+
+    jmaxml1 の固定パス（Head/ReportDateTime, Body/Warning/Item/{Kind,Area}）を iterparse で
+    順に読み、Item の終了時点で Area/Code が ref_area 外ならその Item を破棄する。
+    Warning@type は Item より後（Warning の終了時）に確定させるため、Item の結果は一旦保留する。
+    """
+    report_time = 0
     result = {}
     accepted_types = {WARNING_TYPE} if USE_LEGACY_FEED else {WARNING_TYPE, WARNING_TYPE_R06}
+    pending = []       # 処理中の Warning 内で ref_area に該当した Item: [(area_code_text, item_elem), ...]
+
+    for _, elem in ET.iterparse(io.BytesIO(content)):
+        tag = elem.tag
+        if tag == TAG_ITEM:
+            area_code_text = elem.findtext(TAG_AREA_CODE)
+            if area_code_text in ref_area:
+                pending.append((area_code_text, elem))
+            else:
+                elem.clear()
+        elif tag == TAG_WARNING:
+            if elem.get('type') in accepted_types:
+                for area_code_text, item_elem in pending:
+                    result[area_code_text] = (report_time, parse_item(item_elem))
+            pending = []
+            elem.clear()
+        elif tag == TAG_REPORT_DATETIME and not report_time:
+            report_time = parse_report_time(elem.text)
 
-    for warn_elem in warning:
-        if warn_elem.get('type') not in accepted_types:
-            continue
-        for item_elem in find_element_list_by_tag(warn_elem, 'Item'):
-            area_code_text = find_element_by_tag(item_elem, ['Area', 'Code']).text
-            if area_code_text not in ref_area:
-                continue
+    return result
 
-            # 古い report_time はスキップ（旧形式では同一タイムスタンプもスキップ）
-            ref_last_t = read_last(int(area_code_text))
-            if 'time' in ref_last_t:
-                if report_time < ref_last_t['time']:
-                    continue
-                if report_time == ref_last_t['time'] and USE_LEGACY_FEED:
-                    continue
 
-            current = {'wa': {}, 'ww': {}, 'wuw': {}, 'wew': {}}
-            for kind_elem in find_element_list_by_tag(item_elem, 'Kind'):
-                try:
-                    kind_elem_code   = int(find_element_by_tag(kind_elem, ['Code']).text)
-                    kind_elem_status = find_element_by_tag(kind_elem, ['Status']).text
-                    condition        = find_element_by_tag(kind_elem, ['Condition']).text.strip()
-                except:
-                    continue
-                if kind_elem_status == '解除':
-                    continue
-                code_str = f"{kind_elem_code:02d}"
-                if   10 <= kind_elem_code < 30: current['wa' ][code_str] = condition
-                elif  2 <= kind_elem_code < 10: current['ww' ][code_str] = condition
-                elif 40 <= kind_elem_code < 50: current['wuw'][code_str] = condition
-                elif 30 <= kind_elem_code < 40: current['wew'][code_str] = condition
+def parse_worker(content, ref_area):
+    """解析プロセスで parse_telegram() を実行し、(結果, 所要時間) を返す。"""
+    start = time.perf_counter()
+    return parse_telegram(content, ref_area), time.perf_counter() - start
 
-            result[area_code_text] = (report_time, current)
 
+def drop_processed(result):
+    """parse_telegram() の結果から、前回処理済みの report_time のエリアを除く。"""
+    for area_code_text, (report_time, _) in list(result.items()):
+        # 古い report_time はスキップ（旧形式では同一タイムスタンプもスキップ）
+        ref_last_t = read_last(int(area_code_text))
+        if 'time' in ref_last_t:
+            if report_time < ref_last_t['time'] or (report_time == ref_last_t['time'] and USE_LEGACY_FEED):
+                del result[area_code_text]
     return result
 
 
+def parse_item(item_elem):
+    """Item 要素から current_state を作る。"""
+    current = {'wa': {}, 'ww': {}, 'wuw': {}, 'wew': {}}
+    for kind_elem in item_elem.iterfind(TAG_KIND):
+        try:
+            kind_elem_code   = int(kind_elem.find(TAG_KIND_CODE).text)
+            kind_elem_status = kind_text(kind_elem, TAG_KIND_STATUS)
+            condition        = kind_text(kind_elem, TAG_KIND_CONDITION).strip()
+        except (AttributeError, TypeError, ValueError):
+            continue
+        if kind_elem_status == '解除':
+            continue
+        code_str = f"{kind_elem_code:02d}"
+        if   10 <= kind_elem_code < 30: current['wa' ][code_str] = condition
+        elif  2 <= kind_elem_code < 10: current['ww' ][code_str] = condition
+        elif 40 <= kind_elem_code < 50: current['wuw'][code_str] = condition
+        elif 30 <= kind_elem_code < 40: current['wew'][code_str] = condition
+    return current
+
+
 def compare_and_post(area_code_text, report_time, current, responsible, ref_last):
     """集約された current を ref_last と比較し、変化があれば last を更新して acct dict を返す。
 
     responsible: {wa, ww, wuw, wew} それぞれの担当コード set（新形式時）
                  None = 旧形式（全コードが担当対象）
+    遷移規則は TRANSITIONS（import 時に生成）を参照し、current / ref_last にあるコードのみ調べる。
     """
-    wa = {}; ww = {}; wuw = {}; wew = {}
-    ewa = {}; eww = {}; ewuw = {}; ewew = {}
-    f_wa = 0; f_ww = 0; f_wuw = 0; f_wew = 0
+    out   = {k: {} for k in STATE_KINDS}    # 種別 => { code => 'KindName,Status' }（日本語）
+    out_e = {k: {} for k in STATE_KINDS}    # 同（英語）
+    changed = set()                         # 変化のあった種別
 
     # 種別のループ（wa=注意報L2, ww=警報L3, wuw=危険警報L4, wew=特別警報L5）
-    for kind_str in ['wa', 'ww', 'wuw', 'wew']:
-        code_min       = {'wa': 10, 'ww':  2, 'wuw': 40, 'wew': 30}[kind_str]
-        code_max       = {'wa': 29, 'ww':  9, 'wuw': 49, 'wew': 39}[kind_str]
-        kind_down_str  = {'wa': None, 'ww': 'wa',  'wuw': 'ww',  'wew': 'wuw'}[kind_str]
-        kind_down2_str = {'wa': None, 'ww': None,  'wuw': 'wa',  'wew': 'ww' }[kind_str]
-        kind_down3_str = {'wa': None, 'ww': None,  'wuw': None,  'wew': 'wa' }[kind_str]
-        kind_up_str    = {'wa': 'ww', 'ww': 'wuw', 'wuw': 'wew', 'wew': None}[kind_str]
-        kind_up2_str   = {'wa': 'wuw','ww': 'wew', 'wuw': None,  'wew': None}[kind_str]
-        kind_up3_str   = {'wa': 'wew','ww': None,  'wuw': None,  'wew': None}[kind_str]
-        ref_to_down    = {'wa': {},    'ww': ww_wa,  'wuw': wuw_ww,  'wew': wew_wuw}[kind_str]
-        ref_to_down2   = {'wa': {},    'ww': {},     'wuw': wuw_wa,  'wew': wew_ww }[kind_str]
-        ref_to_down3   = {'wa': {},    'ww': {},     'wuw': {},      'wew': wew_wa }[kind_str]
-        ref_to_up      = {'wa': wa_ww, 'ww': ww_wuw, 'wuw': wuw_wew,'wew': {}     }[kind_str]
-        ref_to_up2     = {'wa': wa_wuw,'ww': ww_wew, 'wuw': {},     'wew': {}     }[kind_str]
-        ref_to_up3     = {'wa': wa_wew,'ww': {},     'wuw': {},     'wew': {}     }[kind_str]
-        ref_kind_out   = {'wa': wa,  'ww': ww,  'wuw': wuw, 'wew': wew }[kind_str]
-        ref_kind_out_e = {'wa': ewa, 'ww': eww, 'wuw': ewuw,'wew': ewew}[kind_str]
-
-        for c in range(code_min, code_max + 1):
-            code = f"{c:02d}"
-            if code in ref_last.get(kind_str, {}):
+    for kind_str in STATE_KINDS:
+        rules = TRANSITIONS[kind_str]
+        cur   = current[kind_str]
+        last  = ref_last.get(kind_str, {})
+        codes = [code for code in cur if code in rules]
+        codes.extend(code for code in last if code in rules and code not in cur)
+        codes.sort()    # 2桁コードなので数値順と同じ
+
+        for code in codes:
+            lost_rules, new_rules = rules[code]
+            if code in last:
                 # 前回このコードが発表されていた
-                if code in current[kind_str]:
+                if code in cur:
                     status = '継続'
                 else:
                     # 担当外コードは現状維持（別電文が管理）
                     # responsible=None の旧形式では全コードが担当対象
                     if responsible is not None and code not in responsible[kind_str]:
-                        ref_kind_out[code]   = f"{code_kind.get(code, code)},継続"
-                        ref_kind_out_e[code] = f"{code_kind_e.get(code, code)},{status_ja_en['継続']}"
+                        out[kind_str][code]   = f"{code_kind.get(code, code)},継続"
+                        out_e[kind_str][code] = f"{code_kind_e.get(code, code)},{status_ja_en['継続']}"
                         continue
                     # 遷移先を特定（昇格→降格の順で確認）
-                    key   = ref_to_up.get(code)    if ref_to_up   else None
-                    key2  = ref_to_up2.get(code)   if ref_to_up2  else None
-                    key3  = ref_to_up3.get(code)   if ref_to_up3  else None
-                    keyd  = ref_to_down.get(code)  if ref_to_down  else None
-                    keyd2 = ref_to_down2.get(code) if ref_to_down2 else None
-                    keyd3 = ref_to_down3.get(code) if ref_to_down3 else None
-                    if   kind_up_str   and current.get(kind_up_str)   and key   is not None and key   in current[kind_up_str]:
-                        status = ref_to_up['status']
-                    elif kind_up2_str  and current.get(kind_up2_str)  and key2  is not None and key2  in current[kind_up2_str]:
-                        status = ref_to_up2['status']
-                    elif kind_up3_str  and current.get(kind_up3_str)  and key3  is not None and key3  in current[kind_up3_str]:
-                        status = ref_to_up3['status']
-                    elif kind_down_str  and current.get(kind_down_str)  and keyd  is not None and keyd  in current[kind_down_str]:
-                        status = ref_to_down['status']
-                    elif kind_down2_str and current.get(kind_down2_str) and keyd2 is not None and keyd2 in current[kind_down2_str]:
-                        status = ref_to_down2['status']
-                    elif kind_down3_str and current.get(kind_down3_str) and keyd3 is not None and keyd3 in current[kind_down3_str]:
-                        status = ref_to_down3['status']
-                    else:
-                        status = '解除'
-                    if   kind_str == 'wa':  f_wa  = 1
-                    elif kind_str == 'ww':  f_ww  = 1
-                    elif kind_str == 'wuw': f_wuw = 1
-                    elif kind_str == 'wew': f_wew = 1
-                ref_kind_out[code]   = f"{code_kind[code]}{current[kind_str].get(code, '')},{status}"
-                ref_kind_out_e[code] = f"{code_kind_e[code]},{status_ja_en[status]}"
-            elif code in current[kind_str]:
+                    status = '解除'
+                    for to_kind, to_code, st in lost_rules:
+                        if to_code in current.get(to_kind, ()):
+                            status = st
+                            break
+                    changed.add(kind_str)
+                out[kind_str][code] = f"{code_kind[code]}{cur.get(code, '')},{status}"
+            else:
                 # 今回新たにこのコードが発表された → 遷移元を特定
-                key   = ref_to_up.get(code)    if ref_to_up   else None
-                key2  = ref_to_up2.get(code)   if ref_to_up2  else None
-                key3  = ref_to_up3.get(code)   if ref_to_up3  else None
-                keyd  = ref_to_down.get(code)  if ref_to_down  else None
-                keyd2 = ref_to_down2.get(code) if ref_to_down2 else None
-                keyd3 = ref_to_down3.get(code) if ref_to_down3 else None
-                if   kind_up_str   and ref_last.get(kind_up_str,   {}) and key   is not None and key   in ref_last[kind_up_str]:
-                    status = ref_to_up['rstatus']
-                elif kind_up2_str  and ref_last.get(kind_up2_str,  {}) and key2  is not None and key2  in ref_last[kind_up2_str]:
-                    status = ref_to_up2['rstatus']
-                elif kind_up3_str  and ref_last.get(kind_up3_str,  {}) and key3  is not None and key3  in ref_last[kind_up3_str]:
-                    status = ref_to_up3['rstatus']
-                elif kind_down_str  and ref_last.get(kind_down_str,  {}) and keyd  is not None and keyd  in ref_last[kind_down_str]:
-                    status = ref_to_down['rstatus']
-                elif kind_down2_str and ref_last.get(kind_down2_str, {}) and keyd2 is not None and keyd2 in ref_last[kind_down2_str]:
-                    status = ref_to_down2['rstatus']
-                elif kind_down3_str and ref_last.get(kind_down3_str, {}) and keyd3 is not None and keyd3 in ref_last[kind_down3_str]:
-                    status = ref_to_down3['rstatus']
-                else:
-                    status = '発表'
-                if   kind_str == 'wa':  f_wa  = 1
-                elif kind_str == 'ww':  f_ww  = 1
-                elif kind_str == 'wuw': f_wuw = 1
-                elif kind_str == 'wew': f_wew = 1
-                ref_kind_out[code]   = f"{code_kind[code]}{current[kind_str][code]},{status}"
-                ref_kind_out_e[code] = f"{code_kind_e[code]},{status_ja_en[status]}"
+                status = '発表'
+                for from_kind, from_code, st in new_rules:
+                    if from_code in ref_last.get(from_kind, ()):
+                        status = st
+                        break
+                changed.add(kind_str)
+                out[kind_str][code] = f"{code_kind[code]}{cur[code]},{status}"
+            out_e[kind_str][code] = f"{code_kind_e[code]},{status_ja_en[status]}"
 
     # area[area_code_text] = [ja_wa, ja_ww, ja_wuw, ja_wew, en_wa, en_ww, en_wuw, en_wew]
     acct = {}
-    if f_wa:
-        if wa  and area[area_code_text][0]: acct[area[area_code_text][0]] = wa
-        if ewa and area[area_code_text][4]: acct[area[area_code_text][4]] = ewa
-    if f_ww:
-        if ww  and area[area_code_text][1]: acct[area[area_code_text][1]] = ww
-        if eww and area[area_code_text][5]: acct[area[area_code_text][5]] = eww
-    if f_wuw:
-        if wuw and area[area_code_text][2]: acct[area[area_code_text][2]] = wuw
-        if ewuw and area[area_code_text][6]: acct[area[area_code_text][6]] = ewuw
-    if f_wew:
-        if wew and area[area_code_text][3]: acct[area[area_code_text][3]] = wew
-        if ewew and area[area_code_text][7]: acct[area[area_code_text][7]] = ewew
-    if f_wa or f_ww or f_wuw or f_wew:
-        write_last(area_code_text, wa, ww, wuw, wew, report_time)
+    for i, kind_str in enumerate(STATE_KINDS):
+        if kind_str not in changed:
+            continue
+        if out[kind_str]   and area[area_code_text][i]:     acct[area[area_code_text][i]]     = out[kind_str]
+        if out_e[kind_str] and area[area_code_text][i + 4]: acct[area[area_code_text][i + 4]] = out_e[kind_str]
+    if changed:
+        write_last(area_code_text, *(out[k] for k in STATE_KINDS), report_time)
     return acct
 
-def post_bs(mssg, lang, username, passwd):
+def remove_session(acct):
+    bs_client.pop(acct, None)
+    bs_session.remove_session(acct)
+
+def is_session_error(e):
+    """トークン失効・無効など、セッションを作り直せば回復するエラーか判定する。"""
+    from atproto.exceptions import BadRequestError, LoginRequiredError, UnauthorizedError
+    if isinstance(e, (UnauthorizedError, LoginRequiredError)):
+        return True
+    if isinstance(e, BadRequestError) and e.response is not None:
+        error = getattr(e.response.content, 'error', None)
+        return error in ('ExpiredToken', 'InvalidToken')
+    return False
+
+# def get_client(acct)
+# アカウントのログイン済み Client を返す。
+#   1. 同一実行内で生成済みならそれを再利用
+#   2. 前回実行で保存したセッション文字列があれば復元（期限切れ間近なら atproto が refreshSession で更新）
+#   3. いずれも無い・失効している場合のみ createSession（パスワードログイン）
+def get_client(acct):
+    client = bs_client.get(acct)
+    if client is not None:
+        return client
+
+    session_str = bs_session.read_session(acct)
+    if session_str:
+        client = bs_session.new_client(acct)
+        try:
+            with timed('login'):
+                client.login(session_string=session_str)
+            count('jma_logins_total', method='session', result='ok')
+            remember_did(client)
+            bs_client[acct] = client
+            return client
+        except Exception as e:
+            syslog.syslog(syslog.LOG_INFO, f"Saved session for {acct} is no longer valid: {e}")
+            count('jma_logins_total', method='session', result='error')
+
+    client = bs_session.new_client(acct)
+    try:
+        with timed('login'):
+            client.login(post_acct[acct]['bs_username'], post_acct[acct]['bs_passwd'])
+    except Exception:
+        count('jma_logins_total', method='password', result='error')
+        raise
+    count('jma_logins_total', method='password', result='ok')
+    remember_did(client)
+    bs_client[acct] = client
+    return client
+
+def remember_did(client):
+    """ログインで分かったハンドルと DID をキャッシュに登録する（プロフィールへのリンクに使う）。"""
+    if client.me is not None:
+        bs_handles.store(client.me.handle, client.me.did)
+
+# def post_once(text, facets, lang, acct)
+# 1回分の投稿。保存済みセッションが失効していた場合はパスワードでログインし直して1度だけ送り直す
+def post_once(text, facets, lang, acct):
+    client = get_client(acct)
+    try:
+        with timed('post'):
+            return client.send_post(text, facets=facets, langs=[ lang ])
+    except Exception as e:
+        if not is_session_error(e):
+            raise
+        syslog.syslog(syslog.LOG_INFO, f"Session for {acct} was rejected, logging in again: {e}")
+        remove_session(acct)
+    client = get_client(acct)
+    with timed('post'):
+        return client.send_post(text, facets=facets, langs=[ lang ])
+
+# def post_bs(text, facets, lang, acct, deadline=None)
+# 429 はリセット時刻まで、5xx・通信エラーは指数バックオフで待って POST_RETRY 回まで試行する。
+# 認証エラーは再試行しない
+# deadline: time.monotonic() の期限。これを過ぎる待ちになる時は送らずに 2 を返す
+# return: 0=成功, 1=失敗, 2=期限切れ（未送信）
+def post_bs(text, facets, lang, acct, deadline=None):
+    from atproto.exceptions import RateLimitExceededError
+
+    def on_retry(e, delay):
+        reason = 'rate_limit' if isinstance(e, RateLimitExceededError) else 'server_error'
+        syslog.syslog(syslog.LOG_WARNING, f"Retrying post to {acct} ({reason}) in {delay:.1f}s: {e}")
+        count('jma_post_retries_total', reason=reason)
+
     try:
-        client = Client()
-        client.login(username, passwd)
-        resp = client.send_post(mssg, langs=[ lang ])
+        bs_ratelimit.call(lambda: post_once(text, facets, lang, acct), POST_RETRY, on_retry, deadline)
+    except bs_ratelimit.DeadlineExceeded as e:
+        syslog.syslog(syslog.LOG_WARNING, f"Deferred post to {acct}: {e}")
+        return 2
     except Exception as e:
-        syslog.syslog(syslog.LOG_ERR, f"Failed post to Bluesky: mssg='{mssg}', response={e}")
+        syslog.syslog(syslog.LOG_ERR, f"Failed post to Bluesky: mssg='{text}', response={e}")
+        if is_session_error(e):
+            remove_session(acct)
         return 1
     return 0
 
-# post_by_acct(report_datetime, account_kind, ref_acct_kind[account_kind])
+# render_post(report_datetime, account_kind, ref_acct_kind[account_kind])
 #
-# description - make message and post, error handling
+# description - make message
 STATUS_KEY = {
     '発表': 1,
     'Announcement': 1,
@@ -762,19 +1416,78 @@ GRADE_INDEX_EN = {'Advisory': 0, 'Warning': 1, 'Urgent Warning': 2, 'Emergency W
 GRADE_RE_JA = re.compile(r'特別警報|危険警報|警報|注意報')
 GRADE_RE_EN = re.compile(r'Emergency Warning|Urgent Warning|Advisory|Warning')
 
-def linkify_status(status_text, acct):
-    """ステータス文字列を [(text, url_or_None), ...] のセグメント列へ分解する。
-    投稿元アカウント以外の等級名（例「警報から注意報」の注意報）を、
-    同一地域・該当等級・同一言語のアカウントのプロフィールへの link facet とする。
-    """
-    ja        = acct_area[acct]['lang'] == 'ja'
+# def grapheme_len(text)
+# return: Bluesky が投稿の長さとして数える書記素クラスタの数（UAX #29 の簡易版）
+#   結合文字(Mn/Me/Mc)・異体字セレクタ・肌の色の修飾子・タグ文字は直前の文字に含め、ZWJ の後の文字も直前と合わせて1つと数える
+def grapheme_len(text):
+    if text.isascii():
+        return len(text)
+    n = 0
+    joined = False
+    for ch in text:
+        if ch == '\u200d':
+            joined = True
+        elif joined or unicodedata.category(ch) in ('Mn', 'Me', 'Mc') \
+                or '\U0001f3fb' <= ch <= '\U0001f3ff' or '\U000e0020' <= ch <= '\U000e007f':
+            joined = False
+        else:
+            n += 1
+    return n
+
+# def segment(text, facet=None)
+# return: 投稿本文の一片 (text, facet, 書記素クラスタ数, UTF-8 バイト数)
+#   facet: None（プレーン）/ ('link', url) / ('tag', tag) / ('profile', handle)（描画時に DID で URL にする）
+def segment(text, facet=None):
+    return text, facet, grapheme_len(text), len(text.encode('utf-8'))
+
+# def measured(segs)
+# return: (segs, 書記素クラスタ数の合計, バイト数の合計)
+def measured(segs):
+    return segs, sum(seg[2] for seg in segs), sum(seg[3] for seg in segs)
+
+# def compile_template(acct)
+# acct_area[acct] から投稿の定型部分（見出し・ハッシュタグ・気象庁サイトへのリンク）を計測済みのセグメントにする。
+# ステータス毎の部分は compile_status() が初めて使う時に作って 'status' に加える
+# return: acct_template[acct]
+def compile_template(acct):
+    info = acct_area[acct]
+    ja = info['lang'] == 'ja'
+    grade_level = f'{info["grade"]}({GRADE_LEVEL.get(info["grade"], "")})'
+    template = {
+        'ja': ja,
+        'delimiter': '、' if ja else ', ',
+        'header': segment(f'【{info["name"]}：{grade_level}】\n' if ja else f'% {info["name"]} : {grade_level} %\n'),
+        'tags': measured([segment('\n ')] + [segment('#' + tag + ' ', ('tag', tag)) for tag in info['tag'].split(' ')]),
+        'site': measured([segment('\n[気象庁サイトへ]' if ja else '\n[To JMA site]',
+                                  ('link', FORM_URL_JMA_WARNING.format(info['code'], info['lang'])))]),
+        'trim': segment(POST_TRIM_MARK),
+        'status': {},
+    }
+    acct_template[acct] = template
+    return template
+
+# def compile_status(acct, template, status_text)
+# ステータス1種類分の行の前半（開き括弧とステータス）のセグメント・閉じ括弧・行末の等級を template['status'] に記録する。
+# 投稿元アカウント以外の等級名（例「警報から注意報」の注意報）は、同一地域・該当等級・同一言語のアカウントの
+# プロフィールへの link facet とする
+# return: (セグメントのリスト, 閉じ括弧, 等級)
+def compile_status(acct, template, status_text):
+    ja = template['ja']
+    key = STATUS_KEY.get(status_text, 50)	# 未知のステータスは 50 以降
+    if ja:
+        ob, cb = ('《', '》') if key < 10 else ('‥', '‥') if key < 50 else ('｛', '｝')
+    else:
+        ob, cb = ('[', ']') if key < 10 else ('-', '-') if key < 50 else ('{', '}')
+    grade = re.match(r'(.+)へ変化', status_text) or re.search(r'Change to (.+)$', status_text)
+    grade = grade.group(1) if grade else acct_area[acct]['grade']
+
     grade_idx = GRADE_INDEX_JA if ja else GRADE_INDEX_EN
     grade_re  = GRADE_RE_JA   if ja else GRADE_RE_EN
     cur_grade = acct_area[acct]['grade']
     accts     = area.get(acct_area[acct]['code'], [])
     base      = 0 if ja else 4
 
-    segs = []
+    segs = [segment(ob)]
     pos = 0
     for m in grade_re.finditer(status_text):
         token = m.group(0)
@@ -787,120 +1500,252 @@ def linkify_status(status_text, acct):
         if not target or target not in post_acct:
             continue
         if m.start() > pos:
-            segs.append((status_text[pos:m.start()], None))
-        url = f"https://bsky.app/profile/{post_acct[target]['bs_username']}"
-        segs.append((token, url))
+            segs.append(segment(status_text[pos:m.start()]))
+        segs.append(segment(token, ('profile', post_acct[target]['bs_username'])))
         pos = m.end()
     if pos < len(status_text):
-        segs.append((status_text[pos:], None))
-    if not segs:
-        segs = [(status_text, None)]
-    return segs
-
-def post_by_acct(report_datetime, acct, ref_code_status):
-    ja = acct_area[acct]['lang'] == 'ja'
-
-    kind_str = {}
+        segs.append(segment(status_text[pos:]))
+    compiled = template['status'][status_text] = (segs, cb, grade)
+    return compiled
+
+# def render_post(report_datetime, acct, ref_code_status)
+# 見出し・ステータス毎の行・発表時刻・ハッシュタグ・気象庁サイトへのリンクを、計測済みのセグメントを足し合わせて
+# 組み立てる（本文を作り直して数え直すことはしない）。POST_MAX_GRAPHEMES / POST_MAX_BYTES を超える時は
+# ステータスの行を後ろから行単位で削って POST_TRIM_MARK を置き、リンクの facet は残す。
+# ハッシュタグ、気象庁サイトへのリンクの順に、収まる場合だけ加える
+# return: (本文, facets)  facets は TextBuilder の facet を models.get_model_as_dict() した形の dict のリスト
+#         （outbox にそのまま JSON で保存し、送信時に drain_outbox() が atproto のモデルに戻す）
+def render_post(report_datetime, acct, ref_code_status):
+    template = acct_template.get(acct) or compile_template(acct)
+    ja = template['ja']
+
+    names = {}
     status = {}
     cnt = 50
-    delimiter = '、' if ja else ', '
-
-    for code, value in ref_code_status.items():
-        match = re.fullmatch(r'(.*),([^,]+)', value)
-        if match:
-            name, st = match.groups()
-            key = STATUS_KEY.get(st, cnt)
-            cnt += 1 if key == cnt else 0
-            kind_str[key] = kind_str.get(key, '') + delimiter + name
-            status[key] = st
-
-    grade_level = f'{acct_area[acct]["grade"]}({GRADE_LEVEL.get(acct_area[acct]["grade"], "")})'
-    # segments: [(text, url_or_None), ...] — url 付きは link facet として組み立てる
-    segments = [(f'【{acct_area[acct]["name"]}：{grade_level}】\n' if ja
-                 else f'% {acct_area[acct]["name"]} : {grade_level} %\n', None)]
+    for value in ref_code_status.values():
+        name, comma, st = value.rpartition(',')
+        if not comma or not st:
+            continue
+        key = STATUS_KEY.get(st, cnt)
+        cnt += 1 if key == cnt else 0
+        names.setdefault(key, []).append(name)
+        status[key] = st
 
+    lines = []	# [measured(1行分のセグメント), ...]
     for k in sorted(status.keys()):
         if k < 0:
             continue
-        kind_str[k] = re.sub(r'^[、,]', '', kind_str[k])
-        if ja:
-            ob, cb = ('《', '》') if k < 10 else ('‥', '‥') if k < 50 else ('｛', '｝')
-        else:
-            ob, cb = ('[', ']') if k < 10 else ('-', '-') if k < 50 else ('{', '}')
-        grade = re.match(r'(.+)へ変化', status[k]) or re.search(r'Change to (.+)$', status[k])
-        grade = grade.group(1) if grade else acct_area[acct]['grade']
-        # ステータス部のみ等級名をリンク化（前後の装飾・種別名・等級はプレーン）
-        segments.append((ob, None))
-        segments.extend(linkify_status(status[k], acct))
-        if ja:
-            segments.append((f'{cb} {kind_str[k]} {grade}\n', None))
-        else:
-            segments.append((f'{cb} {kind_str[k]}\n', None))
-
-    local_tz = datetime.now().astimezone().tzinfo
-    dt = datetime.fromtimestamp(report_datetime, local_tz)
-    formatted_time = dt.strftime('%Y-%m-%d %H:%M')
-    segments.append((f" ({formatted_time})", None))
-
-    body = ''.join(t for t, _ in segments)
-
-    tb = client_utils.TextBuilder()
-    if len(body) > 299:
-        # 上限超過時は安全側でリンクを諦めて切り詰める（facet 境界の破損を回避）
-        tb = tb.text(body[:299] + '…')
+        segs, cb, grade = template['status'].get(status[k]) or compile_status(acct, template, status[k])
+        delimiter = template['delimiter']
+        kinds = (delimiter + delimiter.join(names[k]))[1:]	# 従来どおり先頭の区切り文字の1文字目だけを除く
+        lines.append(measured(segs + [segment(f'{cb} {kinds} {grade}\n' if ja else f'{cb} {kinds}\n')]))
+
+    header = template['header']
+    footer = segment(f" ({time.strftime('%Y-%m-%d %H:%M', time.localtime(report_datetime))})")
+    graphemes = header[2] + footer[2] + sum(line[1] for line in lines)
+    size = header[3] + footer[3] + sum(line[2] for line in lines)
+    segments = [header]
+    if graphemes > POST_MAX_GRAPHEMES or size > POST_MAX_BYTES:
+        # 行単位で削る（行の途中で切らないので、残した行のリンクはそのまま使える）
+        trim = template['trim']
+        graphemes = header[2] + footer[2] + trim[2]
+        size = header[3] + footer[3] + trim[3]
+        kept = 0
+        for line, line_graphemes, line_size in lines:
+            if graphemes + line_graphemes > POST_MAX_GRAPHEMES or size + line_size > POST_MAX_BYTES:
+                break
+            segments.extend(line)
+            graphemes += line_graphemes
+            size += line_size
+            kept += 1
+        segments.append(trim)
+        syslog.syslog(syslog.LOG_WARNING, f"TRIM: {acct}, dropped {len(lines) - kept} of {len(lines)} status lines.")
+        count('jma_posts_trimmed_total')
     else:
-        for t, u in segments:
-            tb = tb.link(t, u) if u else tb.text(t)
-
-    if len(tb.build_text()) + len(acct_area[acct]['tag']) + 3 < 299:
-        tb = tb.text(f"\n ")
-        for tag in acct_area[acct]["tag"].split(' '):
-            tb = tb.tag('#' + tag + ' ', tag)
-
-    mssg = f'\n[気象庁サイトへ]' if ja else f'\n[To JMA site]'
-    if len(tb.build_text()) + len(mssg) < 299:
-        tb = tb.link(mssg, FORM_URL_JMA_WARNING.format(acct_area[acct]['code'], acct_area[acct]['lang']))
-
-    for _ in range(POST_RETRY):
-        result = post_bs(tb, 'ja-JP' if ja else 'en-US', post_acct[acct]['bs_username'], post_acct[acct]['bs_passwd'])
-        if result == 0:
+        for line, _, _ in lines:
+            segments.extend(line)
+    segments.append(footer)
+
+    for extra, extra_graphemes, extra_size in (template['tags'], template['site']):
+        if graphemes + extra_graphemes <= POST_MAX_GRAPHEMES and size + extra_size <= POST_MAX_BYTES:
+            segments.extend(extra)
+            graphemes += extra_graphemes
+            size += extra_size
+
+    # facet の位置は各セグメントのバイト数を足して求める（TextBuilder で本文を書きながら数え直さない）
+    facets = []
+    offset = 0
+    for _, facet, _, nbytes in segments:
+        if facet is not None:
+            kind, value = facet
+            if kind == 'tag':
+                feature = {'tag': value, '$type': FACET_TYPE + '#tag'}
+            elif kind == 'profile':
+                # DID が分かっていれば DID で指定する（ハンドルが変わってもリンクが切れない）
+                feature = {'uri': f"https://bsky.app/profile/{bs_handles.cached_did(value) or value}",
+                           '$type': FACET_TYPE + '#link'}
+            else:
+                feature = {'uri': value, '$type': FACET_TYPE + '#link'}
+            facets.append({'features': [feature],
+                           'index': {'byteEnd': offset + nbytes, 'byteStart': offset, '$type': FACET_TYPE + '#byteSlice'},
+                           '$type': FACET_TYPE})
+        offset += nbytes
+    return ''.join(seg[0] for seg in segments), facets
+
+# def enqueue_post(area_code_text, acct, report_time, post, lang)
+# 描画済みの投稿（render_post() の (本文, facets)）を outbox に登録する（commit_last() で状態と同時に確定）。
+# (エリア, アカウント, report_time) が登録済みなら何もしない
+# return: 登録した件数(0/1)
+def enqueue_post(area_code_text, acct, report_time, post, lang):
+    text, facets = post
+    cur = state_db.execute('INSERT OR IGNORE INTO outbox (area_code, acct, report_time, lang, text, facets, created) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (int(area_code_text), acct, report_time, lang, text,
+                            json.dumps(facets, ensure_ascii=False), int(time.time())))
+    return cur.rowcount
+
+# def breaker_allows()
+# return: 投稿してよいか。停止期限を過ぎた後は1件だけ試行を許す（成功・失敗は breaker_record() で報告）
+def breaker_allows():
+    with breaker_lock:
+        if not breaker['until']:
+            return True
+        if breaker['until'] > time.time() or breaker['probing']:
+            return False
+        breaker['probing'] = True
+        return True
+
+def breaker_open():
+    with breaker_lock:
+        return breaker['until'] > time.time()
+
+def breaker_record(ok):
+    with breaker_lock:
+        if ok:
+            if breaker['until']:
+                syslog.syslog(syslog.LOG_INFO, "CIRCUIT CLOSED: posting resumed.")
+            breaker.update(failures=0, until=0, probing=False)
             return
-        time.sleep(POST_INTERVAL)
-    syslog.syslog(syslog.LOG_ERR, f"ERROR: Aborted to post to {acct}.")
-
-
-### MAIN ###
-syslog.syslog(syslog.LOG_INFO, "START")
-time.sleep(DELAY_START)
-
-######################
-# 排他制御(厳密でない)
-if os.path.exists(LOCK_FILE) and (os.stat(LOCK_FILE).st_mtime + LOCK_TIMEOUT > time.time()):
-    syslog.syslog(syslog.LOG_ERR, "Aborted by exclusion of lock file.")
-    exit(0)
-
-# ロックファイルを作成
-with open(LOCK_FILE, "w"):
-    pass
-
-if not check_last_modified():
-    os.unlink(LOCK_FILE)
-    exit(0)
-#######################
-    
-# エリアファイル読込み
-read_area()
-read_bs()
-
-
-# 気象庁から随時XMLを取得
-feed = feedparser.parse(URL_JMA_PULL)
-if not feed:
-    syslog.syslog(syslog.LOG_ERR, "atom/rss parse error")
-    exit()
-
-# DEBUG: save to data file
-if DEBUG:
+        breaker['failures'] += 1
+        if breaker['probing'] or breaker['failures'] >= BREAKER_THRESHOLD:
+            breaker.update(until=int(time.time()) + BREAKER_COOLDOWN, probing=False)
+            syslog.syslog(syslog.LOG_ERR, f"CIRCUIT OPEN: {breaker['failures']} consecutive post failures, "
+                                          f"suspending posts for {BREAKER_COOLDOWN}s.")
+
+# ブレーカーの状態は cron の1回実行モードでも引き継ぐため state.db の meta に保存する
+def load_breaker():
+    row = state_db.execute("SELECT value FROM meta WHERE key = 'breaker'").fetchone()
+    failures, until = map(int, row[0].split()) if row else (0, 0)
+    with breaker_lock:
+        breaker.update(failures=failures, until=until, probing=False)
+
+def save_breaker():
+    with breaker_lock:
+        value = f"{breaker['failures']} {breaker['until']}"
+    state_db.execute("INSERT OR REPLACE INTO meta VALUES ('breaker', ?)", (value,))
+
+# def post_acct_items(acct, items, deadline)
+# 1アカウント分の outbox の投稿を report_time 順に送る。失敗したら順序を保つため後続は次回に回す
+# deadline を過ぎたら新たな投稿を始めず、送信中の投稿も deadline を過ぎる待ちはせずに次回に回す
+# items: [(rowid, report_time, lang, text, facets), ...]
+# return: [(rowid, 成功したか), ...]（試行したもののみ）
+def post_acct_items(acct, items, deadline):
+    results = []
+    for rowid, report_time, lang, text, facets in items:
+        if time.monotonic() > deadline or not breaker_allows():
+            break
+        syslog.syslog(syslog.LOG_INFO, f"POST {report_time}, {acct}")
+        result = post_bs(text, facets, lang, acct, deadline)
+        if result == 2:
+            # 期限までに送れなかった。失敗とは数えず、送信待ちのまま次回に回す
+            count('jma_posts_total', result='deferred')
+            break
+        ok = result == 0
+        breaker_record(ok)
+        count('jma_posts_total', result='ok' if ok else 'failed')
+        results.append((rowid, ok))
+        if not ok:
+            syslog.syslog(syslog.LOG_ERR, f"ERROR: Aborted to post to {acct}, will retry later.")
+            break
+    return results
+
+# def drain_outbox()
+# outbox の送信待ち投稿を送る。アカウント単位にまとめ、アカウント間は POST_WORKERS 本のワーカーで並列に投稿する。
+# 送れなかった投稿は OUTBOX_RETRY_BASE 秒から倍々に間隔を空けて次回以降の実行で再送する。
+def drain_outbox():
+    open_state()
+    now = int(time.time())
+    expired = state_db.execute("UPDATE outbox SET state = 'expired' WHERE state = 'pending' AND report_time < ?",
+                               (now - OUTBOX_EXPIRE,)).rowcount
+    if expired:
+        syslog.syslog(syslog.LOG_ERR, f"OUTBOX: dropped {expired} posts older than {OUTBOX_EXPIRE}s.")
+        count('jma_outbox_expired_total', expired)
+    state_db.execute("DELETE FROM outbox WHERE state != 'pending' AND created < ?", (now - OUTBOX_KEEP,))
+    # 再送待ち(next_try が先)の投稿があるアカウントは、それより後の投稿も送らない（report_time の順序を保つ）
+    rows = []
+    held = set()
+    for row in state_db.execute("SELECT rowid, acct, report_time, lang, text, facets, next_try FROM outbox "
+                                "WHERE state = 'pending' ORDER BY report_time, rowid"):
+        if row[1] in held:
+            continue
+        if row[6] > now:
+            held.add(row[1])
+            continue
+        rows.append(row[:6])
+    state_db.commit()
+    load_breaker()
+
+    by_acct = {}
+    if rows:
+        from atproto import models
+    for rowid, acct, report_time, lang, text, facets in rows:
+        facets = [models.get_or_create(f, models.AppBskyRichtextFacet.Main) for f in json.loads(facets)]
+        by_acct.setdefault(acct, []).append((rowid, report_time, lang, text, facets))
+
+    if by_acct and breaker_open():
+        syslog.syslog(syslog.LOG_WARNING, f"CIRCUIT OPEN: {len(rows)} posts held until {breaker['until']}.")
+        by_acct = {}
+    if by_acct and not config_loaded:
+        read_config()
+
+    start = time.monotonic()
+    deadline = start + OUTBOX_DRAIN_TIME
+    results = []
+    if by_acct and POST_WORKERS <= 1:
+        for acct, items in by_acct.items():
+            results.extend(post_acct_items(acct, items, deadline))
+    elif by_acct:
+        with ThreadPoolExecutor(max_workers=min(POST_WORKERS, len(by_acct))) as executor:
+            futures = [executor.submit(post_acct_items, acct, items, deadline) for acct, items in by_acct.items()]
+            for future in futures:
+                results.extend(future.result())
+
+    attempts = {rowid: n for rowid, n in state_db.execute(
+        "SELECT rowid, attempts FROM outbox WHERE state = 'pending'")}
+    for rowid, ok in results:
+        if ok:
+            state_db.execute("UPDATE outbox SET state = 'sent', attempts = attempts + 1 WHERE rowid = ?", (rowid,))
+        else:
+            delay = min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** attempts.get(rowid, 0))
+            state_db.execute("UPDATE outbox SET attempts = attempts + 1, next_try = ? WHERE rowid = ?",
+                             (int(time.time()) + delay, rowid))
+    save_breaker()
+    state_db.commit()
+
+    pending = state_db.execute("SELECT COUNT(*) FROM outbox WHERE state = 'pending'").fetchone()[0]
+    set_gauge('jma_outbox_pending', pending)
+    set_gauge('jma_breaker_open', 1 if breaker_open() else 0)
+    if results:
+        ok = sum(1 for _, r in results if r)
+        elapsed = time.monotonic() - start
+        rate = len(results) / elapsed if elapsed > 0 else 0.0
+        syslog.syslog(syslog.LOG_INFO, f"POST SUMMARY: posts={len(results)}, ok={ok}, failed={len(results) - ok}, "
+                                       f"pending={pending}, accounts={len(by_acct)}, workers={POST_WORKERS}, "
+                                       f"elapsed={elapsed:.2f}s, rate={rate:.2f}/s")
+
+
+def dump_feed(feed):
+    """DEBUG: フィードの内容をデータファイルへ保存する。"""
     t = time.localtime()
     data_file = f'/var/tmp/push_{t.tm_year}{t.tm_mon:02d}{t.tm_mday:02d}{t.tm_hour:02d}{t.tm_min:02d}{t.tm_sec:02d}_{os.getpid()}.debug'
     try:
@@ -924,28 +1769,91 @@ if DEBUG:
     except IOError:
         syslog.syslog(syslog.LOG_ERR, f"fail to open data file {data_file}")
 
-ref_links = check(feed)
-
-# ── Phase 1: 全リンクのXMLを解析し (エリア, report_time) ごとに集約 ──────────
-# 同一イベントの複数電文（VPWW58/59/61 など同一 report_time）をマージすることで
-# 1イベント1投稿を実現する
-area_events = {}   # area_code_text -> { report_time -> {'current': ..., 'vpww_types': set()} }
-
-for link, ref_area in ref_links.items():
-    syslog.syslog(syslog.LOG_INFO, f"DEBUG: LINK={link}, PARAM={':'.join(ref_area.keys())}")
-    vpww_type = extract_vpww_type(link)
-    result = collect_xml(link, ref_area)
-    for area_code_text, (report_time, current) in result.items():
-        area_events.setdefault(area_code_text, {})
-        ev = area_events[area_code_text]
-        ev.setdefault(report_time, {'current': {'wa': {}, 'ww': {}, 'wuw': {}, 'wew': {}}, 'vpww_types': set()})
+
+def run_once(poll=True):
+    """1回分の処理。新しい電文を取り込んで outbox に登録し、その後 outbox の投稿を送る。
+    投稿の失敗・中断は取り込みに影響しない（送れなかった投稿は次回以降の実行で送る）。
+    poll=False: フィードは確認せず outbox の投稿だけを送る（cron で確認時刻に達していない時）。"""
+    if poll:
+        gap = catchup_gap(time.time())
+        if catchup_requested or gap > FEED_WINDOW:
+            catch_up(gap)
+        ingest()
+    drain_outbox()
+
+
+def ingest():
+    """更新確認 → フィード取得 → XML解析 → 比較 → 状態更新・投稿の outbox 登録。"""
+    # 気象庁から随時XMLを取得（更新が無ければ終了）
+    feed = fetch_feed()
+    if feed is None:
+        return
+
+    # エリアファイル読込み（更新がある時のみ。常駐モードでは読込み済みの設定を使い回す）
+    if not config_loaded:
+        read_config()
+
+    if feed.bozo and not feed.entries:
+        syslog.syslog(syslog.LOG_ERR, "atom/rss parse error")
+        return
+
+    # DEBUG: save to data file
+    if DEBUG:
+        dump_feed(feed)
+
+    with timed('feed_parse'):
+        ref_links = check(feed)
+
+    # 処理済みの電文は取得しない（エントリID・リンクのいずれかが記録済みならスキップ）
+    with timed('state_read'):
+        ledger = read_ledger()
+    entry_ids = {item.link: item.get('id', item.link) for item in feed.entries}
+    skipped = 0
+    for link in list(ref_links):
+        if link in ledger or entry_ids.get(link) in ledger:
+            del ref_links[link]
+            skipped += 1
+    syslog.syslog(syslog.LOG_INFO, f"LEDGER: fetch={len(ref_links)}, skipped={skipped}")
+    count('jma_telegrams_skipped_total', skipped)
+
+    # 取得 → 解析 → エリア毎の集約をキューでつなぎ、エリアに関係する電文が全て解析できた時点で
+    # そのエリアを比較・outbox 登録する（最初の投稿が全電文の取得を待たない）
+    processed, queued, _ = run_pipeline(ref_links)
+    if queued:
+        syslog.syslog(syslog.LOG_INFO, f"OUTBOX: queued {queued} posts.")
+
+    # 状態の更新まで終えた電文を処理済みとして記録する
+    now = int(time.time())
+    for link in processed:
+        ledger[link] = now
+        ledger[entry_ids.get(link, link)] = now
+    with timed('state_write'):
+        write_ledger(ledger)
+
+
+# def merge_events(parts)
+# 同一エリアの電文毎の解析結果を report_time ごとに集約する。
+# 同一イベントの複数電文（VPWW58/59/61 など同一 report_time）をマージすることで1イベント1投稿を実現する
+# parts: [(電文の順番, report_time, current, vpww_type), ...]  電文の順番(フィードの順)にマージする
+# return: { report_time => {'current': ..., 'vpww_types': set()} }
+def merge_events(parts):
+    events = {}
+    for _, report_time, current, vpww_type in sorted(parts, key=lambda part: part[0]):
+        ev = events.setdefault(report_time, {'current': {'wa': {}, 'ww': {}, 'wuw': {}, 'wew': {}}, 'vpww_types': set()})
         for k in ['wa', 'ww', 'wuw', 'wew']:
-            ev[report_time]['current'][k].update(current[k])
+            ev['current'][k].update(current[k])
         if vpww_type:
-            ev[report_time]['vpww_types'].add(vpww_type)
-
-# ── Phase 2: エリアごとに時系列順で比較・投稿 ────────────────────────────────
-for area_code_text, events in area_events.items():
+            ev['vpww_types'].add(vpww_type)
+    return events
+
+# def process_area(area_code_text, events)
+# エリア1件分の集約結果を時系列順に比較し、投稿を outbox に登録する。
+# 状態の更新と投稿の登録はエリア単位で1トランザクションにまとめる（片方だけ残ることはない）
+# post_after: report_time がこれより前の変化は状態だけを更新し、投稿しない（追いつき処理用）
+# return: (登録した投稿数, 投稿しなかった数)
+def process_area(area_code_text, events, post_after=0):
+    queued = 0
+    suppressed = 0
     ref_last = read_last(int(area_code_text))
     for report_time in sorted(events.keys()):
         # 古い report_time は改めてスキップ
@@ -965,20 +1873,728 @@ for area_code_text, events in area_events.items():
         else:
             responsible = None  # 旧形式: 全コードが担当対象
 
-        ref_acct = compare_and_post(area_code_text, report_time, event['current'], responsible, ref_last)
+        with timed('compare'):
+            ref_acct = compare_and_post(area_code_text, report_time, event['current'], responsible, ref_last)
 
         for acct_name, code_status in ref_acct.items():
-            syslog.syslog(syslog.LOG_INFO, f"POST {report_time}, {acct_name}, {code_status}")
-            if acct_name:
-                post_by_acct(report_time, acct_name, code_status)
+            if not acct_name:
+                continue
+            if report_time < post_after:
+                suppressed += 1
+                continue
+            with timed('render'):
+                post = render_post(report_time, acct_name, code_status)
+            lang = 'ja-JP' if acct_area[acct_name]['lang'] == 'ja' else 'en-US'
+            queued += enqueue_post(area_code_text, acct_name, report_time, post, lang)
 
         if ref_acct:
             ref_last = read_last(int(area_code_text))  # 次の report_time 処理のために更新
 
-#######################
-os.unlink(LOCK_FILE)
-#######################
-syslog.syslog(syslog.LOG_INFO, "END")
-exit(0)
+    # エリア単位で状態と outbox を確定する
+    commit_last()
+    if suppressed:
+        count('jma_posts_suppressed_total', suppressed)
+    return queued, suppressed
+
+# def pipeline_put(q, item, stop) / pipeline_get(q, stop)
+# stop が立つまで q への追加・取り出しを待つ（後段が例外で止まっても前段のスレッドが残らないようにする）
+# return: put は追加できたか、get は取り出した要素（stop が立った時は None）
+def pipeline_put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def pipeline_get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            pass
+    return None
+
+# def run_stage(stage, stop, *args)
+# 段のスレッドの本体。段が例外で止まった時は記録して stop を立て、他の段と集約段に知らせる
+def run_stage(stage, stop, *args):
+    try:
+        stage(*args)
+    except Exception as e:
+        syslog.syslog(syslog.LOG_ERR, f"PIPELINE: {stage.__name__} stopped: {e!r}")
+        stop.set()
+
+# def collect_get(parsed, parse_thread, stop)
+# 集約段: parsed から次の解析結果を取り出す。段が止まった（stop が立った、または解析段のスレッドが終わった）後に
+# parsed が空なら、それ以上の結果は来ないため None を返す
+def collect_get(parsed, parse_thread, stop):
+    while True:
+        try:
+            return parsed.get(timeout=0.5)
+        except queue.Empty:
+            if stop.is_set() or not parse_thread.is_alive():
+                try:
+                    return parsed.get_nowait()
+                except queue.Empty:
+                    return None
+
+# def fetch_stage(links, fetched, stop)
+# 取得段: links の XML を FETCH_WORKERS 本まで並列に（フィードの順に）取得し、(順番, 本文) を fetched に入れる
+def fetch_stage(links, fetched, stop):
+    def fetch(index):
+        if stop.is_set():
+            return
+        try:
+            content = fetch_xml(links[index])
+        except Exception as e:
+            syslog.syslog(syslog.LOG_ERR, f"Failed to fetch XML from {links[index]}: {e!r}")
+            content = None
+        pipeline_put(fetched, (index, content), stop)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(FETCH_WORKERS, len(links)))) as executor:
+        list(executor.map(fetch, range(len(links))))
+
+# def parse_stage(links, ref_links, fetched, parsed, stop)
+# 解析段: fetched の本文を parse_xml() で解析し、(順番, 本文, 結果) を parsed に入れる。
+# 取得・解析に失敗した電文の結果は None（処理済みとしない）
+def parse_stage(links, ref_links, fetched, parsed, stop):
+    if PARSE_PROCESSES > 1 and len(links) >= PARSE_PROCESS_THRESHOLD:
+        parse_stage_pool(links, ref_links, fetched, parsed, stop)
+        return
+    parse_stage_thread(links, ref_links, fetched, parsed, stop, len(links))
+
+# def parse_stage_thread(links, ref_links, fetched, parsed, stop, remaining)
+# 解析段（このスレッドで解析する）: fetched から remaining 件の本文を受け取って解析する
+def parse_stage_thread(links, ref_links, fetched, parsed, stop, remaining):
+    for _ in range(remaining):
+        item = pipeline_get(fetched, stop)
+        if item is None:
+            return
+        index, content = item
+        if not pipeline_put(parsed, (index, content, parse_one(links[index], content, ref_links)), stop):
+            return
+
+# def parse_one(link, content, ref_links)
+# return: 1件の電文の parse_xml() の結果（本文が無い・解析に失敗した時は None）
+def parse_one(link, content, ref_links):
+    if content is None:
+        return None
+    try:
+        with timed('xml_parse'):
+            return parse_xml(content, ref_links[link])
+    except Exception as e:	# 1件の電文の不備で他の電文・エリアの処理を止めない（次回の実行で再取得する）
+        syslog.syslog(syslog.LOG_ERR, f"Failed to parse XML from {link}: {e!r}")
+        return None
+
+# def parse_stage_pool(links, ref_links, fetched, parsed, stop)
+# 解析段（電文が PARSE_PROCESS_THRESHOLD 件以上の時）: parse_telegram() を PARSE_PROCESSES 個のプロセスで並列に実行する。
+# 本文(bytes)とエリアコードの集合だけを渡し、処理済みの report_time の除外はこのプロセスで行う。
+# 解析プロセスを起動できない・異常終了した（BrokenProcessPool）時は、残りの電文をこのスレッドで解析する
+def parse_stage_pool(links, ref_links, fetched, parsed, stop):
+    import multiprocessing
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    from concurrent.futures.process import BrokenProcessPool
+
+    running = {}	# future => (順番, 本文)
+    unsent = []	# 受け取ったがプロセスに渡せなかった (順番, 本文)
+    received = 0
+    executor = None
+    try:
+        # スレッドを持つこのプロセスを fork しないよう spawn で起動する
+        executor = ProcessPoolExecutor(max_workers=PARSE_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+        while (received < len(links) or running) and not stop.is_set():
+            # 解析中の電文を PARSE_PROCESSES の2倍までに抑えて、取得段からの電文を渡す
+            while received < len(links) and len(running) < PARSE_PROCESSES * 2:
+                try:
+                    index, content = fetched.get_nowait() if running else fetched.get(timeout=0.5)
+                except queue.Empty:
+                    break
+                received += 1
+                if content is None:
+                    if not pipeline_put(parsed, (index, None, None), stop):
+                        return
+                    continue
+                unsent.append((index, content))
+                future = executor.submit(parse_worker, content, frozenset(ref_links[links[index]]))
+                running[future] = unsent.pop()
+            if not running:
+                continue
+
+            done, _ = wait(running, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result, seconds = future.result()
+                    observe('xml_parse', seconds)
+                    result = drop_processed(result)
+                except BrokenProcessPool:
+                    raise	# この電文も running に残したまま、このスレッドでの解析に切り替える
+                except Exception as e:
+                    syslog.syslog(syslog.LOG_ERR, f"Failed to parse XML from {links[running[future][0]]}: {e!r}")
+                    result = None
+                index, content = running.pop(future)
+                if not pipeline_put(parsed, (index, content, result), stop):
+                    return
+    except (BrokenProcessPool, OSError) as e:
+        left = sorted(unsent + list(running.values()))
+        syslog.syslog(syslog.LOG_ERR, f"PIPELINE: parse processes failed ({e!r}), parsing the remaining "
+                                      f"{len(left) + len(links) - received} telegrams in this thread.")
+        for index, content in left:
+            if not pipeline_put(parsed, (index, content, parse_one(links[index], content, ref_links)), stop):
+                return
+        parse_stage_thread(links, ref_links, fetched, parsed, stop, len(links) - received)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+# def run_pipeline(ref_links, post_after=0)
+# 集約段（呼び出し元のスレッドで実行）: 解析結果をエリア毎に溜め、そのエリアを含む電文が全て解析されたら
+# merge_events() → process_area() を行う。エリアの集約・比較の結果は全電文を解析してから処理した場合と同じ
+# return: (取得・解析できたリンクのリスト, outbox に登録した投稿数, 投稿しなかった数)
+def run_pipeline(ref_links, post_after=0):
+    links = list(ref_links)
+    if not links:
+        return [], 0, 0
+    load_state_cache()	# 解析段の read_last() が別スレッドで state.db を読まないよう先に読み込む
+    waiting = {}	# area_code_text => そのエリアを含む未解析の電文数
+    for ref_area in ref_links.values():
+        for area_code_text in ref_area:
+            waiting[area_code_text] = waiting.get(area_code_text, 0) + 1
+    parts = {}	# area_code_text => [(電文の順番, report_time, current, vpww_type), ...]
+    processed = []
+    queued = 0
+    suppressed = 0
+    first_queued = None
+    start = time.perf_counter()
+
+    # 1件の電文の解析結果を受け取り、そのエリアを含む電文が揃ったエリアを処理する
+    def collect(index, content, result):
+        nonlocal queued, suppressed, first_queued
+        link = links[index]
+        ref_area = ref_links[link]
+        syslog.syslog(syslog.LOG_INFO, f"DEBUG: LINK={link}, PARAM={':'.join(ref_area.keys())}")
+        if content is not None:
+            record_corpus({f"data/{os.path.basename(link)}": content})
+        if result is not None:
+            processed.append(link)
+            vpww_type = extract_vpww_type(link)
+            for area_code_text, (report_time, current) in result.items():
+                parts.setdefault(area_code_text, []).append((index, report_time, current, vpww_type))
+
+        for area_code_text in ref_area:
+            waiting[area_code_text] -= 1
+            if waiting[area_code_text] == 0 and area_code_text in parts:
+                n_queued, n_suppressed = process_area(area_code_text, merge_events(parts.pop(area_code_text)),
+                                                      post_after)
+                queued += n_queued
+                suppressed += n_suppressed
+                if queued and first_queued is None:
+                    first_queued = time.perf_counter() - start
+
+    fetched = queue.Queue(PIPELINE_QUEUE)
+    parsed = queue.Queue(PIPELINE_QUEUE)
+    stop = threading.Event()
+    stages = [threading.Thread(target=run_stage, args=(fetch_stage, stop, links, fetched, stop), daemon=True),
+              threading.Thread(target=run_stage, args=(parse_stage, stop, links, ref_links, fetched, parsed, stop),
+                               daemon=True)]
+    for stage in stages:
+        stage.start()
+
+    received = set()
+    try:
+        while len(received) < len(links):
+            item = collect_get(parsed, stages[1], stop)
+            if item is None:
+                # 段が止まった: 届かなかった電文は取得に失敗した電文と同じく処理済みとせず（次回の実行で再取得する）、
+                # 届いた電文だけでエリアを処理する
+                missing = [index for index in range(len(links)) if index not in received]
+                syslog.syslog(syslog.LOG_ERR, f"PIPELINE: stopped with {len(missing)} telegrams not parsed, "
+                                              f"retrying them next run.")
+                for index in missing:
+                    collect(index, None, None)
+                break
+            received.add(item[0])
+            collect(*item)
+    finally:
+        stop.set()
+        for stage in stages:
+            stage.join()
+
+    if first_queued is not None:
+        set_gauge('jma_first_queue_seconds', first_queued)
+        syslog.syslog(syslog.LOG_INFO, f"PIPELINE: first post queued after {first_queued:.2f}s "
+                                       f"({len(processed)}/{len(links)} telegrams).")
+    return processed, queued, suppressed
+
+# def record_feed_check()
+# フィードの確認（200/304）に成功した時刻を記録する（catchup_gap() が確認できなかった期間の判定に使う）
+def record_feed_check():
+    open_state()
+    state_db.execute("INSERT OR REPLACE INTO meta VALUES ('last_check', ?)", (str(int(time.time())),))
+    state_db.commit()
+
+# def catchup_gap(now)
+# return: 最後にフィードを確認できてからの秒数。確認時刻の記録が無い場合は、前回のフィードの Last-Modified と
+#         各エリアの状態の report_time のうち新しい方から数える（いずれも無い初回は 0）
+def catchup_gap(now):
+    open_state()
+    row = state_db.execute("SELECT value FROM meta WHERE key = 'last_check'").fetchone()
+    if row is not None:
+        return now - int(row[0])
+    last_seen = max(read_feed_state()[0], state_db.execute('SELECT MAX(time) FROM last').fetchone()[0] or 0)
+    return now - last_seen if last_seen else 0
+
+# def entry_time(item)
+# return: フィードのエントリの更新時刻(UNIX時刻)。不明時は 0
+def entry_time(item):
+    parsed = item.get('updated_parsed') or item.get('published_parsed')
+    return calendar.timegm(parsed) if parsed else 0
+
+# def fetch_long_feed()
+# return: 解析済みの長期フィード（取得失敗時は None）
+def fetch_long_feed():
+    try:
+        with timed('feed_check'):
+            response = get_http_session().get(URL_JMA_LONG, timeout=HTTP_TIMEOUT)
+    except requests.RequestException as e:
+        syslog.syslog(syslog.LOG_ERR, f"Failed to fetch feed from {URL_JMA_LONG}: {e}")
+        count('jma_feed_requests_total', result='error')
+        return None
+    if response.status_code != 200:
+        syslog.syslog(syslog.LOG_ERR, f"Failed to fetch feed from {URL_JMA_LONG}. Status code: {response.status_code}")
+        count('jma_feed_requests_total', result='error')
+        return None
+    count('jma_feed_requests_total', result='updated')
+    count('jma_bytes_total', len(response.content), source='feed')
+
+    import feedparser
+    with timed('feed_parse'):
+        return feedparser.parse(response.content)
+
+# def catch_up(gap)
+# 追いつき処理: 長期フィード(extra_l.xml)の未処理の電文を、エントリの更新時刻の古い順に CATCHUP_BATCH 件ずつ
+# run_pipeline() で処理する（メモリに持つのは1バッチ分の電文だけ）。バッチ毎に処理済みの電文を記録する。
+# report_time が CATCHUP_POST_AGE 秒より古い変化は状態だけを更新し、古い警報を投稿しない
+def catch_up(gap):
+    global catchup_requested
+    catchup_requested = False
+    syslog.syslog(syslog.LOG_WARNING, f"CATCHUP: feed not checked for {gap:.0f}s, reading {URL_JMA_LONG}")
+    count('jma_catchup_runs_total')
+    feed = fetch_long_feed()
+    if feed is None:
+        return
+    if not config_loaded:
+        read_config()
+    if feed.bozo and not feed.entries:
+        syslog.syslog(syslog.LOG_ERR, "atom/rss parse error")
+        return
+
+    with timed('feed_parse'):
+        ref_links = check(feed)
+    with timed('state_read'):
+        ledger = read_ledger()
+    entries = {item.link: item for item in feed.entries}
+    links = [link for link in ref_links
+             if link not in ledger and entries[link].get('id', link) not in ledger]
+    links.sort(key=lambda link: entry_time(entries[link]))
+    skipped = len(ref_links) - len(links)
+    count('jma_telegrams_skipped_total', skipped)
+    post_after = time.time() - CATCHUP_POST_AGE if CATCHUP_POST_AGE > 0 else float('inf')
+
+    queued = suppressed = batches = 0
+    start = 0
+    while start < len(links):
+        end = min(start + CATCHUP_BATCH, len(links))
+        # 同じ時刻の電文（同一イベントの VPWW55-61 など）は同じバッチで集約する
+        while end < len(links) and entry_time(entries[links[end]]) == entry_time(entries[links[end - 1]]):
+            end += 1
+        processed, n_queued, n_suppressed = run_pipeline({link: ref_links[link] for link in links[start:end]},
+                                                         post_after)
+        queued += n_queued
+        suppressed += n_suppressed
+        batches += 1
+        start = end
+
+        now = int(time.time())
+        for link in processed:
+            ledger[link] = now
+            ledger[entries[link].get('id', link)] = now
+        with timed('state_write'):
+            write_ledger(ledger)
+
+    syslog.syslog(syslog.LOG_INFO, f"CATCHUP: telegrams={len(links)}, skipped={skipped}, batches={batches}, "
+                                   f"queued={queued}, suppressed={suppressed}")
+
+# def record_feed_update(modified)
+# 取得したフィードの Last-Modified を記録する（poll_delay() が更新の周期・時刻を学習するのに使う）
+def record_feed_update(modified):
+    open_state()
+    state_db.execute('INSERT OR IGNORE INTO feed_updates VALUES (?)', (modified,))
+    state_db.execute('DELETE FROM feed_updates WHERE modified < ?', (modified - POLL_HISTORY,))
+    state_db.commit()
+
+def feed_history():
+    """記録した Last-Modified（古い順）。"""
+    open_state()
+    return [modified for (modified,) in state_db.execute('SELECT modified FROM feed_updates ORDER BY modified')]
+
+# def feed_phase(history)
+# return: フィードが毎分何秒に更新されるかの推定値（記録が POLL_SAMPLES 件未満、または半数以上が
+#         ±POLL_PHASE_SPREAD 秒に収まらず学習できない時は None）
+def feed_phase(history):
+    if len(history) < POLL_SAMPLES:
+        return None
+    counts = [0] * POLL_PERIOD
+    for modified in history:
+        counts[modified % POLL_PERIOD] += 1
+    # 同数の時は幅を狭めた数で比べ、記録の集まる中心の秒を選ぶ（端の秒を選ぶと確認が遅れる）
+    best = max((tuple(sum(counts[(second + d) % POLL_PERIOD] for d in range(-spread, spread + 1))
+                      for spread in range(POLL_PHASE_SPREAD, -1, -1)), second) for second in range(POLL_PERIOD))
+    hits, phase = best[0][0], best[1]
+    return phase if hits * 2 >= len(history) else None
+
+def warnings_active():
+    """警報以上（警報・危険警報・特別警報）が発表中のエリアがあるか。"""
+    open_state()
+    return state_db.execute("SELECT 1 FROM last WHERE ww != '' OR wuw != '' OR wew != '' LIMIT 1").fetchone() is not None
+
+# def poll_delay(now)
+# return: 次にフィードを確認するまでの秒数
+#   1. 直近 POLL_ACTIVE_WINDOW 秒以内に更新があれば、更新が続いているとみなして毎分確認する。
+#      更新時刻（毎分の何秒か）を学習済みなら予想される更新の POLL_LAG 秒後に確認し、そこで今回の更新が
+#      見えなければ POLL_PHASE_SPREAD 秒の遅れを見込んで POLL_MIN 後にもう一度確認する。未学習なら POLL_MIN
+#   2. それ以外は最後の更新からの経過時間の POLL_BACKOFF 倍（POLL_MIN〜POLL_MAX、警報発表中は POLL_WARNING_MAX まで）
+#   3. 更新時刻を学習済みなら、その間隔以内で最後に更新が予想される時刻の POLL_LAG 秒後に合わせる
+def poll_delay(now):
+    history = feed_history()
+    limit = POLL_WARNING_MAX if warnings_active() else POLL_MAX
+    if not history:
+        return min(POLL_PERIOD, limit)	# 記録が無い間は従来の cron と同じ間隔
+    since = now - history[-1]
+    phase = feed_phase(history)
+    if since < POLL_ACTIVE_WINDOW:
+        if phase is None:
+            return POLL_MIN
+        expected = now - (now - phase) % POLL_PERIOD	# 直前に更新が予想される時刻
+        if now < expected + POLL_LAG + POLL_PHASE_SPREAD and history[-1] < expected - POLL_PHASE_SPREAD:
+            return POLL_MIN
+        return max(POLL_MIN, expected + POLL_PERIOD + POLL_LAG - now)
+    interval = min(max(POLL_MIN, since * POLL_BACKOFF), limit)
+
+    if phase is None:
+        return interval
+    latest = now + interval
+    expected = latest - (latest - phase - POLL_LAG) % POLL_PERIOD
+    return expected - now if expected - now >= POLL_MIN else interval
+
+# def feed_share_age(now)
+# return: 他のシャードが取得した共有フィードを取得し直さずに使う時間(秒)。各シャードの確認間隔の下限 POLL_MIN。
+#   更新時刻を学習済みなら、直前に予想される更新（の POLL_PHASE_SPREAD 秒前）より前に取得したものは使わない
+def feed_share_age(now):
+    phase = feed_phase(feed_history())
+    if phase is None:
+        return POLL_MIN
+    return min(POLL_MIN, (now - phase + POLL_PHASE_SPREAD) % POLL_PERIOD)
+
+# def schedule_next_poll()
+# 次にフィードを確認する時刻を決めて state.db の meta に保存する（cron の次回起動でも参照する）
+# return: 次の確認時刻(UNIX時刻)
+def schedule_next_poll():
+    open_state()
+    now = time.time()
+    next_poll = now + poll_delay(now)
+    state_db.execute("INSERT OR REPLACE INTO meta VALUES ('next_poll', ?)", (f"{next_poll:.1f}",))
+    state_db.commit()
+    set_gauge('jma_next_poll_timestamp_seconds', next_poll)
+    return next_poll
+
+# def oneshot_delay(now)
+# return: cron 起動時にフィードを確認するまで待つ秒数。次の確認時刻が次回の cron 起動以降なら None（今回は確認しない）
+def oneshot_delay(now):
+    open_state()
+    row = state_db.execute("SELECT value FROM meta WHERE key = 'next_poll'").fetchone()
+    if row is None:
+        return DELAY_START
+    delay = float(row[0]) - now
+    if CRON_INTERVAL <= delay <= POLL_MAX:
+        return None
+    return delay if 0 < delay < CRON_INTERVAL else 0.0	# 時計が戻った等で POLL_MAX を超える場合はすぐ確認する
+
+
+def run_measured(poll=True):
+    """run_once() を実行し、実行回数・所要時間をメトリクスに記録して METRICS_FILE へ書き出す。"""
+    start = time.time()
+    try:
+        run_once(poll)
+    finally:
+        count('jma_runs_total')
+        set_gauge('jma_last_run_timestamp_seconds', start)
+        set_gauge('jma_last_run_duration_seconds', time.time() - start)
+        write_metrics()
+
+
+def read_config():
+    """area.csv / post.csv を読み直す（デーモンの SIGHUP 時にも使用）。"""
+    global config_loaded
+    pref.clear(); area.clear(); acct_area.clear(); post_acct.clear()
+    read_area()
+    read_bs()
+    if bs_handles.CACHE_FILE != HANDLE_CACHE:
+        bs_handles.close_cache()
+        bs_handles.CACHE_FILE = HANDLE_CACHE
+    bs_session.SESSION_DIR, bs_session.BS_BASE_URL = SESSION_DIR, BS_BASE_URL
+    # 認証情報が変わっている可能性があるためクライアントは作り直す（セッションファイルは再利用）
+    bs_client.clear()
+    acct_template.clear()
+    config_loaded = True
+
+
+# def setup_shard(index, count, shard_dir)
+# --shard I/N: 状態（state.db・ledger・feed_state）とロックを SHARD_DIR/shard-I-N/ に分ける。
+# シャード毎の状態が無ければ、従来の state.db（無ければ従来のエリア別状態ファイル）から受け持ちのエリアの状態を引き継ぐ
+def setup_shard(index, count, shard_dir):
+    global SHARD_INDEX, SHARD_COUNT, SHARD_DIR, LAST_DIR, LOCK_FILE, DAEMON_LOCK_FILE, FEED_STATE, LAST_MODIFIED, \
+        STATE_DB, LEDGER_FILE
+    base_dir = LAST_DIR
+    base_state_db = STATE_DB
+    SHARD_INDEX, SHARD_COUNT = index, count
+    SHARD_DIR = os.path.join(shard_dir, '')
+    LAST_DIR = f"{SHARD_DIR}shard-{index}-{count}/"
+    LOCK_FILE = LAST_DIR + "lock"
+    DAEMON_LOCK_FILE = LAST_DIR + "daemon.lock"
+    FEED_STATE = LAST_DIR + "feed_state"
+    LAST_MODIFIED = LAST_DIR + "last_modified"
+    STATE_DB = LAST_DIR + "state.db"
+    LEDGER_FILE = LAST_DIR + "ledger"
+    if not os.path.exists(STATE_DB):
+        if os.path.exists(base_state_db):
+            seed_shard_state(base_state_db)
+        elif os.path.isdir(base_dir) and any(name.isdigit() for name in os.listdir(base_dir)):
+            seed_shard_files(base_dir)
+
+# def seed_shard_state(src)
+# シャードの state.db を初めて作る時、従来の state.db から受け持ちのエリアの状態・フィードの更新記録・
+# 最後にフィードを確認した時刻を写す（写さないと発表中の警報を新たな発表として投稿し直してしまう）。
+# 受け持ちのエリアの送信待ちの投稿は移す（従来の state.db からは消し、二重に送らない）
+def seed_shard_state(src):
+    read_config()
+    codes = [(int(a_code),) for p_name in shard_prefs for a_code in pref[p_name]]
+    db = load_state()
+    try:
+        db.execute('ATTACH DATABASE ? AS src', (src,))
+        db.executemany('INSERT OR REPLACE INTO last SELECT * FROM src.last WHERE area_code = ?', codes)
+        db.execute("INSERT OR REPLACE INTO meta SELECT * FROM src.meta WHERE key = 'last_check'")
+        db.execute('INSERT OR IGNORE INTO feed_updates SELECT modified FROM src.feed_updates')
+        columns = 'area_code, acct, report_time, lang, text, facets, state, attempts, next_try, created'
+        db.executemany(f"INSERT OR IGNORE INTO outbox ({columns}) SELECT {columns} FROM src.outbox "
+                       f"WHERE state = 'pending' AND area_code = ?", codes)
+        moved = db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+        db.executemany("DELETE FROM src.outbox WHERE state = 'pending' AND area_code = ?", codes)
+        db.commit()
+        syslog.syslog(syslog.LOG_INFO, f"Seeded shard {SHARD_INDEX}/{SHARD_COUNT} state from {src} "
+                                       f"({len(codes)} areas, {moved} pending posts).")
+    except sqlite3.Error as e:
+        db.rollback()
+        syslog.syslog(syslog.LOG_WARNING, f"Can't seed shard state from {src}: {e}")
+    finally:
+        db.close()
+
+# def seed_shard_files(src_dir)
+# 従来の state.db が無く、エリア別状態ファイル（state.db より前の形式）だけがある時に、受け持ちのエリアの分を
+# シャードの state.db へ取り込む
+def seed_shard_files(src_dir):
+    read_config()
+    codes = {int(a_code) for p_name in shard_prefs for a_code in pref[p_name]}
+    db = load_state()
+    try:
+        migrate_last_files(db, src_dir, codes)
+        db.commit()
+    finally:
+        db.close()
+
+# def lock_run()
+# return: 実行してよいか（他のプロセスが実行中なら False）
+#   シャード実行時は LOCK_FILE を fcntl.lockf で排他する。共有ディレクトリ上なら他のホストの同じシャードとも
+#   排他になり、プロセスが終了すればロックは解放される。従来の実行は LOCK_FILE の有無と更新時刻で判定する（厳密でない）
+def lock_run():
+    global lock_fd
+    if SHARD_COUNT > 1:
+        os.makedirs(LAST_DIR, exist_ok=True)
+        lock_fd = open(LOCK_FILE, 'a')
+        try:
+            fcntl.lockf(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_fd.close()
+            lock_fd = None
+            return False
+        return True
+    if os.path.exists(LOCK_FILE) and (os.stat(LOCK_FILE).st_mtime + LOCK_TIMEOUT > time.time()):
+        return False
+    touch_lock()
+    return True
+
+def touch_lock():
+    """従来のロックファイルの更新時刻を更新する（シャード実行時は fcntl のロックを持ち続けるので不要）。"""
+    if lock_fd is None:
+        with open(LOCK_FILE, "w"):
+            pass
+
+def unlock_run():
+    global lock_fd
+    if lock_fd is not None:
+        lock_fd.close()
+        lock_fd = None
+        return
+    try:
+        os.unlink(LOCK_FILE)
+    except FileNotFoundError:
+        pass
+
+
+def run_oneshot():
+    """cron から毎分起動される従来の1回実行モード。
+    フィードは schedule_next_poll() が決めた時刻に確認し、次回の cron 起動までに次の確認時刻が来れば
+    この実行の中で続けて確認する。確認時刻が次回の cron 起動以降なら outbox の送信だけを行う。"""
+    syslog.syslog(syslog.LOG_INFO, "START")
+    start = time.time()
+    delay = oneshot_delay(start)
+    if delay is None:
+        syslog.syslog(syslog.LOG_INFO, "SKIP: next feed check is after the next cron run.")
+    else:
+        time.sleep(delay)
+
+    # 排他制御
+    if not lock_run():
+        syslog.syslog(syslog.LOG_ERR, "Aborted by exclusion of lock file.")
+        return
+
+    try:
+        run_measured(delay is not None)
+        while delay is not None:
+            next_poll = schedule_next_poll()
+            if next_poll > start + CRON_INTERVAL - POLL_MIN:
+                break	# 次回の cron 起動に任せる
+            time.sleep(max(0.0, next_poll - time.time()))
+            touch_lock()
+            run_measured()
+    finally:
+        close_state()
+        unlock_run()
+    syslog.syslog(syslog.LOG_INFO, "END")
+
+
+def run_daemon():
+    """常駐モード。設定・HTTP セッション・Bluesky セッションを保持したまま schedule_next_poll() が決めた時刻毎に処理する。
+    SIGTERM/SIGINT: 処理中のサイクルを終えてから終了する。
+    SIGHUP        : 次のサイクルの前に area.csv / post.csv を読み直す。
+    """
+    stop = threading.Event()
+    reload = threading.Event()
+
+    def on_stop(signum, frame):
+        syslog.syslog(syslog.LOG_INFO, f"Received signal {signum}, stopping.")
+        stop.set()
+
+    def on_hup(signum, frame):
+        reload.set()
+
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+    signal.signal(signal.SIGHUP, on_hup)
+
+    # 常駐プロセスの二重起動防止（プロセス終了時にロックは自動で解放される）
+    # シャード実行時は1回実行モードと同じ LOCK_FILE のロックを常駐の間持ち続ける
+    os.makedirs(LAST_DIR, exist_ok=True)
+    daemon_fd = open(DAEMON_LOCK_FILE, 'w')
+    try:
+        fcntl.flock(daemon_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        syslog.syslog(syslog.LOG_ERR, "Aborted: another daemon is running.")
+        return
+    if SHARD_COUNT > 1 and not lock_run():
+        syslog.syslog(syslog.LOG_ERR, f"Aborted: shard {SHARD_INDEX}/{SHARD_COUNT} is running elsewhere.")
+        daemon_fd.close()
+        return
+
+    syslog.syslog(syslog.LOG_INFO, "START (daemon)")
+    metrics_server = start_metrics_server(METRICS_PORT) if METRICS_PORT else None
+    read_config()
+    while not stop.is_set():
+        if reload.is_set():
+            reload.clear()
+            syslog.syslog(syslog.LOG_INFO, "Reloading configuration.")
+            read_config()
+
+        # cron の1回実行モードが同時に走らないよう従来のロックファイルを更新し続ける
+        touch_lock()
+        try:
+            run_measured()
+            next_poll = schedule_next_poll()
+        except Exception as e:
+            syslog.syslog(syslog.LOG_ERR, f"Unexpected error in poll cycle: {e!r}")
+            count('jma_run_errors_total')
+            next_poll = time.time() + POLL_MIN
+        stop.wait(max(0.0, next_poll - time.time()))
+
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    close_state()
+    unlock_run()
+    daemon_fd.close()
+    syslog.syslog(syslog.LOG_INFO, "END (daemon)")
+
+
+def main():
+    global CORPUS_FILE, METRICS_FILE, METRICS_PORT, CATCHUP_POST_AGE, catchup_requested
+    parser = argparse.ArgumentParser(description='Post JMA weather warnings to Bluesky.')
+    parser.add_argument('--daemon', action='store_true',
+                        help=f'run continuously, polling the JMA feed every {POLL_MIN}-{POLL_MAX} seconds '
+                             'as the poll scheduler decides')
+    parser.add_argument('--record', metavar='ZIP',
+                        help='append every fetched feed and telegram to ZIP for bench/replay.py')
+    parser.add_argument('--catch-up', action='store_true',
+                        help=f'read the long feed ({os.path.basename(URL_JMA_LONG)}) on the first run even without a gap')
+    parser.add_argument('--catch-up-post-age', metavar='SECONDS', type=int,
+                        help='when catching up, only post changes newer than SECONDS and just update the state for '
+                             f'older ones (default {CATCHUP_POST_AGE}; 0: never post)')
+    parser.add_argument('--shard', metavar='I/N',
+                        help='process only the I-th of N groups of prefectures (0 <= I < N) with its own state '
+                             'and lock under --shard-dir; the shards share one feed download per cycle')
+    parser.add_argument('--shard-dir', metavar='DIR', default=LAST_DIR,
+                        help='directory shared by the shards (default %(default)s); put it on shared storage '
+                             '(e.g. NFS with POSIX locks) to run the shards on several hosts')
+    parser.add_argument('--metrics-file', metavar='PATH',
+                        help='write per-stage metrics in Prometheus text format to PATH after every run '
+                             '(e.g. a node_exporter textfile collector directory, *.prom)')
+    parser.add_argument('--metrics-port', metavar='PORT', type=int,
+                        help='with --daemon, also serve the metrics on http://:PORT/metrics')
+    args = parser.parse_args()
+    shard = None
+    if args.shard:
+        try:
+            shard = tuple(int(n) for n in args.shard.split('/'))
+        except ValueError:
+            shard = ()
+        if len(shard) != 2 or not 0 <= shard[0] < shard[1]:
+            parser.error(f"--shard: expected I/N with 0 <= I < N, got '{args.shard}'")
+
+    catchup_requested = args.catch_up
+    if args.catch_up_post_age is not None:
+        CATCHUP_POST_AGE = args.catch_up_post_age
+    if args.record:
+        CORPUS_FILE = args.record
+    if args.metrics_file:
+        METRICS_FILE = args.metrics_file
+    if args.metrics_port:
+        METRICS_PORT = args.metrics_port
+    if shard is not None and shard[1] > 1:
+        setup_shard(*shard, args.shard_dir)
+
+    if args.daemon:
+        run_daemon()
+    else:
+        run_oneshot()
+
 
-### END ###
+if __name__ == '__main__':
+    main()
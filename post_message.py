@@ -1,10 +1,19 @@
 #!/usr/bin/python3
+import argparse
 import csv
+import hashlib
+import json
+import os
+import queue
 import re
 import sys
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from atproto import Client, client_utils
 
+import bs_handles
+import bs_ratelimit
+
 # メッセージ中の @handle と URL を検出するための正規表現。
 # handle: 英数字・ハイフン・ドットから成り、語境界(直前が行頭または空白等)で始まるもの。
 TOKEN_RE = re.compile(
@@ -13,8 +22,10 @@ TOKEN_RE = re.compile(
 )
 
 POST_CSV = 'post.csv'
-POST_RETRY = 3
-POST_INTERVAL = 10
+POST_RETRY = 3  # 試行回数（再試行の間隔は bs_ratelimit が 429・5xx に応じて決める）
+BS_BASE_URL = os.environ.get('BS_BASE_URL')  # 投稿先 PDS（None: bsky.social）
+BULK_WORKERS = 8  # --bulk: 同時に投稿するアカウント数の上限
+BULK_QUEUE = 100  # --bulk: アカウント毎に読み込んでおく行数の上限（入力を読む速さを投稿の速さに合わせる）
 
 
 def read_post_csv():
@@ -33,10 +44,27 @@ def read_post_csv():
     return credentials
 
 
+def mentioned_handles(message):
+    return [m.group(0)[1:] for m in TOKEN_RE.finditer(message) if m.lastgroup == 'mention']
+
+
+def resolve_handles(client, handles):
+    # ハンドルを DID に解決する（bs_handles のキャッシュに無いものだけを並列に問い合わせる）。
+    # 解決できないハンドルは警告を出し、値を None とする。
+    errors = {}
+    dids = bs_handles.resolve_all(client, handles, lambda handle, e: errors.setdefault(handle, e))
+    for handle, did in dids.items():
+        if did is None:
+            reason = errors.get(handle, 'cached as unresolvable')
+            print(f"Warning: Cannot resolve handle '{handle}': {reason}", file=sys.stderr)
+    return dids
+
+
 def build_rich_text(client, message):
     # メッセージを @handle / URL / 通常テキストに分割し、TextBuilder を組み立てる。
     # メンションはハンドルを DID に解決して mention facet を付与する。
     # URL は link facet を付与する。解決に失敗した場合はプレーンテキストとして扱う。
+    dids = resolve_handles(client, mentioned_handles(message))
     tb = client_utils.TextBuilder()
     pos = 0
     for m in TOKEN_RE.finditer(message):
@@ -44,12 +72,10 @@ def build_rich_text(client, message):
             tb.text(message[pos:m.start()])
         token = m.group(0)
         if m.lastgroup == 'mention':
-            handle = token[1:]  # 先頭の '@' を除く
-            try:
-                did = client.com.atproto.identity.resolve_handle({'handle': handle}).did
+            did = dids.get(token[1:])  # 先頭の '@' を除く
+            if did:
                 tb.mention(token, did)
-            except Exception as e:
-                print(f"Warning: Cannot resolve handle '{handle}': {e}", file=sys.stderr)
+            else:
                 tb.text(token)
         else:  # url
             tb.link(token, token)
@@ -59,49 +85,242 @@ def build_rich_text(client, message):
     return tb
 
 
-def post_message(username, password, message):
+def post_message(account, username, password, message):
+    # ログイン・投稿はそれぞれ bs_ratelimit.call() で再試行する（認証エラーは再試行しない）。
     try:
-        client = Client()
-        client.login(username, password)
-        client.send_post(build_rich_text(client, message))
+        client = Client(BS_BASE_URL, request=bs_ratelimit.new_request(account))
+        bs_ratelimit.call(lambda: client.login(username, password), POST_RETRY)
+        tb = build_rich_text(client, message)
+        bs_ratelimit.call(lambda: client.send_post(tb), POST_RETRY)
     except Exception as e:
         print(f"Error: Failed to post: {e}", file=sys.stderr)
         return 1
     return 0
 
 
-def main():
-    if len(sys.argv) < 2:
-        print(f"Usage: {sys.argv[0]} <input_csv>", file=sys.stderr)
+# def read_rows(input_file, fmt, warn=True)
+# 入力を1件ずつ読み (行番号, account, message) を返す（全件をメモリに読み込まない）。
+#   csv  : account,message（メッセージ中の改行は "" で囲む）  行番号は CSV のレコード番号
+#   jsonl: {"account": ..., "message": ...} を1行に1件
+# warn: 不正な行の警告を出すか（同じ入力を2回読む時、2回目以降は False）
+def read_rows(input_file, fmt, warn=True):
+    with open(input_file, 'r', encoding='utf-8') as f:
+        if fmt == 'jsonl':
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                    yield n, str(row['account']), str(row['message'])
+                except (ValueError, KeyError, TypeError) as e:
+                    if warn:
+                        print(f"Warning: Invalid JSON at line {n}, skipping: {e}", file=sys.stderr)
+        else:
+            for n, row in enumerate(csv.reader(f), 1):
+                if len(row) >= 2:
+                    yield n, row[0], row[1]
+
+
+def row_key(account, message, occurrence):
+    # 再開時に同じ投稿かどうかを判定するためのキー（入力の行番号がずれても一致する）
+    # occurrence: 同じアカウント・同じメッセージの何件目か（同一内容の投稿を区別する）
+    return hashlib.sha256(f"{account}\0{message}".encode()).hexdigest()[:16] + f".{occurrence}"
+
+
+# def read_posted(results_file)
+# return: 前回の結果ファイルで投稿済み(posted)となっている row_key の集合
+def read_posted(results_file):
+    posted = set()
+    try:
+        with open(results_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue  # 中断時に書きかけだった行
+                if result.get('status') == 'posted':
+                    posted.add(result.get('key'))
+    except (FileNotFoundError, IOError) as e:
+        print(f"Error: Cannot read {results_file}: {e}", file=sys.stderr)
         sys.exit(1)
+    return posted
+
+
+# def post_account_rows(account, rows, session, credential, write_result, idle)
+# 1アカウント分の投稿を入力順に送る。ログインはアカウント毎に1回だけ行い、結果を session に残す。
+# rows: (行番号, message, key) を入れる Queue。idle() が True を返したら（rows が空）終わる
+def post_account_rows(account, rows, session, credential, write_result, idle):
+    if not session:
+        session['client'] = Client(BS_BASE_URL, request=bs_ratelimit.new_request(account))
+        session['error'] = None
+        try:
+            bs_ratelimit.call(lambda: session['client'].login(credential['username'], credential['password']),
+                              POST_RETRY)
+        except Exception as e:
+            print(f"Error: Cannot log in to '{account}': {e}", file=sys.stderr)
+            session['error'] = f"login: {e}"
+    client, login_error = session['client'], session['error']
 
-    input_csv = sys.argv[1]
+    try:
+        while not idle():
+            n, message, key = rows.get()
+            if login_error is not None:
+                write_result(n, account, key, 'failed', error=login_error)
+                continue
+            try:
+                tb = build_rich_text(client, message)
+                resp = bs_ratelimit.call(lambda: client.send_post(tb), POST_RETRY)
+            except Exception as e:
+                print(f"Error: Failed to post row {n} to '{account}': {e}", file=sys.stderr)
+                write_result(n, account, key, 'failed', error=str(e))
+                continue
+            print(f"Posted to {account}: {message[:50]}{'...' if len(message) > 50 else ''}")
+            write_result(n, account, key, 'posted', uri=resp.uri)
+    except BaseException:
+        # 想定外のエラー: 入力を読む側が止まらないよう残りの行を捨てる（結果は書かないので --resume で再送される）
+        while not idle():
+            rows.get()
+        raise
+
+
+# def bulk_main(args)
+# 入力を読みながらアカウント毎のキューに振り分け、アカウント間は並列、アカウント内は入力順に投稿する。
+# 結果は1件毎に args.results へ JSON Lines で書き出す（--resume で投稿済みの行を飛ばす）。
+def bulk_main(args):
     credentials = read_post_csv()
+    posted = read_posted(args.resume) if args.resume else set()
 
+    # 全行のメンション先を投稿を始める前にまとめて解決しておく（入力を一度読み流し、ハンドルだけを集める）
     try:
-        with open(input_csv, 'r', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                if len(row) < 2:
-                    continue
-                account, message = row[0], row[1]
-                if account not in credentials:
-                    print(f"Warning: No credentials for account '{account}', skipping.", file=sys.stderr)
-                    continue
-                username = credentials[account]['username']
-                password = credentials[account]['password']
-                for attempt in range(POST_RETRY):
-                    result = post_message(username, password, message)
-                    if result == 0:
-                        print(f"Posted to {account}: {message[:50]}{'...' if len(message) > 50 else ''}")
-                        break
-                    if attempt < POST_RETRY - 1:
-                        time.sleep(POST_INTERVAL)
-                else:
-                    print(f"Error: Aborted posting to '{account}' after {POST_RETRY} attempts.", file=sys.stderr)
+        handles = {handle for _, account, message in read_rows(args.input, args.format, warn=False)
+                   if account in credentials for handle in mentioned_handles(message)}
     except (FileNotFoundError, IOError) as e:
-        print(f"Error: Cannot read {input_csv}: {e}", file=sys.stderr)
+        print(f"Error: Cannot read {args.input}: {e}", file=sys.stderr)
         sys.exit(1)
+    if handles:
+        resolve_handles(Client(BS_BASE_URL, request=bs_ratelimit.new_request('')), handles)
+
+    counts = {'posted': 0, 'failed': 0, 'skipped': 0}
+    lock = threading.Lock()
+
+    try:
+        results = open(args.results, 'a', encoding='utf-8')
+    except IOError as e:
+        print(f"Error: Cannot write {args.results}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    def write_result(n, account, key, status, **extra):
+        line = json.dumps({'row': n, 'account': account, 'key': key, 'status': status, **extra}, ensure_ascii=False)
+        with lock:
+            counts[status] += 1
+            results.write(line + '\n')
+            results.flush()
+
+    queues = {}  # account => Queue
+    sessions = {}  # account => {'client': Client, 'error': ログインの失敗}
+    active = set()  # ワーカーが動いている（または開始待ちの）アカウント
+    futures = []
+    occurrences = {}  # (account, message) => 出現回数
+
+    # ワーカーは rows が空になると終わり、次の行が来たら dispatch() が開始し直す。
+    # 行を入れたまま止まっているワーカーは無いので、キューが一杯でも put() はいずれ戻る
+    def idle(account):
+        with lock:
+            if queues[account].empty():
+                active.discard(account)
+                return True
+        return False
+
+    def dispatch(executor, n, account, message, key):
+        if account not in queues:
+            queues[account] = queue.Queue(maxsize=BULK_QUEUE)
+            sessions[account] = {}
+        queues[account].put((n, message, key))
+        with lock:
+            if account not in active:
+                active.add(account)
+                futures.append(executor.submit(post_account_rows, account, queues[account], sessions[account],
+                                               credentials[account], write_result, lambda: idle(account)))
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            try:
+                for n, account, message in read_rows(args.input, args.format):
+                    occurrences[account, message] = occurrences.get((account, message), 0) + 1
+                    key = row_key(account, message, occurrences[account, message])
+                    if key in posted:
+                        with lock:
+                            counts['skipped'] += 1
+                        continue
+                    if account not in credentials:
+                        print(f"Warning: No credentials for account '{account}', skipping.", file=sys.stderr)
+                        write_result(n, account, key, 'failed', error='no credentials')
+                        continue
+                    dispatch(executor, n, account, message, key)
+            except (FileNotFoundError, IOError) as e:
+                print(f"Error: Cannot read {args.input}: {e}", file=sys.stderr)
+    finally:
+        results.close()
+
+    worker_errors = 0
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Error: Worker failed: {e!r}", file=sys.stderr)
+            worker_errors += 1
+
+    print(f"posted={counts['posted']}, failed={counts['failed']}, skipped={counts['skipped']}, "
+          f"accounts={len(queues)}, results={args.results}", file=sys.stderr)
+    sys.exit(1 if counts['failed'] or worker_errors else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Post messages to Bluesky accounts listed in post.csv.')
+    parser.add_argument('input', help='input file: CSV (account,message) or, with --format jsonl, JSON Lines')
+    parser.add_argument('--bulk', action='store_true',
+                        help='log in once per account and post to several accounts in parallel')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default=None,
+                        help='input format (default: jsonl for *.jsonl, otherwise csv)')
+    parser.add_argument('--workers', type=int, default=BULK_WORKERS,
+                        help='--bulk: accounts posted to in parallel (default: %(default)s)')
+    parser.add_argument('--results', default=None,
+                        help='--bulk: append one JSON line per row to this file (default: INPUT.results.jsonl)')
+    parser.add_argument('--resume', metavar='RESULTS',
+                        help='--bulk: skip rows recorded as posted in RESULTS')
+    args = parser.parse_args()
+    if args.format is None:
+        args.format = 'jsonl' if args.input.endswith('.jsonl') else 'csv'
+
+    if args.bulk or args.resume:
+        if args.results is None:
+            args.results = args.input + '.results.jsonl'
+        bulk_main(args)
+        return
+
+    credentials = read_post_csv()
+
+    try:
+        rows = list(read_rows(args.input, args.format))
+    except (FileNotFoundError, IOError) as e:
+        print(f"Error: Cannot read {args.input}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    # 全メッセージのメンション先を先にまとめて解決しておく（同じハンドルは1回だけ問い合わせる）
+    handles = [handle for _, _, message in rows for handle in mentioned_handles(message)]
+    if handles:
+        bs_handles.resolve_all(Client(BS_BASE_URL, request=bs_ratelimit.new_request('')), handles)
+
+    for _, account, message in rows:
+        if account not in credentials:
+            print(f"Warning: No credentials for account '{account}', skipping.", file=sys.stderr)
+            continue
+        username = credentials[account]['username']
+        password = credentials[account]['password']
+        if post_message(account, username, password, message) == 0:
+            print(f"Posted to {account}: {message[:50]}{'...' if len(message) > 50 else ''}")
+        else:
+            print(f"Error: Aborted posting to '{account}'.", file=sys.stderr)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,212 @@
+import itertools
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jma
+from jma import (code_kind, code_kind_e, status_ja_en, ww_wa, wa_ww, ww_wuw, wuw_ww, wuw_wew, wew_wuw,
+                 wa_wuw, wuw_wa, wew_ww, ww_wew, wew_wa, wa_wew)
+
+KINDS = ['wa', 'ww', 'wuw', 'wew']
+AREA_CODE = '1310100'
+CASES = 23592	# 全系列の組合せの数（遷移表・コード表を変えたら数え直す）
+
+
+# ── 従来の実装（比較用） ─────────────────────────────────────────────
+def compare_and_post_legacy(area_code_text, report_time, current, responsible, ref_last):
+    area = jma.area
+    wa = {}; ww = {}; wuw = {}; wew = {}
+    ewa = {}; eww = {}; ewuw = {}; ewew = {}
+    f_wa = 0; f_ww = 0; f_wuw = 0; f_wew = 0
+
+    for kind_str in ['wa', 'ww', 'wuw', 'wew']:
+        code_min       = {'wa': 10, 'ww':  2, 'wuw': 40, 'wew': 30}[kind_str]
+        code_max       = {'wa': 29, 'ww':  9, 'wuw': 49, 'wew': 39}[kind_str]
+        kind_down_str  = {'wa': None, 'ww': 'wa',  'wuw': 'ww',  'wew': 'wuw'}[kind_str]
+        kind_down2_str = {'wa': None, 'ww': None,  'wuw': 'wa',  'wew': 'ww' }[kind_str]
+        kind_down3_str = {'wa': None, 'ww': None,  'wuw': None,  'wew': 'wa' }[kind_str]
+        kind_up_str    = {'wa': 'ww', 'ww': 'wuw', 'wuw': 'wew', 'wew': None}[kind_str]
+        kind_up2_str   = {'wa': 'wuw','ww': 'wew', 'wuw': None,  'wew': None}[kind_str]
+        kind_up3_str   = {'wa': 'wew','ww': None,  'wuw': None,  'wew': None}[kind_str]
+        ref_to_down    = {'wa': {},    'ww': ww_wa,  'wuw': wuw_ww,  'wew': wew_wuw}[kind_str]
+        ref_to_down2   = {'wa': {},    'ww': {},     'wuw': wuw_wa,  'wew': wew_ww }[kind_str]
+        ref_to_down3   = {'wa': {},    'ww': {},     'wuw': {},      'wew': wew_wa }[kind_str]
+        ref_to_up      = {'wa': wa_ww, 'ww': ww_wuw, 'wuw': wuw_wew,'wew': {}     }[kind_str]
+        ref_to_up2     = {'wa': wa_wuw,'ww': ww_wew, 'wuw': {},     'wew': {}     }[kind_str]
+        ref_to_up3     = {'wa': wa_wew,'ww': {},     'wuw': {},     'wew': {}     }[kind_str]
+        ref_kind_out   = {'wa': wa,  'ww': ww,  'wuw': wuw, 'wew': wew }[kind_str]
+        ref_kind_out_e = {'wa': ewa, 'ww': eww, 'wuw': ewuw,'wew': ewew}[kind_str]
+
+        for c in range(code_min, code_max + 1):
+            code = f"{c:02d}"
+            if code in ref_last.get(kind_str, {}):
+                if code in current[kind_str]:
+                    status = '継続'
+                else:
+                    if responsible is not None and code not in responsible[kind_str]:
+                        ref_kind_out[code]   = f"{code_kind.get(code, code)},継続"
+                        ref_kind_out_e[code] = f"{code_kind_e.get(code, code)},{status_ja_en['継続']}"
+                        continue
+                    key   = ref_to_up.get(code)    if ref_to_up   else None
+                    key2  = ref_to_up2.get(code)   if ref_to_up2  else None
+                    key3  = ref_to_up3.get(code)   if ref_to_up3  else None
+                    keyd  = ref_to_down.get(code)  if ref_to_down  else None
+                    keyd2 = ref_to_down2.get(code) if ref_to_down2 else None
+                    keyd3 = ref_to_down3.get(code) if ref_to_down3 else None
+                    if   kind_up_str   and current.get(kind_up_str)   and key   is not None and key   in current[kind_up_str]:
+                        status = ref_to_up['status']
+                    elif kind_up2_str  and current.get(kind_up2_str)  and key2  is not None and key2  in current[kind_up2_str]:
+                        status = ref_to_up2['status']
+                    elif kind_up3_str  and current.get(kind_up3_str)  and key3  is not None and key3  in current[kind_up3_str]:
+                        status = ref_to_up3['status']
+                    elif kind_down_str  and current.get(kind_down_str)  and keyd  is not None and keyd  in current[kind_down_str]:
+                        status = ref_to_down['status']
+                    elif kind_down2_str and current.get(kind_down2_str) and keyd2 is not None and keyd2 in current[kind_down2_str]:
+                        status = ref_to_down2['status']
+                    elif kind_down3_str and current.get(kind_down3_str) and keyd3 is not None and keyd3 in current[kind_down3_str]:
+                        status = ref_to_down3['status']
+                    else:
+                        status = '解除'
+                    if   kind_str == 'wa':  f_wa  = 1
+                    elif kind_str == 'ww':  f_ww  = 1
+                    elif kind_str == 'wuw': f_wuw = 1
+                    elif kind_str == 'wew': f_wew = 1
+                ref_kind_out[code]   = f"{code_kind[code]}{current[kind_str].get(code, '')},{status}"
+                ref_kind_out_e[code] = f"{code_kind_e[code]},{status_ja_en[status]}"
+            elif code in current[kind_str]:
+                key   = ref_to_up.get(code)    if ref_to_up   else None
+                key2  = ref_to_up2.get(code)   if ref_to_up2  else None
+                key3  = ref_to_up3.get(code)   if ref_to_up3  else None
+                keyd  = ref_to_down.get(code)  if ref_to_down  else None
+                keyd2 = ref_to_down2.get(code) if ref_to_down2 else None
+                keyd3 = ref_to_down3.get(code) if ref_to_down3 else None
+                if   kind_up_str   and ref_last.get(kind_up_str,   {}) and key   is not None and key   in ref_last[kind_up_str]:
+                    status = ref_to_up['rstatus']
+                elif kind_up2_str  and ref_last.get(kind_up2_str,  {}) and key2  is not None and key2  in ref_last[kind_up2_str]:
+                    status = ref_to_up2['rstatus']
+                elif kind_up3_str  and ref_last.get(kind_up3_str,  {}) and key3  is not None and key3  in ref_last[kind_up3_str]:
+                    status = ref_to_up3['rstatus']
+                elif kind_down_str  and ref_last.get(kind_down_str,  {}) and keyd  is not None and keyd  in ref_last[kind_down_str]:
+                    status = ref_to_down['rstatus']
+                elif kind_down2_str and ref_last.get(kind_down2_str, {}) and keyd2 is not None and keyd2 in ref_last[kind_down2_str]:
+                    status = ref_to_down2['rstatus']
+                elif kind_down3_str and ref_last.get(kind_down3_str, {}) and keyd3 is not None and keyd3 in ref_last[kind_down3_str]:
+                    status = ref_to_down3['rstatus']
+                else:
+                    status = '発表'
+                if   kind_str == 'wa':  f_wa  = 1
+                elif kind_str == 'ww':  f_ww  = 1
+                elif kind_str == 'wuw': f_wuw = 1
+                elif kind_str == 'wew': f_wew = 1
+                ref_kind_out[code]   = f"{code_kind[code]}{current[kind_str][code]},{status}"
+                ref_kind_out_e[code] = f"{code_kind_e[code]},{status_ja_en[status]}"
+
+    acct = {}
+    if f_wa:
+        if wa  and area[area_code_text][0]: acct[area[area_code_text][0]] = wa
+        if ewa and area[area_code_text][4]: acct[area[area_code_text][4]] = ewa
+    if f_ww:
+        if ww  and area[area_code_text][1]: acct[area[area_code_text][1]] = ww
+        if eww and area[area_code_text][5]: acct[area[area_code_text][5]] = eww
+    if f_wuw:
+        if wuw and area[area_code_text][2]: acct[area[area_code_text][2]] = wuw
+        if ewuw and area[area_code_text][6]: acct[area[area_code_text][6]] = ewuw
+    if f_wew:
+        if wew and area[area_code_text][3]: acct[area[area_code_text][3]] = wew
+        if ewew and area[area_code_text][7]: acct[area[area_code_text][7]] = ewew
+    if f_wa or f_ww or f_wuw or f_wew:
+        jma.write_last(area_code_text, wa, ww, wuw, wew, report_time)
+    return acct
+
+
+# ── 組合せの生成 ─────────────────────────────────────────────────────
+def kind_of(code):
+    return next(k for k, (lo, hi) in jma.KIND_CODE_RANGE.items() if lo <= int(code) <= hi)
+
+
+def code_families():
+    """遷移表でつながるコードの系列（例: {'10', '03', '43', '33'}）を返す。"""
+    tables = [ww_wa, wa_ww, ww_wuw, wuw_ww, wuw_wew, wew_wuw, wa_wuw, wuw_wa, wew_ww, ww_wew, wew_wa, wa_wew]
+    parent = {code: code for code in code_kind}
+
+    def find(c):
+        while parent[c] != c:
+            c = parent[c]
+        return c
+
+    for table in tables:
+        for src, dst in table.items():
+            if src in parent and dst in parent:
+                parent[find(src)] = find(dst)
+    families = {}
+    for code in code_kind:
+        families.setdefault(find(code), []).append(code)
+    return sorted(families.values())
+
+
+def state(codes, condition=''):
+    st = {k: {} for k in KINDS}
+    for code in codes:
+        st[kind_of(code)][code] = condition
+    return st
+
+
+def subsets(codes):
+    return itertools.chain.from_iterable(itertools.combinations(codes, n) for n in range(len(codes) + 1))
+
+
+def cases():
+    """同じ遷移系列（例: 10/03/43/33 の大雨）に属するコードごとに、前回・今回の有無と注意事項、担当コード
+    (responsible)の全組合せを (current, responsible, ref_last) で返す。系列をまたぐ遷移規則は無いため、
+    系列ごとの全組合せで全コードの組合せを網羅する。"""
+    for family in code_families():
+        responsibles = [None] + [{k: set(r) & {c for c in code_kind if kind_of(c) == k} for k in KINDS}
+                                 for r in subsets(family)]
+        for last_codes in subsets(family):
+            ref_last = state(last_codes)
+            ref_last['time'] = 100
+            for cur_codes in subsets(family):
+                for condition in ('', '土砂災害'):
+                    current = state(cur_codes, condition)
+                    for responsible in responsibles:
+                        yield current, responsible, ref_last
+
+
+class CompareEquivalenceTest(unittest.TestCase):
+    """compare_and_post() が従来の全コード走査・if/elif 方式と同じ投稿・状態の書込みをする。"""
+
+    def setUp(self):
+        self.write_last = jma.write_last
+        self.saved_area = jma.area.get(AREA_CODE)
+        self.written = []
+        jma.area[AREA_CODE] = [f'acct{i}' for i in range(8)]
+        jma.write_last = lambda *args: self.written.append(args)
+
+    def tearDown(self):
+        jma.write_last = self.write_last
+        if self.saved_area is None:
+            jma.area.pop(AREA_CODE, None)
+        else:
+            jma.area[AREA_CODE] = self.saved_area
+
+    def run_both(self, current, responsible, ref_last):
+        results = []
+        for func in (jma.compare_and_post, compare_and_post_legacy):
+            self.written.clear()
+            acct = func(AREA_CODE, 200, current, responsible, ref_last)
+            results.append((acct, list(self.written)))
+        return results
+
+    def test_all_combinations(self):
+        n = 0
+        for current, responsible, ref_last in cases():
+            new, old = self.run_both(current, responsible, ref_last)
+            if new != old:
+                self.fail(f'last={ref_last} current={current} responsible={responsible}: {new} != {old}')
+            n += 1
+        self.assertEqual(n, CASES)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bs_ratelimit
+import jma
+
+SAVED = ('LAST_DIR', 'STATE_DB', 'config_loaded')
+
+
+class DrainOrderTest(unittest.TestCase):
+    """再送待ちの投稿があるアカウントは、後の投稿を先に送らない。"""
+
+    def setUp(self):
+        self.saved = {name: getattr(jma, name) for name in SAVED}
+        self.dir = tempfile.TemporaryDirectory()
+        jma.close_state()
+        jma.LAST_DIR = self.dir.name + '/'
+        jma.STATE_DB = jma.LAST_DIR + 'state.db'
+        jma.config_loaded = True
+        jma.breaker.update(failures=0, until=0, probing=False)
+        self.post_bs = jma.post_bs
+        self.sent = []
+        self.failing = set()
+        jma.post_bs = self.fake_post_bs
+
+        jma.open_state()
+        now = int(time.time())
+        for report_time, text in ((now - 60, 'first'), (now - 30, 'second')):
+            jma.state_db.execute('INSERT INTO outbox (area_code, acct, report_time, lang, text, facets, created) '
+                                 "VALUES (1310100, 'acct', ?, 'ja-JP', ?, '[]', ?)", (report_time, text, now))
+        jma.state_db.commit()
+
+    def tearDown(self):
+        jma.post_bs = self.post_bs
+        jma.close_state()
+        for name, value in self.saved.items():
+            setattr(jma, name, value)
+        jma.breaker.update(failures=0, until=0, probing=False)
+        self.dir.cleanup()
+
+    def fake_post_bs(self, text, facets, lang, acct, deadline=None):
+        if text in self.failing:
+            return 1
+        self.sent.append(text)
+        return 0
+
+    def pending(self):
+        return [text for (text,) in jma.state_db.execute(
+            "SELECT text FROM outbox WHERE state = 'pending' ORDER BY report_time")]
+
+    def test_later_post_waits_for_failed_post(self):
+        self.failing.add('first')
+        jma.drain_outbox()
+        self.assertEqual(self.sent, [])
+
+        # 'first' は再送待ち（next_try が先）。'second' は送れる時刻だが、順序を保つため送らない
+        self.failing.clear()
+        jma.drain_outbox()
+        self.assertEqual(self.sent, [])
+        self.assertEqual(self.pending(), ['first', 'second'])
+
+        jma.state_db.execute("UPDATE outbox SET next_try = 0")
+        jma.state_db.commit()
+        jma.drain_outbox()
+        self.assertEqual(self.sent, ['first', 'second'])
+        self.assertEqual(self.pending(), [])
+
+    def test_deadline_leaves_post_pending(self):
+        # リセットまで 60 秒止められたアカウント。drain の期限(1秒)を過ぎるので待たずに次回へ回す
+        jma.post_bs = self.post_bs
+        post_once, drain_time = jma.post_once, jma.OUTBOX_DRAIN_TIME
+        jma.post_once = lambda text, facets, lang, acct: bs_ratelimit.acquire(('acct', acct))
+        jma.OUTBOX_DRAIN_TIME = 1
+        bs_ratelimit.refill(('acct', 'acct'), time.monotonic())[2] = time.monotonic() + 60
+        try:
+            start = time.monotonic()
+            jma.drain_outbox()
+            self.assertLess(time.monotonic() - start, 10)	# 60 秒の停止を待たない（初回は atproto の読込みを含む）
+        finally:
+            jma.post_once, jma.OUTBOX_DRAIN_TIME = post_once, drain_time
+            bs_ratelimit.buckets.clear()
+        self.assertEqual(self.pending(), ['first', 'second'])
+        self.assertEqual(list(jma.state_db.execute("SELECT DISTINCT attempts, next_try FROM outbox")), [(0, 0)])
+        self.assertEqual(jma.breaker['failures'], 0)
+
+    def test_breaker_gauge_after_cooldown(self):
+        # 停止時間が過ぎていれば、試行が成功して停止が解除される前でも送信は止まっていない
+        jma.state_db.execute("INSERT OR REPLACE INTO meta VALUES ('breaker', ?)",
+                             (f"{jma.BREAKER_THRESHOLD} {int(time.time()) - 1}",))
+        jma.state_db.execute("UPDATE outbox SET next_try = ?", (int(time.time()) + 600,))
+        jma.state_db.commit()
+        jma.drain_outbox()
+        self.assertTrue(jma.breaker['until'])
+        self.assertEqual(jma.metric_gauge['jma_breaker_open'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import concurrent.futures
+import os
+import queue
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jma
+
+LINKS = {f'http://127.0.0.1:9/data/{n}_VPWW54_130000.xml': {'1310100': {}} for n in range(3)}
+
+
+class StageFailureTest(unittest.TestCase):
+    """段のスレッドが例外で止まっても集約段は待ち続けず、届かなかった電文を処理済みとしない。"""
+
+    def setUp(self):
+        self.saved = jma.fetch_xml, jma.parse_stage, jma.LAST_DIR, jma.STATE_DB
+        self.dir = tempfile.TemporaryDirectory()
+        jma.close_state()
+        jma.LAST_DIR = self.dir.name + '/'
+        jma.STATE_DB = jma.LAST_DIR + 'state.db'
+        jma.fetch_xml = lambda url: b'<Report/>'
+
+    def tearDown(self):
+        jma.close_state()
+        jma.fetch_xml, jma.parse_stage, jma.LAST_DIR, jma.STATE_DB = self.saved
+        self.dir.cleanup()
+
+    def run_pipeline(self):
+        result = []
+
+        def target():	# state.db は開いたスレッドで閉じる
+            result.append(jma.run_pipeline(LINKS))
+            jma.close_state()
+
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), 'run_pipeline() did not return')
+        return result[0]
+
+    def test_parse_stage_fails(self):
+        def parse_stage(links, ref_links, fetched, parsed, stop):
+            jma.pipeline_put(parsed, (1, None, None), stop)
+            raise MemoryError('parse stage')
+        parse_stage.__name__ = 'parse_stage'
+        jma.parse_stage = parse_stage
+        self.assertEqual(self.run_pipeline(), ([], 0, 0))
+
+    def test_parse_stage_returns_early(self):
+        jma.parse_stage = lambda links, ref_links, fetched, parsed, stop: None
+        self.assertEqual(self.run_pipeline(), ([], 0, 0))
+
+
+class BrokenPool:
+    """submit() した電文が解析プロセスの異常終了(BrokenProcessPool)で失敗するプロセスプール。"""
+
+    def __init__(self, *args, **kwargs):
+        self.submitted = 0
+
+    def submit(self, func, *args):
+        from concurrent.futures.process import BrokenProcessPool
+        self.submitted += 1
+        if self.submitted > 2:
+            raise BrokenProcessPool('pool is broken')
+        future = concurrent.futures.Future()
+        future.set_exception(BrokenProcessPool('worker died'))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+class ParsePoolFallbackTest(unittest.TestCase):
+    """解析プロセスが使えない時は、残りの電文をスレッドで解析する。"""
+
+    def setUp(self):
+        self.saved = concurrent.futures.ProcessPoolExecutor, jma.parse_xml, jma.PARSE_PROCESSES
+        jma.parse_xml = lambda content, ref_area: {'parsed': content}
+        jma.PARSE_PROCESSES = 2
+
+    def tearDown(self):
+        concurrent.futures.ProcessPoolExecutor, jma.parse_xml, jma.PARSE_PROCESSES = self.saved
+
+    def parse_all(self, n):
+        links = [f'http://127.0.0.1:9/data/{i}.xml' for i in range(n)]
+        fetched, parsed, stop = queue.Queue(), queue.Queue(), threading.Event()
+        for i in range(n):
+            fetched.put((i, str(i).encode()))
+        jma.parse_stage_pool(links, {link: {} for link in links}, fetched, parsed, stop)
+        return sorted(parsed.get_nowait() for _ in range(parsed.qsize()))
+
+    def test_broken_pool(self):
+        concurrent.futures.ProcessPoolExecutor = BrokenPool
+        self.assertEqual(self.parse_all(6), [(i, str(i).encode(), {'parsed': str(i).encode()}) for i in range(6)])
+
+    def test_pool_cannot_start(self):
+        def fail(*args, **kwargs):
+            raise OSError('cannot start processes')
+        concurrent.futures.ProcessPoolExecutor = fail
+        self.assertEqual(self.parse_all(3), [(i, str(i).encode(), {'parsed': str(i).encode()}) for i in range(3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
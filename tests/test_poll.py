@@ -0,0 +1,98 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jma
+
+START = 1792285200	# 2026-10-18 10:00:00 JST（毎分0秒）
+PHASE = 20	# フィードが更新される毎分の秒
+SAVED = ('LAST_DIR', 'STATE_DB')
+
+
+class ActivePollTest(unittest.TestCase):
+    """更新が続いている間も、学習した更新時刻に合わせて確認する。"""
+
+    def setUp(self):
+        self.saved = {name: getattr(jma, name) for name in SAVED}
+        self.dir = tempfile.TemporaryDirectory()
+        jma.close_state()
+        jma.LAST_DIR = self.dir.name + '/'
+        jma.STATE_DB = jma.LAST_DIR + 'state.db'
+        for minute in range(-jma.POLL_SAMPLES - 5, 0):
+            jma.record_feed_update(START + minute * 60 + PHASE)
+
+    def tearDown(self):
+        jma.close_state()
+        for name, value in self.saved.items():
+            setattr(jma, name, value)
+        self.dir.cleanup()
+
+    def simulate(self, updates, minutes):
+        """updates の時刻にフィードが更新される時の確認時刻を辿り、(確認回数, 更新を検出するまでの秒数) を返す。"""
+        now = START + PHASE + jma.POLL_LAG
+        seen = START - 60 + PHASE
+        polls, latency = 0, []
+        while now < START + minutes * 60:
+            polls += 1
+            latest = max(u for u in updates if u <= now)
+            if latest > seen:
+                jma.record_feed_update(latest)
+                latency.append(now - latest)
+                seen = latest
+            now += jma.poll_delay(now)
+        return polls, latency
+
+    def test_regular_updates(self):
+        minutes = 10
+        updates = [START + minute * 60 + PHASE for minute in range(-1, minutes)]
+        polls, latency = self.simulate(updates, minutes)
+        self.assertLessEqual(polls, minutes + 1)	# 毎分1回（POLL_MIN 毎なら 12回/分）
+        self.assertEqual(len(latency), minutes)
+        self.assertLessEqual(max(latency), jma.POLL_LAG)
+
+    def test_late_update(self):
+        # 更新が POLL_LAG より遅れた分は POLL_MIN 後の確認で拾う
+        minutes = 5
+        updates = [START + minute * 60 + PHASE + (jma.POLL_PHASE_SPREAD + 2 if minute == 2 else 0)
+                   for minute in range(-1, minutes)]
+        polls, latency = self.simulate(updates, minutes)
+        self.assertLessEqual(polls, minutes + 2)
+        self.assertEqual(len(latency), minutes)
+        self.assertLessEqual(max(latency), jma.POLL_LAG + jma.POLL_MIN)
+
+    def test_unlearned_phase(self):
+        jma.state_db.execute('DELETE FROM feed_updates')
+        jma.record_feed_update(START)
+        self.assertEqual(jma.poll_delay(START + 30), jma.POLL_MIN)
+
+
+    def test_share_age(self):
+        # 予想される更新の前に他のシャードが取得したフィードは、POLL_MIN 以内でも使わない
+        before = START + PHASE - jma.POLL_PHASE_SPREAD
+        self.assertEqual(jma.feed_share_age(before - 30), jma.POLL_MIN)
+        self.assertEqual(jma.feed_share_age(before + 1), 1)
+        self.assertEqual(jma.feed_share_age(START + PHASE + jma.POLL_LAG), jma.POLL_MIN)
+
+        jma.state_db.execute('DELETE FROM feed_updates')
+        self.assertEqual(jma.feed_share_age(before + 1), jma.POLL_MIN)
+
+
+    def test_meta_without_area_state(self):
+        # 確認を見送る・304 の実行で使う meta の読み書きでは、全エリアの状態を読み込まない
+        jma.state_db.execute("INSERT INTO last VALUES (1310100, '', '03', '', '', ?)", (START - 120,))
+        jma.state_db.commit()
+        self.assertEqual(jma.catchup_gap(START), 120)
+        jma.record_feed_check()
+        jma.schedule_next_poll()
+        jma.oneshot_delay(START)
+        self.assertTrue(jma.warnings_active())
+        self.assertFalse(jma.state_loaded)
+
+        self.assertEqual(jma.read_last(1310100), {'wa': {}, 'ww': {'03': ''}, 'wuw': {}, 'wew': {}, 'time': START - 120})
+        self.assertTrue(jma.state_loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
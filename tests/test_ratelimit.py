@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bs_ratelimit
+
+
+class DeadlineTest(unittest.TestCase):
+    """call() の期限を過ぎる待ちはせずに DeadlineExceeded とする。"""
+
+    def setUp(self):
+        bs_ratelimit.buckets.clear()
+
+    def test_blocked_bucket(self):
+        # リセットまで 60 秒止められたアカウント（MAX_WAIT 以内なので期限が無ければ待つ）
+        key = ('acct', 'a')
+        bs_ratelimit.refill(key, time.monotonic())[2] = time.monotonic() + 60
+        start = time.monotonic()
+        with self.assertRaises(bs_ratelimit.DeadlineExceeded):
+            bs_ratelimit.call(lambda: bs_ratelimit.acquire(key), deadline=start + 1)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertIsNone(getattr(bs_ratelimit.local, 'deadline', None))
+
+    def test_retry_delay(self):
+        from atproto.exceptions import RateLimitExceededError
+        calls = []
+
+        def func():
+            calls.append(1)
+            raise RateLimitExceededError()
+
+        start = time.monotonic()
+        with self.assertRaises(bs_ratelimit.DeadlineExceeded):
+            bs_ratelimit.call(func, retries=3, deadline=start + bs_ratelimit.BACKOFF_BASE / 2)
+        self.assertEqual(len(calls), 1)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_nested_call_keeps_outer_deadline(self):
+        key = ('acct', 'b')
+        bs_ratelimit.refill(key, time.monotonic())[2] = time.monotonic() + 60
+        with self.assertRaises(bs_ratelimit.DeadlineExceeded):
+            bs_ratelimit.call(lambda: bs_ratelimit.call(lambda: bs_ratelimit.acquire(key)),
+                              deadline=time.monotonic() + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
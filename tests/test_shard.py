@@ -0,0 +1,101 @@
+import os
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jma
+
+SAVED = ('SHARD_INDEX', 'SHARD_COUNT', 'SHARD_DIR', 'LAST_DIR', 'LOCK_FILE', 'DAEMON_LOCK_FILE', 'FEED_STATE',
+         'LAST_MODIFIED', 'STATE_DB', 'LEDGER_FILE', 'AREA_CSV', 'POST_CSV', 'HANDLE_CACHE', 'shard_prefs')
+# (エリアコード, 都道府県名)。シャード 0/2 が 東京都、1/2 が 京都 を受け持つ
+AREAS = [('1310100', '東京都'), ('2610000', '京都')]
+
+
+class ShardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = {name: getattr(jma, name) for name in SAVED}
+        self.dir = tempfile.TemporaryDirectory()
+        jma.close_state()
+        base = self.dir.name + '/'
+        jma.LAST_DIR = base + 'last/'
+        jma.STATE_DB = jma.LAST_DIR + 'state.db'
+        jma.HANDLE_CACHE = jma.LAST_DIR + 'handles.db'
+        jma.AREA_CSV, jma.POST_CSV = base + 'area.csv', base + 'post.csv'
+        self.write_area(AREAS)
+        with open(jma.POST_CSV, 'w', encoding='utf-8') as f:
+            f.write(''.join(f'{code}wa,{code}wa.test,pw\n' for code, _ in AREAS))
+        os.makedirs(jma.LAST_DIR)
+
+    def tearDown(self):
+        jma.close_state()
+        for name, value in self.saved.items():
+            setattr(jma, name, value)
+        jma.config_loaded = False
+        self.dir.cleanup()
+
+    def write_area(self, areas):
+        with open(jma.AREA_CSV, 'w', encoding='utf-8') as f:
+            for code, p_name in areas:
+                accts = ','.join(f'{code}{g}' for g in ('wa', 'ww', 'wuw', 'wew', 'ewa', 'eww', 'ewuw', 'ewew'))
+                f.write(f'{code},市{code},City {code},x,{p_name},{accts},タグ,Tag\n')
+
+    def open_shard(self, index):
+        """従来の LAST_DIR から index 番目のシャード(2分割)を作り、(エリア毎の時刻, 送信待ちの投稿) を返す。"""
+        base_dir = self.dir.name + '/last/'
+        jma.LAST_DIR, jma.STATE_DB = base_dir, base_dir + 'state.db'
+        jma.setup_shard(index, 2, base_dir)
+        jma.load_state_cache()
+        last = {code: ref_last['time'] for code, ref_last in jma.state_cache.items()}
+        outbox = [acct for (acct,) in jma.state_db.execute("SELECT acct FROM outbox WHERE state = 'pending'")]
+        jma.close_state()
+        return last, outbox
+
+    def test_seed_from_state_files(self):
+        # state.db より前の形式（エリアコード名のファイル）だけがある
+        for n, (code, _) in enumerate(AREAS):
+            with open(jma.LAST_DIR + code, 'w') as f:
+                f.write(f'10\n\n\n\n{1000 + n}\n')
+        self.assertEqual(self.open_shard(0), ({1310100: 1000}, []))
+        self.assertEqual(self.open_shard(1), ({2610000: 1001}, []))
+
+    def test_seed_moves_pending_posts(self):
+        jma.open_state()
+        for n, (code, _) in enumerate(AREAS):
+            jma.state_db.execute('INSERT INTO last VALUES (?, ?, ?, ?, ?, ?)', (int(code), '10', '', '', '', 1000 + n))
+            jma.state_db.execute('INSERT INTO outbox (area_code, acct, report_time, lang, text, facets, created) '
+                                 "VALUES (?, ?, 1000, 'ja-JP', 'text', '[]', 0)", (int(code), f'{code}wa'))
+        jma.state_db.commit()
+        jma.close_state()
+
+        self.assertEqual(self.open_shard(0), ({1310100: 1000}, ['1310100wa']))
+        self.assertEqual(self.open_shard(1), ({2610000: 1001}, ['2610000wa']))
+        jma.LAST_DIR = self.dir.name + '/last/'
+        jma.STATE_DB = jma.LAST_DIR + 'state.db'
+        jma.open_state()
+        self.assertEqual(jma.state_db.execute("SELECT COUNT(*) FROM outbox WHERE state = 'pending'").fetchone(), (0,))
+
+    def test_overlapping_prefecture_names(self):
+        # 説明文に 東京都 と 京都 の両方が一致する電文も、シャードに分けない時と同じ都道府県を受け持つ1つのシャードだけが取る
+        feed = types.SimpleNamespace(entries=[types.SimpleNamespace(
+            title=jma.ITEM_TITLE_R06 + '（大雨）', description='【東京都気象警報・注意報】', link='http://x/a.xml')])
+        for areas in (AREAS, AREAS[::-1]):
+            self.write_area(areas)
+            jma.SHARD_COUNT = 1
+            jma.read_config()
+            unsharded = jma.check(feed)
+            self.assertEqual(len(unsharded), 1)
+            taken = []
+            for index in range(2):
+                jma.SHARD_INDEX, jma.SHARD_COUNT = index, 2
+                jma.assign_shard()
+                if jma.check(feed):
+                    taken.append((index, jma.check(feed)))
+            self.assertEqual(len(taken), 1)
+            self.assertEqual(taken[0][1], unsharded)
+
+
+if __name__ == '__main__':
+    unittest.main()
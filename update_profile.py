@@ -1,12 +1,16 @@
 #!/usr/bin/python3
+import argparse
 import csv
 import sys
-import time
-from atproto import Client
+from concurrent.futures import ThreadPoolExecutor
+from atproto.exceptions import BadRequestError
+
+import bs_ratelimit
+import bs_session
 
 POST_CSV = 'post.csv'
-POST_RETRY = 3
-POST_INTERVAL = 10
+POST_RETRY = 3  # 試行回数（再試行の間隔は bs_ratelimit が 429・5xx に応じて決める）
+SYNC_WORKERS = 8  # --sync: 同時に処理するアカウント数の上限
 
 
 def read_post_csv():
@@ -25,51 +29,139 @@ def read_post_csv():
     return credentials
 
 
-def update_profile(username, password, description):
-    try:
-        client = Client()
-        client.login(username, password)
-
-        # 既存のプロフィールレコードを取得し、avatar/banner/displayName 等を保持する。
-        # get_profile はビューを返すだけで avatar/banner の blob 参照を含まないため、
-        # レコード本体を get_record で取得して description のみ差し替える。
+# def login(account, username, password)
+# jma.py が保存したセッション（bs_session.SESSION_DIR/<account>）があれば再利用し、無い・失効している場合のみ
+# パスワードでログインする（createSession の回数制限を消費しない）。更新されたセッションは保存し直す。
+def login(account, username, password):
+    client = bs_session.new_client(account)
+    session_str = bs_session.read_session(account)
+    if session_str:
         try:
-            existing = client.com.atproto.repo.get_record({
-                'repo': client.me.did,
-                'collection': 'app.bsky.actor.profile',
-                'rkey': 'self',
-            })
-            record = existing.value
+            bs_ratelimit.call(lambda: client.login(session_string=session_str), POST_RETRY)
+            return client
         except Exception:
-            record = None
-
-        if record is not None:
-            record.description = description
-        else:
-            # レコードが存在しない場合は新規作成
-            record = {
-                '$type': 'app.bsky.actor.profile',
-                'description': description,
-            }
-
-        client.com.atproto.repo.put_record({
+            pass
+    bs_ratelimit.call(lambda: client.login(username, password), POST_RETRY)
+    return client
+
+
+def get_profile_record(client):
+    # 既存のプロフィールレコードを取得し、avatar/banner/displayName 等を保持する。
+    # get_profile はビューを返すだけで avatar/banner の blob 参照を含まないため、
+    # レコード本体を get_record で取得して description のみ差し替える。
+    try:
+        existing = bs_ratelimit.call(lambda: client.com.atproto.repo.get_record({
             'repo': client.me.did,
             'collection': 'app.bsky.actor.profile',
             'rkey': 'self',
-            'record': record,
-        })
+        }), POST_RETRY)
+        return existing.value
+    except BadRequestError as e:
+        # レコードが無い(RecordNotFound)時のみ新規作成する。その他の 400・5xx 等で取得できない場合は
+        # 既存レコードを description だけのレコードで上書きしないよう失敗とする
+        if getattr(getattr(e.response, 'content', None), 'error', None) == 'RecordNotFound':
+            return None
+        raise
+
+
+def put_profile_record(client, record, description):
+    if record is not None:
+        record.description = description
+    else:
+        # レコードが存在しない場合は新規作成
+        record = {
+            '$type': 'app.bsky.actor.profile',
+            'description': description,
+        }
+
+    bs_ratelimit.call(lambda: client.com.atproto.repo.put_record({
+        'repo': client.me.did,
+        'collection': 'app.bsky.actor.profile',
+        'rkey': 'self',
+        'record': record,
+    }), POST_RETRY)
+
+
+def update_profile(account, username, password, description):
+    # ログイン・書き込みはそれぞれ bs_ratelimit.call() で再試行する（認証エラーは再試行しない）。
+    try:
+        client = login(account, username, password)
+        put_profile_record(client, get_profile_record(client), description)
     except Exception as e:
         print(f"Error: Failed to update profile: {e}", file=sys.stderr)
         return 1
     return 0
 
 
-def main():
-    if len(sys.argv) < 2:
-        print(f"Usage: {sys.argv[0]} <input_csv>", file=sys.stderr)
+# def sync_profile(account, credential, description, dry_run)
+# 現在の description と比べ、異なる場合のみ書き込む
+# return: 'unchanged' / 'updated' / 'failed'
+def sync_profile(account, credential, description, dry_run):
+    try:
+        client = login(account, credential['username'], credential['password'])
+        record = get_profile_record(client)
+        if record is not None and (record.description or '') == description:
+            return 'unchanged'
+        if not dry_run:
+            put_profile_record(client, record, description)
+    except Exception as e:
+        print(f"Error: Failed to sync profile for '{account}': {e}", file=sys.stderr)
+        return 'failed'
+    print(f"{'Would update' if dry_run else 'Updated'} profile for {account}: "
+          f"{description[:50]}{'...' if len(description) > 50 else ''}")
+    return 'updated'
+
+
+# def sync_main(args)
+# 入力の全アカウントを SYNC_WORKERS 本まで並列に処理し、変更のあったものだけ書き込む。
+# 同じアカウントが複数行ある場合は最後の行を使う。
+def sync_main(args):
+    credentials = read_post_csv()
+    descriptions = {}
+    try:
+        with open(args.input, 'r', encoding='utf-8') as f:
+            for row in csv.reader(f):
+                if len(row) >= 2:
+                    descriptions[row[0]] = row[1]
+    except (FileNotFoundError, IOError) as e:
+        print(f"Error: Cannot read {args.input}: {e}", file=sys.stderr)
         sys.exit(1)
 
-    input_csv = sys.argv[1]
+    counts = {'unchanged': 0, 'updated': 0, 'failed': 0}
+    jobs = []
+    for account, description in descriptions.items():
+        if account not in credentials:
+            print(f"Warning: No credentials for account '{account}', skipping.", file=sys.stderr)
+            counts['failed'] += 1
+            continue
+        jobs.append((account, credentials[account], description, args.dry_run))
+
+    if jobs:
+        with ThreadPoolExecutor(max_workers=min(args.workers, len(jobs))) as executor:
+            for result in executor.map(lambda job: sync_profile(*job), jobs):
+                counts[result] += 1
+
+    print(f"unchanged={counts['unchanged']}, updated={counts['updated']}, failed={counts['failed']}"
+          f"{' (dry run)' if args.dry_run else ''}", file=sys.stderr)
+    sys.exit(1 if counts['failed'] else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Update the profile description of Bluesky accounts listed in post.csv.')
+    parser.add_argument('input', help='input CSV (account,description)')
+    parser.add_argument('--sync', action='store_true',
+                        help='compare with the current descriptions in parallel and write only the changed ones')
+    parser.add_argument('--workers', type=int, default=SYNC_WORKERS,
+                        help='--sync: accounts processed in parallel (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='--sync: only report which accounts would be updated')
+    args = parser.parse_args()
+
+    if args.sync or args.dry_run:
+        sync_main(args)
+        return
+
+    input_csv = args.input
     credentials = read_post_csv()
 
     try:
@@ -84,15 +176,10 @@ def main():
                     continue
                 username = credentials[account]['username']
                 password = credentials[account]['password']
-                for attempt in range(POST_RETRY):
-                    result = update_profile(username, password, description)
-                    if result == 0:
-                        print(f"Updated profile for {account}: {description[:50]}{'...' if len(description) > 50 else ''}")
-                        break
-                    if attempt < POST_RETRY - 1:
-                        time.sleep(POST_INTERVAL)
+                if update_profile(account, username, password, description) == 0:
+                    print(f"Updated profile for {account}: {description[:50]}{'...' if len(description) > 50 else ''}")
                 else:
-                    print(f"Error: Aborted updating profile for '{account}' after {POST_RETRY} attempts.", file=sys.stderr)
+                    print(f"Error: Aborted updating profile for '{account}'.", file=sys.stderr)
     except (FileNotFoundError, IOError) as e:
         print(f"Error: Cannot read {input_csv}: {e}", file=sys.stderr)
         sys.exit(1)